@@ -1,37 +1,53 @@
 #__init__.py
 '''
 Flask app instance setup. Extends `config.py` Config object.
-Initialize app blueprints and dependencie modules
+Initialize app blueprints and dependencie modules. Clients of outside
+services (S3, OAuth) are created on first use, see `common/services.py`
 '''
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from flask_mail import Mail
-from oauthlib.oauth2 import WebApplicationClient
-from boto3 import resource
+from app.common.cache import Cache
+from app.common.database import RoutingSQLAlchemy
+from app.common.events import Events
+from app.common.ratelimit import Limiter
 
 import os
 
+from app import config
 from app.config import Development
 from app.config import Production
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 jwt = JWTManager()
 mail = Mail()
-client = WebApplicationClient(os.environ.get('GOOGLE_CLIENT_ID'))
-s3 = resource('s3')
+cache = Cache()
+events = Events()
+limiter = Limiter()
 
 
-def instance(mode=Production):
+def instance(mode=None):
+    if mode is None:
+        '''`APP_CONFIG` names a `config.py` class, Production by default'''
+        mode = getattr(config, os.environ.get('APP_CONFIG', 'Production'))
     app = Flask(__name__)
     CORS(app)
     app.config.from_object(mode)
 
+    from app.common import database, identity, metrics, revocation, uploads
+    database.init_app(app)
+    metrics.init_app(app)
     db.init_app(app)
     jwt.init_app(app)
+    identity.init_app(app)
+    revocation.init_app(app)
     mail.init_app(app)
+    cache.init_app(app)
+    events.init_app(app)
+    limiter.init_app(app)
+    uploads.init_app(app)
 
     from app.resources.user_auths import user_auths
     from app.resources.content_manager import contents
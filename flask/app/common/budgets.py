@@ -0,0 +1,136 @@
+# budgets.py
+'''
+SQL statement budgets of endpoints.
+
+Views declare with `query_budget` how many statements a request may run.
+The number must hold however many rows exist: a lazy load per project or
+notification makes the count grow with the data. `bench/queries.py` replays
+every endpoint on a small and a large dataset and fails when a request goes
+over budget, runs more statements on the larger one or does a full table
+scan, printing the offending statements with their query plan. In every
+environment `metrics` logs requests running over budget.
+'''
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import re
+import threading
+import time
+
+'''SQLite `SCAN TABLE x` / `SCAN x` without an index, PostgreSQL `Seq Scan`'''
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?\w+( AS \w+)?$|Seq Scan on')
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def query_budget(default=None, **methods):
+    '''
+    Declare the SQL statement budget of a view, right under its route
+    decorator
+
+    Args:
+        default (int): Statements a request of any method may run
+        methods (int): Budget of one method, e.g. `POST=4`
+
+    Returns:
+        decorator
+    '''
+    def decorator(view):
+        view.query_budget = dict(methods)
+        view.query_budget['*'] = default
+        return view
+    return decorator
+
+
+def budget_of(view, method):
+    '''
+    Budget declared for a view and method
+
+    Returns:
+        (int): None when the view declares none
+    '''
+    budgets = getattr(view, 'query_budget', None)
+    if budgets is None:
+        return None
+    return budgets.get(method, budgets['*'])
+
+
+class Statement(object):
+    '''A statement run while recording'''
+
+    __slots__ = ('engine', 'sql', 'parameters', 'many', 'seconds', 'plan')
+
+    def __init__(self, engine, sql, parameters, many):
+        self.engine = engine
+        self.sql = sql
+        self.parameters = parameters
+        self.many = many
+        self.seconds = None
+        self.plan = None
+
+    def explain(self):
+        '''
+        Query plan lines, `EXPLAIN QUERY PLAN` on SQLite. Runs once, while
+        the database is still around
+
+        Returns:
+            (list): Plan lines, empty for statements without a plan
+        '''
+        if self.plan is not None:
+            return self.plan
+        self.plan = []
+        if self.many or not self.sql.lstrip().upper().startswith(EXPLAINED):
+            return self.plan
+        sqlite = self.engine.dialect.name == 'sqlite'
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(('EXPLAIN QUERY PLAN ' if sqlite else 'EXPLAIN ') +
+                           self.sql, self.parameters)
+            self.plan = [str(row[-1]) for row in cursor.fetchall()]
+        finally:
+            connection.close()
+        return self.plan
+
+    def full_scans(self):
+        '''Plan lines reading a whole table'''
+        return [line for line in self.explain() if FULL_SCAN.search(line)]
+
+
+class Recorder(object):
+    '''
+    Records the statements this thread runs inside the `with` block,
+    streamed response bodies included when consumed inside it
+
+        with Recorder() as recorder:
+            client.get('/list').get_data()
+        len(recorder.statements)
+    '''
+
+    def __init__(self):
+        self.statements = []
+        self.thread = None
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if threading.get_ident() == self.thread:
+            self.statements.append(Statement(conn.engine, statement,
+                                             parameters, executemany))
+            conn.info['budgets_start'] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        start = conn.info.pop('budgets_start', None)
+        if start is not None and threading.get_ident() == self.thread:
+            self.statements[-1].seconds = time.perf_counter() - start
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        event.listen(Engine, 'before_cursor_execute', self._before)
+        event.listen(Engine, 'after_cursor_execute', self._after)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'before_cursor_execute', self._before)
+        event.remove(Engine, 'after_cursor_execute', self._after)
+        self.thread = None
@@ -0,0 +1,235 @@
+# cache.py
+'''
+Read-through response cache for anonymous catalog endpoints.
+
+Entries are keyed by request plus the current version of every scope the
+response depends on (`catalog`, `project:<id>`, `autor:<id>`). Writers bump
+scope versions instead of deleting keys, stale entries just stop being read
+and age out by TTL.
+'''
+
+from flask import request, current_app
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+class MemoryBackend(object):
+    '''Per-process LRU with TTL. Versions are kept apart from LRU eviction'''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def version(self, key):
+        return self.versions.get(key, 0)
+
+    def bump(self, key):
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+
+def uwsgi_caches(*names):
+    '''
+    uWSGI module, checking the instance declares the given cache2 stores:
+    reads of a missing store return None without error
+
+    Raises:
+        ImportError: Not running under uWSGI
+        RuntimeError: A store is not declared
+
+    Returns:
+        The `uwsgi` module
+    '''
+    import uwsgi
+    entries = uwsgi.opt.get('cache2', [])
+    if not isinstance(entries, list):
+        entries = [entries]
+    declared = set()
+    for entry in entries:
+        if isinstance(entry, bytes):
+            entry = entry.decode()
+        for option in entry.split(','):
+            key, _, value = option.partition('=')
+            if key.strip() == 'name':
+                declared.add(value.strip())
+    missing = [name for name in names if name not in declared]
+    if missing:
+        raise RuntimeError('uwsgi cache2 not declared: {}'.format(
+            ', '.join(missing)))
+    return uwsgi
+
+
+class UwsgiBackend(object):
+    '''
+    uWSGI cache2 stores shared by every worker of the instance. Responses
+    go to an LRU store, versions to one never evicting, where a lost bump
+    would serve stale entries until they expire
+    '''
+
+    def __init__(self, name, versions):
+        self.uwsgi = uwsgi_caches(name, versions)
+        self.name = name
+        self.versions = versions
+
+    def get(self, key):
+        return self.uwsgi.cache_get(key, self.name)
+
+    def set(self, key, value, ttl):
+        if not self.uwsgi.cache_update(key, value, ttl, self.name):
+            current_app.logger.warning('uwsgi cache %s refused %s',
+                                       self.name, key)
+
+    def version(self, key):
+        value = self.uwsgi.cache_get('ver:' + key, self.versions)
+        return int(value) if value else 0
+
+    def bump(self, key):
+        self.uwsgi.lock()
+        try:
+            stored = self.uwsgi.cache_update(
+                'ver:' + key, str(self.version(key) + 1).encode(), 0,
+                self.versions)
+        finally:
+            self.uwsgi.unlock()
+        if not stored:
+            '''Callers bump after their commit, no point failing them'''
+            current_app.logger.error('uwsgi cache %s is full, %s not bumped',
+                                     self.versions, key)
+
+
+class RedisBackend(object):
+    '''Redis store, shared by every process pointed at the same server'''
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def set(self, key, value, ttl):
+        self.redis.set(key, value, ex=ttl)
+
+    def version(self, key):
+        value = self.redis.get('ver:' + key)
+        return int(value) if value else 0
+
+    def bump(self, key):
+        self.redis.incr('ver:' + key)
+
+
+class Cache(object):
+    '''
+    Cache extension, backend picked from `CACHE_BACKEND` config:
+    `memory` (default), `uwsgi` or `redis`
+    '''
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config.get('CACHE_BACKEND', 'memory')
+        if kind == 'uwsgi':
+            try:
+                self.backend = UwsgiBackend(app.config['CACHE_UWSGI_NAME'],
+                                            app.config['CACHE_UWSGI_VERSIONS'])
+            except ImportError:
+                '''Not running under uWSGI, e.g. `python wsgi.py`'''
+                app.logger.warning('uwsgi cache unavailable, using memory')
+                kind = 'memory'
+        elif kind == 'redis':
+            self.backend = RedisBackend(app.config['CACHE_REDIS_URL'])
+        if kind == 'memory':
+            self.backend = MemoryBackend(app.config['CACHE_MAX_ENTRIES'])
+        app.extensions['cache'] = self
+
+    @staticmethod
+    def scope(*parts):
+        return ':'.join(str(part) for part in parts)
+
+    def bump(self, *parts):
+        '''Invalidate every entry depending on a scope'''
+        self.backend.bump(self.scope(*parts))
+
+    def invalidate_project(self, *project_ids):
+        '''Invalidate catalog pages and the given projects'''
+        self.bump('catalog')
+        for project_id in project_ids:
+            self.bump('project', project_id)
+
+    def invalidate_autor(self, user):
+        '''Invalidate an author profile and everything showing their info'''
+        self.bump('autor', user.id)
+        self.invalidate_project(*[proj.id for proj in user.projects])
+
+    def response(self, key, scopes, build):
+        '''
+        Serve a response from cache, building and storing it on miss.
+        Responses get an ETag and 304 is answered to matching If-None-Match
+
+        Args:
+            key (str): Request identity, None to bypass the cache (e.g.
+            responses personalized for a logged user)
+            scopes (list): Scope tuples the response depends on
+            build (function): Returns the Response when not cached
+
+        Returns:
+            Response
+        '''
+        if key is None:
+            response = build()
+            if response.is_streamed:
+                '''No ETag without buffering the whole body'''
+                return response
+            response.add_etag()
+            return response.make_conditional(request)
+        versions = ','.join(str(self.backend.version(self.scope(*scope)))
+                            for scope in scopes)
+        full_key = 'resp:{}:{}'.format(key, versions)
+        value = self.backend.get(full_key)
+        if value is not None:
+            etag, body = value.split(b' ', 1)
+            response = current_app.response_class(
+                body, mimetype='application/json')
+            response.set_etag(etag.decode('ascii'))
+        else:
+            response = build()
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            etag = hashlib.sha1(body).hexdigest()
+            response.set_etag(etag)
+            self.backend.set(full_key, etag.encode('ascii') + b' ' + body,
+                             current_app.config['CACHE_TTL'])
+        return response.make_conditional(request)
+
+
+def request_key(*parts):
+    '''Build a cache key from a prefix and arbitrary request data'''
+    digest = hashlib.sha1(repr(parts[1:]).encode('utf-8')).hexdigest()
+    return '{}:{}'.format(parts[0], digest)
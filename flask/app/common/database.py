@@ -0,0 +1,161 @@
+# database.py
+'''
+Database engine setup. Builds per-process pool options for every bind,
+applies `SQLITE_PRAGMAS` on each new SQLite connection, drops pooled
+connections inherited through a fork (`services.postfork`) and routes reads of GET
+requests to read-only replicas (`SQLALCHEMY_REPLICA_BINDS`)
+
+Under gevent sessions are per greenlet already (Flask-SQLAlchemy scopes
+them by the Werkzeug context ident, a greenlet when greenlet is installed).
+SQLite calls still run on the worker's only thread: keep write
+transactions short, a writer waiting on `busy_timeout` stalls every
+greenlet of its process
+'''
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.expression import Select, TextClause
+from .services import postfork
+
+import sqlite3
+import threading
+
+_pragmas = []
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session sending the SELECTs of GET/HEAD requests to the bind replica,
+    when one is configured. Flushes, bulk statements and every statement
+    following a write in the same session go to the primary
+    '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not self._reads_from_replica(clause):
+            return super().get_bind(mapper, clause)
+        bind_key = None
+        if mapper is not None:
+            bind_key = mapper.persist_selectable.info.get('bind_key')
+        elif clause is not None:
+            for table in getattr(clause, 'froms', ()):
+                bind_key = getattr(table, 'info', {}).get('bind_key')
+        replica = self.db.get_replica(self.app, bind_key)
+        return replica or super().get_bind(mapper, clause)
+
+    def _reads_from_replica(self, clause):
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+        if self.info.get('wrote'):
+            return False
+        if isinstance(clause, Select) or (
+                isinstance(clause, TextClause) and
+                clause.text.lstrip().upper().startswith('SELECT')):
+            return True
+        '''Write statement, stick to the primary from now on'''
+        self.info['wrote'] = True
+        return False
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''Flask-SQLAlchemy with replica aware sessions'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._replicas = dict()
+        self._replicas_lock = threading.Lock()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_replica(self, app, bind_key):
+        '''Replica engine of a bind, None when it has no replica'''
+        uri = app.config['SQLALCHEMY_REPLICA_BINDS'].get(bind_key)
+        if not uri:
+            return None
+        with self._replicas_lock:
+            if (app, bind_key) not in self._replicas:
+                self._replicas[(app, bind_key)] = create_engine(
+                    uri, **engine_options(app.config))
+            return self._replicas[(app, bind_key)]
+
+    def dispose_replicas(self):
+        with self._replicas_lock:
+            for engine in self._replicas.values():
+                engine.dispose()
+
+
+def engine_options(config):
+    '''
+    Engine options from config, shared by every bind
+
+    Args:
+        config (Config): Application config
+
+    Returns:
+        (dict): `create_engine` keyword arguments
+    '''
+    pool = dict(pool_size=config['DATABASE_POOL_SIZE'],
+                max_overflow=config['DATABASE_MAX_OVERFLOW'],
+                pool_timeout=config['DATABASE_POOL_TIMEOUT'])
+    if config['WORKER_MODE'] == 'gevent':
+        '''Hundreds of greenlets per process share a hard bounded pool, the
+        patched Condition of QueuePool makes waiting for it cooperative'''
+        pool.update(pool_size=config['DATABASE_GEVENT_POOL_SIZE'],
+                    max_overflow=0)
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        busy_timeout = dict(config['SQLITE_PRAGMAS']).get('busy_timeout', 0)
+        return dict(pool, poolclass=QueuePool,
+                    connect_args={'check_same_thread': False,
+                                  'timeout': busy_timeout / 1000})
+    if config['DATABASE_PGBOUNCER']:
+        '''pgbouncer does the pooling, a client side pool would pin server
+        connections to idle workers'''
+        return dict(poolclass=NullPool)
+    return dict(pool, pool_pre_ping=True, pool_recycle=1800)
+
+
+@event.listens_for(Engine, 'connect')
+def set_pragmas(dbapi_connection, connection_record):
+    '''Apply configured pragmas to every new SQLite connection'''
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas:
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
+def dispose_engines(app):
+    '''
+    Drop pooled connections of every bind, new ones are opened on demand.
+    Connections must never be shared between forked processes
+
+    Returns:
+        void
+    '''
+    db = app.extensions['sqlalchemy'].db
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+            db.get_engine(app, bind).dispose()
+    db.dispose_replicas()
+
+
+def init_app(app):
+    '''
+    Configure engines before Flask-SQLAlchemy creates them
+
+    Returns:
+        void
+    '''
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        engine_options(app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    _pragmas[:] = app.config['SQLITE_PRAGMAS']
+    postfork(lambda: dispose_engines(app))
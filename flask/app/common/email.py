@@ -1,9 +1,29 @@
 # email.py
-'''Confirmation and alert e-mail senders'''
+'''
+Confirmation and alert e-mail senders. Messages are stored in the outbox
+table and delivered by the background sender in `outbox.py`
+'''
 
-from flask_mail import Message
+from app import db
+from .models import OutboxEmail
 
-from app import mail
+
+def enqueue_email(recipient, html, subject='Hello', sender='email@email.com'):
+    '''
+    Store a message in the outbox, to be sent by the outbox worker
+
+    Args:
+        recipient (str): Target e-mail address
+        html (str): Message html body
+        subject (str): Message subject
+        sender (str): From address
+
+    Returns:
+        void
+    '''
+    db.session.add(OutboxEmail(recipient=recipient, sender=sender,
+                               subject=subject, html=html))
+    db.session.commit()
 
 
 def send_confirmation_link(user_email, access_code):
@@ -17,13 +37,10 @@ def send_confirmation_link(user_email, access_code):
     Returns:
         void
     '''
-    msg = Message('Hello', sender="email@email.com",
-                  recipients=[user_email])
-    msg.html = """
+    enqueue_email(user_email, """
 <h1>Confirmação de cadastro</h1>
 <a href=https://fabricio7p.com.br//verify?code={}>Clique no link</a>
-""".format(access_code)
-    mail.send(msg)
+""".format(access_code))
 
 
 def send_partner_notification_email(user_email):
@@ -36,13 +53,10 @@ def send_partner_notification_email(user_email):
     Returns:
         void
     '''
-    msg = Message('Hello', sender="email@email.com",
-                  recipients=[user_email])
-    msg.html = """
+    enqueue_email(user_email, """
 <h1>Você solicitou se tornar um membro do site Ikebana Sanguetsu</h1>
 <h2>Aproveite as novas funcionalidades.</h2>
-"""
-    mail.send(msg)
+""")
 
 
 def send_recover_email(user_email, access_code):
@@ -56,10 +70,7 @@ def send_recover_email(user_email, access_code):
     Returns:
         void
     '''
-    msg = Message('Hello', sender="email@email.com",
-                  recipients=[user_email])
-    msg.html = """
+    enqueue_email(user_email, """
 <h1>Recuperação de senha</h1>
 <a href="https://fabricio7p.com.br/reset_pass?code={}">Clique aqui</a>
-    """.format(access_code)
-    mail.send(msg)
+    """.format(access_code))
@@ -0,0 +1,127 @@
+# events.py
+'''
+Notification pub-sub for the `/notifications/stream` endpoint.
+
+Published messages carry no payload, they only wake the streams of a user,
+which then read new `Notification` rows past their last event id. A lost
+wake-up costs at most `EVENTS_POLL_INTERVAL` of latency since every stream
+also polls. The `local` backend only reaches streams of the publishing
+process, `redis` reaches every process pointed at the same server.
+'''
+
+from collections import defaultdict
+
+import threading
+
+
+class LocalSubscription(object):
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        '''Block until woken or timeout, True if woken'''
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return woken
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    '''In-process subscriptions, also cooperative under gevent'''
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscription = LocalSubscription(self, user_id)
+        with self.lock:
+            self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions[subscription.user_id]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    def publish(self, user_id):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.event.set()
+
+
+class RedisSubscription(object):
+
+    def __init__(self, redis, channel):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def wait(self, timeout):
+        return self.pubsub.get_message(timeout=timeout) is not None
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker(object):
+    '''Redis channels, one per user'''
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.errors = redis.RedisError
+
+    @staticmethod
+    def channel(user_id):
+        return 'notifications:{}'.format(user_id)
+
+    def subscribe(self, user_id):
+        return RedisSubscription(self.redis, self.channel(user_id))
+
+    def publish(self, user_id):
+        try:
+            self.redis.publish(self.channel(user_id), b'')
+        except self.errors:
+            '''Streams catch up on their next poll'''
+            pass
+
+
+class Events(object):
+    '''
+    Pub-sub extension, backend picked from `EVENTS_BACKEND` config:
+    `local` (default) or `redis`
+    '''
+
+    def __init__(self, app=None):
+        self.broker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('EVENTS_BACKEND', 'local') == 'redis':
+            self.broker = RedisBroker(app.config['EVENTS_REDIS_URL'])
+        else:
+            self.broker = LocalBroker()
+        app.extensions['events'] = self
+
+    def subscribe(self, user_id):
+        '''
+        Listen to a user notifications
+
+        Returns:
+            subscription: `wait(timeout)` and `close()` object
+        '''
+        return self.broker.subscribe(user_id)
+
+    def publish(self, *user_ids):
+        '''Wake the streams of every given user, call after commit'''
+        for user_id in set(user_ids):
+            self.broker.publish(user_id)
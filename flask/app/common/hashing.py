@@ -1,16 +1,125 @@
 #hashing.py
+'''
+Password hashing service.
+
+Key derivation runs in a bounded process pool (`PASSWORD_HASH_WORKERS`) so
+request workers only wait on it. At most `PASSWORD_HASH_QUEUE` derivations
+may be pending per process, past that requests are answered with 429.
+
+Stored formats:
+    legacy: 64 hex salt followed by the hex PBKDF2-SHA512 digest, 100000
+    iterations
+    $pbkdf2_sha512$<iterations>$<salt>$<digest>
+    $scrypt$<n>$<r>$<p>$<salt>$<digest>
+'''
+
+from flask import abort, current_app, jsonify
+from concurrent.futures import TimeoutError
+from .pools import get_pool
 
 import os
+import hmac
 import binascii
 import hashlib
+import threading
+
+LEGACY_ITERATIONS = 100000
+
+_slots = dict()
+_slots_lock = threading.Lock()
+
+
+def derive(algorithm, password, salt, params):
+    '''
+    Compute a password digest. Runs inside the hashing pool
+
+    Args:
+        algorithm (str): `pbkdf2_sha512` or `scrypt`
+        password (str): Unhashed password
+        salt (str): Ascii salt
+        params (tuple): (iterations,) for pbkdf2, (n, r, p) for scrypt
+
+    Returns:
+        digest (str): Hex digest
+    '''
+    if algorithm == 'scrypt':
+        n, r, p = params
+        pwdhash = hashlib.scrypt(password.encode('utf-8'),
+                                 salt=salt.encode('ascii'), n=n, r=r, p=p,
+                                 maxmem=128 * n * r * p + 1024 * 1024)
+    else:
+        pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'),
+                                      salt.encode('ascii'), params[0])
+    return binascii.hexlify(pwdhash).decode('ascii')
+
+
+def _configured():
+    '''Algorithm and parameters new hashes are created with'''
+    config = current_app.config
+    if config['PASSWORD_HASH_ALGORITHM'] == 'scrypt':
+        return 'scrypt', (config['PASSWORD_SCRYPT_N'],
+                          config['PASSWORD_SCRYPT_R'],
+                          config['PASSWORD_SCRYPT_P'])
+    return 'pbkdf2_sha512', (config['PASSWORD_PBKDF2_ITERATIONS'],)
+
+
+def _parse(stored_password):
+    '''Split a stored hash into (algorithm, params, salt, digest)'''
+    if not stored_password.startswith('$'):
+        return ('pbkdf2_sha512', (LEGACY_ITERATIONS,),
+                stored_password[:64], stored_password[64:])
+    fields = stored_password[1:].split('$')
+    params = tuple(int(field) for field in fields[1:-2])
+    return fields[0], params, fields[-2], fields[-1]
+
+
+def _slot():
+    '''Per-process semaphore bounding pending derivations'''
+    with _slots_lock:
+        slot, pid = _slots.get('slot', (None, None))
+        if slot is None or pid != os.getpid():
+            slot = threading.BoundedSemaphore(
+                current_app.config['PASSWORD_HASH_QUEUE'])
+            _slots['slot'] = (slot, os.getpid())
+        return slot
+
+
+def _run(algorithm, password, salt, params):
+    '''
+    Derive in the hashing pool, inline when `PASSWORD_HASH_WORKERS` is 0
+
+    Raises:
+        429: Too many pending derivations in this process
+        503: Derivation timed out
+    '''
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if not workers:
+        return derive(algorithm, password, salt, params)
+    slot = _slot()
+    if not slot.acquire(blocking=False):
+        response = jsonify({'error': 'too many requests'})
+        response.status_code = 429
+        response.headers['Retry-After'] = '1'
+        abort(response)
+    try:
+        future = get_pool('hashing', workers, processes=True).submit(
+            derive, algorithm, password, salt, params)
+        return future.result(
+            timeout=current_app.config['PASSWORD_HASH_TIMEOUT'])
+    except TimeoutError:
+        abort(503)
+    finally:
+        slot.release()
+
 
 def hash_password(password):
     """Hash a password for storing"""
-    salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
-    pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), 
-                                  salt, 100000)
-    pwdhash = binascii.hexlify(pwdhash)
-    return (salt + pwdhash).decode('ascii')
+    algorithm, params = _configured()
+    salt = hashlib.sha256(os.urandom(60)).hexdigest()[:32]
+    pwdhash = _run(algorithm, password, salt, params)
+    return '$' + '$'.join([algorithm] + [str(param) for param in params] +
+                          [salt, pwdhash])
+
 
 def verify_password(stored_password, provided_password):
     '''
@@ -23,11 +132,21 @@ def verify_password(stored_password, provided_password):
     Returns:
         (boolean): True on match, False otherwise
     '''
-    salt = stored_password[:64]
-    stored_password = stored_password[64:]
-    pwdhash = hashlib.pbkdf2_hmac('sha512', 
-                                  provided_password.encode('utf-8'), 
-                                  salt.encode('ascii'), 
-                                  100000)
-    pwdhash = binascii.hexlify(pwdhash).decode('ascii')
-    return pwdhash == stored_password
+    algorithm, params, salt, stored_hash = _parse(stored_password)
+    pwdhash = _run(algorithm, provided_password, salt, params)
+    return hmac.compare_digest(pwdhash, stored_hash)
+
+
+def needs_rehash(stored_password):
+    '''
+    Check whether a stored hash was made with other than the configured
+    algorithm and parameters, it should be replaced on next successful login
+
+    Args:
+        stored_password (str): Stored user password hash
+
+    Returns:
+        (boolean)
+    '''
+    algorithm, params, _, _ = _parse(stored_password)
+    return (algorithm, params) != _configured()
@@ -0,0 +1,153 @@
+# identity.py
+'''
+Token identity handling.
+
+Access tokens carry the user id and role claims (`id`, `partner`,
+`confirmed`) so other services can authorize without our database. Inside
+the app `current_user` resolves to a `UserSnapshot` kept in a per-process
+LRU for `USER_CACHE_TTL` seconds. Snapshots remember the `autor:<id>` cache
+version they were read at, `cache.invalidate_autor` bumps it and every
+process drops its copy on next use. Handlers that change the user load the
+row with `User.query.get(current_user.id)`.
+
+With an asymmetric `JWT_ALGORITHM` tokens name their key with a `kid` header
+and the public key is published as a JWKS.
+'''
+
+from flask import current_app
+from flask_jwt_extended import get_raw_jwt
+from jwt.algorithms import ECAlgorithm, RSAAlgorithm
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from collections import OrderedDict
+from app import cache, jwt
+from .models import User
+
+import hashlib
+import json
+import threading
+import time
+
+_snapshots = OrderedDict()
+_lock = threading.Lock()
+
+
+class UserSnapshot(object):
+    '''Read-only copy of the user fields handlers authorize with'''
+
+    __slots__ = ('id', 'username', 'email', 'fullname', 'partner',
+                 'confirmed', 'tokens_valid_after', 'version', 'expires')
+
+    def __init__(self, user, version, expires):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.fullname = user.fullname
+        self.partner = bool(user.partner)
+        self.confirmed = bool(user.confirmed)
+        '''Epoch seconds, tokens issued (`iat`) before are revoked'''
+        self.tokens_valid_after = 0
+        if user.tokens_revoked_on:
+            self.tokens_valid_after = int(user.tokens_revoked_on.timestamp())
+        self.version = version
+        self.expires = expires
+
+
+def _version(user_id):
+    return cache.backend.version(cache.scope('autor', user_id))
+
+
+def snapshot(username, user_id=None):
+    '''
+    Cached snapshot of a user
+
+    Args:
+        username (str): Token identity
+        user_id (int): `id` claim, primary key lookup on miss when present
+
+    Returns:
+        (UserSnapshot): None if the user no longer exists
+    '''
+    now = time.monotonic()
+    with _lock:
+        cached = _snapshots.get(username)
+        if cached is not None:
+            _snapshots.move_to_end(username)
+    if (cached is not None and cached.expires > now and
+            cached.version == _version(cached.id)):
+        return cached
+    if user_id is not None:
+        user = User.query.get(user_id)
+    else:
+        user = User.query.filter_by(username=username).first()
+    if user is None or user.username != username:
+        with _lock:
+            _snapshots.pop(username, None)
+        return None
+    cached = UserSnapshot(user, _version(user.id),
+                          now + current_app.config['USER_CACHE_TTL'])
+    with _lock:
+        _snapshots[username] = cached
+        while len(_snapshots) > current_app.config['USER_CACHE_SIZE']:
+            _snapshots.popitem(last=False)
+    return cached
+
+
+@jwt.user_claims_loader
+def user_claims(identity):
+    '''Claims added to every access token'''
+    user = snapshot(identity)
+    if user is None:
+        return {}
+    return {'id': user.id, 'partner': user.partner,
+            'confirmed': user.confirmed}
+
+
+@jwt.user_loader_callback_loader
+def load_user(identity):
+    '''`current_user` of protected endpoints, None answers 401'''
+    return snapshot(identity, get_raw_jwt().get(
+        current_app.config['JWT_USER_CLAIMS'], {}).get('id'))
+
+
+def _read(path):
+    with open(path) as file:
+        return file.read()
+
+
+def init_app(app):
+    '''
+    Drop cached snapshots and load the signing key pair files of
+    asymmetric algorithms
+
+    Returns:
+        void
+    '''
+    '''Snapshots hold cache versions of the previous app, if any'''
+    _snapshots.clear()
+    config = app.config
+    if config['JWT_ALGORITHM'].startswith('HS'):
+        return
+    if config['JWT_PRIVATE_KEY_FILE']:
+        config['JWT_PRIVATE_KEY'] = _read(config['JWT_PRIVATE_KEY_FILE'])
+    if config['JWT_PUBLIC_KEY_FILE']:
+        config['JWT_PUBLIC_KEY'] = _read(config['JWT_PUBLIC_KEY_FILE'])
+    public_key = serialization.load_pem_public_key(
+        config['JWT_PUBLIC_KEY'].encode(), backend=default_backend())
+    der = public_key.public_bytes(
+        serialization.Encoding.DER,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+    algorithm = RSAAlgorithm if config['JWT_ALGORITHM'].startswith(
+        ('RS', 'PS')) else ECAlgorithm
+    jwk = json.loads(algorithm.to_jwk(public_key))
+    jwk.update(kid=hashlib.sha256(der).hexdigest()[:16], use='sig',
+               alg=config['JWT_ALGORITHM'])
+    config['JWT_JWKS'] = {'keys': [jwk]}
+
+
+def token_headers():
+    '''Extra token headers, the key id when signing asymmetrically'''
+    jwks = current_app.config.get('JWT_JWKS')
+    if not jwks:
+        return None
+    return {'kid': jwks['keys'][0]['kid']}
@@ -0,0 +1,73 @@
+# images.py
+'''
+Picture renditions. Every uploaded image is decoded once, oriented by its
+EXIF tag, and re-encoded without metadata to each configured size in WebP
+and JPEG. Runs inside the image process pool, see `uploads.py`
+'''
+
+from PIL import Image, ImageOps
+
+import os
+import tempfile
+
+FORMATS = (
+    ('webp', 'WEBP', 'image/webp'),
+    ('jpeg', 'JPEG', 'image/jpeg'),
+)
+
+
+def _flatten(image):
+    '''Drop alpha over a white background, JPEG has no transparency'''
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+
+def render_variants(path, renditions, quality, max_pixels):
+    '''
+    Render every rendition of an image file
+
+    Args:
+        path (str): Source image path
+        renditions (tuple): (name, max side in pixels) pairs, largest first
+        quality (int): Encoder quality for both formats
+        max_pixels (int): Refuse images above this pixel count
+
+    Raises:
+        PIL.UnidentifiedImageError: Not an image
+        PIL.Image.DecompressionBombError: Image over `max_pixels`
+
+    Returns:
+        (list): Dicts with rendition, format, content_type, path, width and
+        height of every rendered file
+    '''
+    '''Pillow refuses at open past twice the limit and only warns below'''
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    folder = os.path.dirname(path)
+    variants = []
+    with Image.open(path) as source:
+        '''Header only so far, check before decoding'''
+        if source.width * source.height > max_pixels:
+            raise Image.DecompressionBombError(
+                'Image size ({} pixels) exceeds limit of {} pixels'.format(
+                    source.width * source.height, max_pixels))
+        image = _flatten(ImageOps.exif_transpose(source))
+    for name, size in sorted(renditions, key=lambda item: -item[1]):
+        '''Downscale from the previous, larger, rendition. Never upscales'''
+        image.thumbnail((size, size), Image.LANCZOS)
+        for format, encoder, content_type in FORMATS:
+            handle, output = tempfile.mkstemp(dir=folder)
+            with os.fdopen(handle, 'wb') as file:
+                image.save(file, encoder, quality=quality, optimize=True)
+            variants.append(dict(rendition=name, format=format,
+                                 content_type=content_type, path=output,
+                                 width=image.width, height=image.height))
+    return variants
+
+
+def variant_key(key, rendition, format):
+    '''S3 key of a rendition derived from the original picture key'''
+    return '{}_{}.{}'.format(key.rsplit('.', 1)[0], rendition, format)
@@ -1,43 +1,20 @@
 # jwt.py
 '''JWT generation logic'''
 
-from flask import abort
 from flask_jwt_extended import (create_access_token,
                                 create_refresh_token)
-from .models import User
-import datetime
-from .hashing import verify_password
+from .identity import token_headers
 
 
-def user_gen_jwt(username, password='', refresh=False):
+def issue_tokens(username):
     '''
-    Main JWT dispatching function. Checks incoming username data and checks if 
-    user exists in Database.
+    Mint an access and refresh token pair for an already authenticated user
 
     Args:
-        username (str): Username string `email` that will be queried into DB
-        [password (str)]: Password string unhashed to output JWT with increased
-        security
-        refresh (bool): Whether return as refresh token or not
-
-    Raises:
-        TypeError,
-        Abort 401: Failed username query
+        username (str): Username string `email`, the token identity
 
     Returns:
-        access_token (str): JWT session key with 3600min life-span
-        [refresh_token (str)]: JWT refresh session key, returned only if
-        refresh==True
+        (access_token, refresh_token) tuple
     '''
-    aux = User.query.filter_by(username=username).first()
-    if aux and verify_password(aux.password, password):
-        if refresh:
-            refresh_token = create_refresh_token(identity=username)
-            return refresh_token
-        access_token = create_access_token(identity=username)
-        return access_token
-    elif aux and password == '':
-        access_token = create_access_token(identity=username)
-        return access_token
-    else:
-        abort(401)
+    return (create_access_token(identity=username, headers=token_headers()),
+            create_refresh_token(identity=username, headers=token_headers()))
@@ -0,0 +1,331 @@
+# metrics.py
+'''
+Application metrics in Prometheus text format.
+
+Request latency by blueprint and endpoint, SQL statements per request with
+their time, and outbound calls (SMTP, S3, OpenID provider) are recorded in
+a per-process `Registry`. With `METRICS_DIR` set every process writes its
+totals there at most every `METRICS_FLUSH_INTERVAL` seconds and `/metrics`
+sums the files of every process, past ones included, so counters survive
+worker restarts. Without it `/metrics` shows the serving process only.
+
+Requests sent with an `X-Profile` header equal to `METRICS_PROFILE_TOKEN`
+are sampled every `METRICS_PROFILE_INTERVAL` seconds. Collapsed stacks
+(flamegraph.pl input) are written to `METRICS_PROFILE_DIR`, the
+`X-Profile-File` response header names the file. Not available under
+gevent workers.
+'''
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from .budgets import budget_of
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    '''
+    Bucketed observations by label values. Every series is a list of
+    per-bucket counts, the last one +Inf, followed by the sum
+    '''
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = dict()
+
+    def observe(self, value, *labels):
+        counts = self.series.get(labels)
+        if counts is None:
+            counts = self.series[labels] = [0] * (len(self.buckets) + 1) + [0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+class Registry(object):
+    '''Metrics of this process, reset in forked children'''
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.directory = None
+        self.interval = 5
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.next_flush = 0
+        for metric in self.metrics.values():
+            metric.series = dict()
+
+    def configure(self, app):
+        self.directory = app.config['METRICS_DIR']
+        self.interval = app.config['METRICS_FLUSH_INTERVAL']
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def histogram(self, name, description, labels, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, description, labels, buckets)
+        self.metrics[name] = metric
+        return metric
+
+    def observe(self, metric, value, *labels):
+        '''Record a value, flushing to `METRICS_DIR` when due'''
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            metric.observe(value, *labels)
+        if self.directory and time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {name: [[list(labels), list(counts)]
+                           for labels, counts in metric.series.items()]
+                    for name, metric in self.metrics.items()}
+
+    def flush(self):
+        '''Write this process totals, replacing its previous file'''
+        self.next_flush = time.monotonic() + self.interval
+        path = os.path.join(self.directory, '{}-{}.json'.format(
+            self.pid, int(self.started * 1000)))
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        try:
+            with open(temporary, 'w') as file:
+                json.dump(self.snapshot(), file)
+            os.replace(temporary, path)
+        except OSError:
+            logger.exception('metrics flush failed')
+
+    def collect(self):
+        '''Totals of every process writing to `METRICS_DIR`'''
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        totals = dict()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for metric, series in snapshot.items():
+                merged = totals.setdefault(metric, dict())
+                for labels, counts in series:
+                    current = merged.get(tuple(labels))
+                    merged[tuple(labels)] = counts if current is None else [
+                        a + b for a, b in zip(current, counts)]
+        return {metric: [[list(labels), counts]
+                         for labels, counts in series.items()]
+                for metric, series in totals.items()}
+
+    def render(self):
+        '''Prometheus text exposition of `collect`'''
+        collected = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append('# HELP {} {}'.format(name, metric.description))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, counts in sorted(collected.get(name, ())):
+                pairs = ['{}="{}"'.format(label, _escape(value))
+                         for label, value in zip(metric.labels, labels)]
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}}} {}'.format(
+                        name, ','.join(pairs + ['le="{}"'.format(bound)]),
+                        cumulative))
+                labelset = '{' + ','.join(pairs) + '}' if pairs else ''
+                lines.append('{}_sum{} {}'.format(name, labelset, counts[-1]))
+                lines.append('{}_count{} {}'.format(name, labelset,
+                                                    cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+registry = Registry()
+request_seconds = registry.histogram(
+    'ikebana_request_seconds', 'Request latency, streamed bodies included',
+    ('blueprint', 'endpoint', 'method', 'status'))
+request_queries = registry.histogram(
+    'ikebana_request_queries', 'SQL statements per request',
+    ('endpoint',), COUNT_BUCKETS)
+request_query_seconds = registry.histogram(
+    'ikebana_request_query_seconds', 'SQL time per request', ('endpoint',))
+outbound_seconds = registry.histogram(
+    'ikebana_outbound_seconds', 'Calls to other services',
+    ('service', 'operation', 'outcome'))
+
+
+@contextmanager
+def timed(service, operation):
+    '''
+    Time an outbound call, exceptions count as `error` outcome
+
+    Args:
+        service (str): e.g. `smtp`, `s3`, `oidc`
+        operation (str): Call name
+    '''
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        registry.observe(outbound_seconds, time.perf_counter() - start,
+                         service, operation, outcome)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    '''
+    Start time on the execution context: after_cursor_execute does not fire
+    when the statement raises (e.g. the IntegrityError of a repeated like),
+    and a start left on the pooled connection would outlive the request
+    '''
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if has_request_context():
+        queries = g.get('metrics_queries')
+        if queries is not None:
+            queries[0] += 1
+            queries[1] += elapsed
+
+
+class Sampler(object):
+    '''Samples the stack of one thread from a background thread'''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = [0, 0.0]
+    config = current_app.config
+    token = config['METRICS_PROFILE_TOKEN']
+    '''Stacks are sampled per thread, greenlets share the worker's one'''
+    if (token and config['WORKER_MODE'] != 'gevent' and
+            request.headers.get('X-Profile') == token):
+        g.metrics_profile = (
+            os.path.join(config['METRICS_PROFILE_DIR'], '{}-{}.folded'.format(
+                int(time.time() * 1000), request.endpoint)),
+            Sampler(threading.get_ident(),
+                    config['METRICS_PROFILE_INTERVAL']).start())
+
+
+def _tag_response(response):
+    g.metrics_status = response.status_code
+    queries = g.get('metrics_queries')
+    if queries is not None and current_app.config['METRICS_QUERY_HEADER']:
+        '''Statements so far, streamed bodies run more after this'''
+        response.headers['X-Query-Count'] = str(queries[0])
+    if 'metrics_profile' in g:
+        response.headers['X-Profile-File'] = os.path.basename(
+            g.metrics_profile[0])
+    return response
+
+
+def _end_request(exception=None):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'unmatched'
+    count, query_time = g.pop('metrics_queries')
+    registry.observe(request_seconds, elapsed, request.blueprint or '',
+                     endpoint, request.method,
+                     str(g.pop('metrics_status', 500)))
+    registry.observe(request_queries, count, endpoint)
+    registry.observe(request_query_seconds, query_time, endpoint)
+    budget = budget_of(current_app.view_functions.get(request.endpoint),
+                       request.method)
+    if budget is not None and count > budget:
+        current_app.logger.warning('%s %s ran %d SQL statements, budget %d',
+                                   request.method, endpoint, count, budget)
+    elif count > current_app.config['METRICS_QUERY_WARN']:
+        current_app.logger.warning('%s ran %d SQL statements', endpoint,
+                                   count)
+    profile = g.pop('metrics_profile', None)
+    if profile is not None:
+        path, sampler = profile
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            for stack, samples in sampler.stop().items():
+                file.write('{} {}\n'.format(stack, samples))
+
+
+def export():
+    '''Prometheus scrape endpoint, keep it internal (see `webapp.conf`)'''
+    return current_app.response_class(
+        registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    '''
+    Install request hooks and the `/metrics` endpoint
+
+    Returns:
+        void
+    '''
+    registry.configure(app)
+    app.before_request(_start_request)
+    app.after_request(_tag_response)
+    app.teardown_request(_end_request)
+    app.add_url_rule('/metrics', 'metrics', export)
@@ -0,0 +1,285 @@
+# migrations.py
+'''
+Schema upgrades for databases created by older model versions.
+`db.create_all()` only creates missing tables, every step here handles what
+it can't: new columns and indexes on existing tables, data moves and
+backfills. Applied steps are recorded as `SchemaStep` rows and run once,
+they are also safe to repeat on databases upgraded before steps were
+recorded. Large backfills go in `MIGRATION_BATCH_SIZE` row batches, each
+committed on its own so the app keeps writing meanwhile. Every bound
+database is analyzed after steps run, so the planner knows the new indexes
+'''
+
+from flask import current_app
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+from datetime import datetime
+from app import db
+from . import search
+from .models import (Notification, OutboxEmail, PictureUpload, Project,
+                     ProjectLike, RevokedToken, SchemaStep, User)
+
+steps = []
+
+
+def step(function):
+    '''Register an upgrade step, steps run in declaration order'''
+    steps.append(function)
+    return function
+
+
+def _engine(model):
+    return db.session.get_bind(mapper=model.__mapper__)
+
+
+def has_column(model, column):
+    '''Check whether a live table already has a given column'''
+    columns = inspect(_engine(model)).get_columns(model.__table__.name)
+    return column in [col['name'] for col in columns]
+
+
+def add_column(model, column, ddl):
+    '''
+    Add a column to an existing table if missing
+
+    Args:
+        model (Model): Mapped class owning the table
+        column (str): Column name
+        ddl (str): Column type and constraints, e.g. `INTEGER DEFAULT 0`
+
+    Returns:
+        (boolean): True if the column was created
+    '''
+    if has_column(model, column):
+        return False
+    db.session.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        model.__table__.name, column, ddl)), mapper=model.__mapper__)
+    return True
+
+
+def create_indexes(model):
+    '''
+    Create the model indexes its live table lacks
+
+    Args:
+        model (Model): Mapped class owning the table
+
+    Returns:
+        (list): Names of the indexes created
+    '''
+    live = {index['name'] for index in
+            inspect(_engine(model)).get_indexes(model.__table__.name)}
+    created = []
+    for index in sorted(model.__table__.indexes, key=lambda i: i.name):
+        if index.name not in live:
+            db.session.execute(CreateIndex(index), mapper=model.__mapper__)
+            created.append(index.name)
+    return created
+
+
+def backfill(model, values, *criteria):
+    '''
+    Update matching rows a batch at a time, committing every batch
+
+    Args:
+        model (Model): Mapped class to update
+        values (dict): Column values to set
+        *criteria: Filter of the rows still to update, must stop matching
+            once updated
+
+    Returns:
+        updated (int): Amount of rows updated
+    '''
+    size = current_app.config['MIGRATION_BATCH_SIZE']
+    updated = 0
+    while True:
+        ids = [row.id for row in db.session.query(model.id).filter(
+            *criteria).limit(size)]
+        if not ids:
+            return updated
+        updated += model.query.filter(model.id.in_(ids)).update(
+            values, synchronize_session=False)
+        db.session.commit()
+
+
+def analyze():
+    '''
+    Refresh query planner statistics of every bound database
+
+    Returns:
+        void
+    '''
+    for bind in [None] + list(current_app.config['SQLALCHEMY_BINDS']):
+        db.session.execute(text('ANALYZE'), bind=db.get_engine(bind=bind))
+    db.session.commit()
+
+
+@step
+def content_bind():
+    '''
+    Move content tables out of users.db, where they lived before getting
+    the `content` bind key. Rows are copied by common columns, columns the
+    legacy table lacks take their model default
+    '''
+    source = _engine(User)
+    legacy = inspect(source)
+    tables = legacy.get_table_names()
+    for model in (Project, ProjectLike, Notification, PictureUpload):
+        table = model.__table__
+        if table.name not in tables:
+            continue
+        columns = [col['name'] for col in legacy.get_columns(table.name)
+                   if col['name'] in table.columns]
+        '''Explicit bind, the session routes these tables to content'''
+        rows = db.session.execute(select(
+            [table.c[column] for column in columns]), bind=source)
+        rows = [dict(zip(columns, row)) for row in rows]
+        if rows:
+            db.session.execute(table.insert().prefix_with('OR IGNORE'), rows,
+                               mapper=model.__mapper__)
+        db.session.execute(text('DROP TABLE {}'.format(table.name)),
+                           bind=source)
+    db.session.execute(text('DROP TABLE IF EXISTS project_search'),
+                       bind=source)
+
+
+@step
+def project_likes():
+    '''Move `Project.liked_by` json maps into `ProjectLike` rows'''
+    add_column(Project, 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    for proj in Project.query.filter(Project.liked_by.isnot(None)):
+        rows = [dict(project_id=proj.id, user_id=user_id,
+                     created_on=datetime.now())
+                for user_id in {int(key) for key in proj.liked_by}]
+        if rows:
+            db.session.execute(
+                ProjectLike.__table__.insert().prefix_with('OR IGNORE'), rows,
+                mapper=ProjectLike.__mapper__)
+    db.session.execute(text(
+        'UPDATE project SET like_count = (SELECT COUNT(*) FROM project_like '
+        'WHERE project_like.project_id = project.id)'),
+        mapper=Project.__mapper__)
+
+
+@step
+def project_picture_meta():
+    '''Column for picture renditions'''
+    add_column(Project, 'picture_meta', 'JSON')
+
+
+@step
+def user_aggregates():
+    '''
+    Denormalized author counters. Sources live on the content bind, so they
+    are aggregated there and written to users in bulk
+    '''
+    for column in ('project_count', 'total_orders', 'unread_notifications'):
+        add_column(User, column, 'INTEGER NOT NULL DEFAULT 0')
+    counters = dict()
+
+    def counter(user_id):
+        return counters.setdefault(user_id, dict(
+            id=user_id, project_count=0, total_orders=0,
+            unread_notifications=0))
+
+    for autor_id, count, orders in db.session.query(
+            Project.autor_id, func.count(Project.id),
+            func.coalesce(func.sum(Project.orders), 0)).group_by(
+            Project.autor_id):
+        counter(autor_id).update(project_count=count, total_orders=orders)
+    for user_id, unread in db.session.query(
+            Notification.user_id, func.count(Notification.id)).filter(
+            Notification.is_read.isnot(True)).group_by(Notification.user_id):
+        counter(user_id)['unread_notifications'] = unread
+    User.query.update({User.project_count: 0, User.total_orders: 0,
+                       User.unread_notifications: 0},
+                      synchronize_session=False)
+    db.session.bulk_update_mappings(User, list(counters.values()))
+
+
+@step
+def user_token_cutoff():
+    '''Per user token revocation cutoff'''
+    add_column(User, 'tokens_revoked_on', 'DATETIME')
+
+
+@step
+def secondary_indexes():
+    '''Indexes on filtered and ordered columns, tables predating them'''
+    for model in (User, Project, ProjectLike, Notification, PictureUpload,
+                  OutboxEmail, RevokedToken):
+        create_indexes(model)
+
+
+@step
+def notification_read_flags():
+    '''Explicit unread flags, rows from before `is_read` had a default'''
+    backfill(Notification, {Notification.is_read: False},
+             Notification.is_read.is_(None))
+
+
+@step
+def notification_unread_index():
+    '''Unread notifications of a user, read by `notifications.recount`'''
+    create_indexes(Notification)
+
+
+@step
+def project_search():
+    '''
+    Full-text search index of projects, filled from the existing ones. Was
+    created on first search, databases indexed that way are refilled
+    '''
+    search.create_index()
+
+
+@step
+def revoked_token_autoincrement():
+    '''
+    `RevokedToken` ids that are never reused, which other processes rely on
+    when they sync past the highest id they read. SQLite only sets
+    AUTOINCREMENT when creating a table, so the table is rebuilt
+    '''
+    table = RevokedToken.__table__
+    schema = db.session.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': table.name}, mapper=RevokedToken.__mapper__).scalar()
+    if 'AUTOINCREMENT' in (schema or '').upper():
+        return
+    legacy = table.name + '_legacy'
+    db.session.execute(text('ALTER TABLE {} RENAME TO {}'.format(
+        table.name, legacy)), mapper=RevokedToken.__mapper__)
+    '''Renamed along with the table, the new one creates them again'''
+    for index in table.indexes:
+        db.session.execute(text('DROP INDEX IF EXISTS {}'.format(
+            index.name)), mapper=RevokedToken.__mapper__)
+    db.session.execute(CreateTable(table), mapper=RevokedToken.__mapper__)
+    for index in table.indexes:
+        db.session.execute(CreateIndex(index), mapper=RevokedToken.__mapper__)
+    columns = [row[1] for row in db.session.execute(text(
+        'PRAGMA table_info({})'.format(legacy)),
+        mapper=RevokedToken.__mapper__) if row[1] in table.columns]
+    db.session.execute(text('INSERT INTO {0} ({2}) SELECT {2} FROM {1}'.format(
+        table.name, legacy, ', '.join(columns))),
+        mapper=RevokedToken.__mapper__)
+    db.session.execute(text('DROP TABLE {}'.format(legacy)),
+                       mapper=RevokedToken.__mapper__)
+
+
+def upgrade():
+    '''
+    Bring every bound database up to the current models
+
+    Returns:
+        void
+    '''
+    db.create_all()
+    applied = {row.name for row in SchemaStep.query}
+    pending = [function for function in steps
+               if function.__name__ not in applied]
+    for function in pending:
+        function()
+        db.session.add(SchemaStep(name=function.__name__))
+        db.session.commit()
+    if pending:
+        analyze()
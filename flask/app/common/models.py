@@ -26,7 +26,7 @@ class User(db.Model):
     fullname = db.Column(db.String(70), nullable=True)
     partner = db.Column(db.Boolean, default=False)
     partner_on = db.Column(db.DateTime, nullable=True)
-    created_on = db.Column(db.DateTime, default=datetime.now())
+    created_on = db.Column(db.DateTime, default=datetime.now)
     password = db.Column(db.String(30), nullable=False)
     confirmed = db.Column(db.Boolean, nullable=False, default=False)
     confirmed_on = db.Column(db.DateTime, nullable=True)
@@ -34,28 +34,22 @@ class User(db.Model):
     picture = db.Column(db.String(60), nullable=True,
                         default='https://ikebana-app-users.s3-sa-east-1.' +
                         'amazonaws.com/default/default_user.png')
+    '''Aggregates maintained by the endpoints changing their sources'''
+    project_count = db.Column(db.Integer, nullable=False, default=0,
+                              server_default='0')
+    total_orders = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0,
+                                     server_default='0')
+    '''Tokens issued before this are refused, set on password reset'''
+    tokens_revoked_on = db.Column(db.DateTime, nullable=True)
 
     @property
     def json_dump(self):
-        '''Dumps itself (object) as json serializable'''
-        total_orders = 0
-        '''Catching amount of orders'''
-        aux = [pj.orders for pj in self.projects]
-        total_orders = sum(aux)
-        '''Checking if is oAuth user'''
-        def _(): return True if self.oauth_id else False
-        return dict(id=self.id, username=self.username, email=self.email,
-                    tel=self.tel, fullname=self.fullname, isPartner=self.partner,
-                    partnerWhen=self.partner_on,
-                    createdOn=self.created_on,
-                    isConfirmed=self.confirmed, bio=self.bio,
-                    picture=self.picture, city=self.city,
-                    projects_amount=len(self.projects),
-                    total_orders=total_orders,
-                    location=self.location, work_address=self.work_address,
-                    personal_address=self.personal_address,
-                    notifications=[notif.json_dump for notif in
-                                   self.notifications], is_oauth=_())
+        '''Dumps itself (object) as json serializable. Notifications are
+        served paginated by `/notifications`'''
+        from .serializers import user
+        return user.dump(self)
 
     @property
     def status(self):
@@ -89,17 +83,29 @@ class Project(db.Model):
         return f'Project: {self.name}, autor: {self.autor.email}'
 
     __table_name__ = 'Project'
+    __bind_key__ = 'content'
+    '''Keyset pagination order, see `pagination.py`'''
+    __table_args__ = (
+        db.Index('ix_project_created_on_id', 'created_on', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True, nullable=False)
     autor_id = db.Column(db.Integer, db.ForeignKey('user.id'),
-                         nullable=False)
+                         nullable=False, index=True)
     autor = db.relationship('User', backref=db.backref('projects', lazy=True))
-    type = db.Column(db.String, nullable=False, default='arrangement')
-    created_on = db.Column(db.DateTime, default=datetime.now())
+    type = db.Column(db.String, nullable=False, default='arrangement',
+                     index=True)
+    created_on = db.Column(db.DateTime, default=datetime.now)
     picture = db.Column(MutableDict.as_mutable(db.JSON), nullable=True) 
+    '''Renditions of every picture, see `uploads.picture_meta`'''
+    picture_meta = db.Column(MutableDict.as_mutable(db.JSON), nullable=True,
+                             default=dict)
     video = db.Column(db.String, nullable=True)
+    '''Legacy likes map, superseded by `ProjectLike` and `like_count`'''
     liked_by = db.Column(MutableDict.as_mutable(db.JSON), nullable=True,
                          default=dict())
+    like_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
     description = db.Column(db.Text, nullable=False, default='')
     orders = db.Column(db.Integer, nullable=False, default=0)
     allow = db.Column(db.Boolean, nullable=False, default=False)
@@ -107,14 +113,62 @@ class Project(db.Model):
     @property
     def json_dump(self):
         '''Dumps itself (object) as json serializable'''
-        return dict(project_id=self.id, name=self.name, orders=self.orders, 
-                    type=self.type,
-                    autor=self.autor.username, likes=len(self.liked_by),
-                    description=self.description, pictures=self.picture,
-                    created_on=self.created_on, video=self.video,
-                    avaiable_on=self.autor.city, autor_pic=self.autor.picture,
-                    autor_fullname=self.autor.fullname, liked_by=self.liked_by,
-                    allow=self.allow)
+        from .serializers import project
+        return project.dump(self)
+
+    @property
+    def picture_sources(self):
+        '''Per picture thumbnail url and srcset strings by format'''
+        sources = dict()
+        for name, renditions in (self.picture_meta or {}).items():
+            entry = dict()
+            for format in ('webp', 'jpeg'):
+                entry[format] = ', '.join(
+                    '{} {}w'.format(rendition[format]['url'],
+                                    rendition['width'])
+                    for rendition in renditions.values())
+            if 'thumb' in renditions:
+                entry['thumb'] = renditions['thumb']['jpeg']['url']
+            sources[name] = entry
+        return sources
+
+
+class ProjectLike(db.Model):
+    '''Project like, one row per user and project'''
+
+    def __repr__(self):
+        return f'Like on project {self.project_id} by user {self.user_id}'
+
+    __table_name__ = 'ProjectLike'
+    __bind_key__ = 'content'
+    __table_args__ = (
+        db.UniqueConstraint('project_id', 'user_id', name='uq_project_like'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'),
+                           nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False,
+                        index=True)
+    created_on = db.Column(db.DateTime, default=datetime.now)
+
+    @staticmethod
+    def liked_among(user_id, project_ids):
+        '''
+        Filter the given projects down to the ones liked by a user
+
+        Args:
+            user_id (int): User id (primary key)
+            project_ids (list): Project ids to check
+
+        Returns:
+            (set): Liked project ids
+        '''
+        if user_id is None or not project_ids:
+            return set()
+        rows = db.session.query(ProjectLike.project_id).filter(
+            ProjectLike.user_id == user_id,
+            ProjectLike.project_id.in_(project_ids))
+        return {row.project_id for row in rows}
 
 
 class Notification(db.Model):
@@ -124,12 +178,18 @@ class Notification(db.Model):
         return f'Notification for user {self.user.email}, when: {self.sended_on}'
 
     __table_name__ = 'Notification'
+    __bind_key__ = 'content'
+    '''A user notifications, newest first, and their unread ones'''
+    __table_args__ = (
+        db.Index('ix_notification_user_sended', 'user_id', 'sended_on', 'id'),
+        db.Index('ix_notification_user_read', 'user_id', 'is_read'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('notifications',
                                                       lazy=True))
     sender = db.Column(db.String, nullable=False, default='Mensagem do Sistema')
-    sended_on = db.Column(db.DateTime, default=datetime.now())
+    sended_on = db.Column(db.DateTime, default=datetime.now)
     content = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Boolean, default=False)
 
@@ -140,6 +200,87 @@ class Notification(db.Model):
     @property
     def json_dump(self):
         '''Dumps itself as json serializable'''
-        return dict(user_id=self.user_id, user=self.user.email, id=self.id,
-                    sended_on=self.sended_on, content=self.content,
-                    is_read=self.is_read)
+        from .serializers import notification
+        return notification.dump(self)
+
+
+class OutboxEmail(db.Model):
+    '''Outgoing e-mail waiting for (or done with) delivery'''
+
+    def __repr__(self):
+        return f'E-mail to {self.recipient}, status: {self.status}'
+
+    __table_name__ = 'OutboxEmail'
+    __table_args__ = (
+        db.Index('ix_outbox_email_due', 'status', 'next_attempt_on'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String, nullable=False)
+    sender = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_on = db.Column(db.DateTime, nullable=False,
+                                default=datetime.now)
+    created_on = db.Column(db.DateTime, default=datetime.now)
+    sent_on = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    @property
+    def domain(self):
+        '''Recipient domain, unit of delivery rate limiting'''
+        return self.recipient.rsplit('@', 1)[-1].lower()
+
+
+class PictureUpload(db.Model):
+    '''Background picture upload, one row per file sent to S3'''
+
+    def __repr__(self):
+        return f'Upload {self.key}, status: {self.status}'
+
+    __table_name__ = 'PictureUpload'
+    __bind_key__ = 'content'
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, nullable=True, index=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    name = db.Column(db.String, nullable=True)
+    bucket = db.Column(db.String, nullable=False)
+    key = db.Column(db.String, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    error = db.Column(db.Text, nullable=True)
+    created_on = db.Column(db.DateTime, default=datetime.now)
+    updated_on = db.Column(db.DateTime, default=datetime.now,
+                           onupdate=datetime.now)
+
+    @property
+    def json_dump(self):
+        '''Dumps itself as json serializable'''
+        from .serializers import upload
+        return upload.dump(self)
+
+
+class RevokedToken(db.Model):
+    '''Revoked (or consumed single-use) JWT, kept until it expires'''
+
+    def __repr__(self):
+        return f'Revoked {self.token_type} token {self.jti}'
+
+    __table_name__ = 'RevokedToken'
+    '''Ids are never reused once pruned rows are gone, processes sync past
+    the highest id they have read'''
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), nullable=False, unique=True)
+    token_type = db.Column(db.String(10), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    expires_on = db.Column(db.DateTime, nullable=False, index=True)
+    revoked_on = db.Column(db.DateTime, default=datetime.now)
+
+
+class SchemaStep(db.Model):
+    '''Upgrade step applied to this deployment, see `migrations.py`'''
+
+    __table_name__ = 'SchemaStep'
+    name = db.Column(db.String, primary_key=True)
+    applied_on = db.Column(db.DateTime, default=datetime.now)
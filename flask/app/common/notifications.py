@@ -1,8 +1,27 @@
 #notifications.py
-'''Notification sender logic'''
-from .models import Notification
-from sqlalchemy.exc import IntegrityError
-from app import db
+'''
+Notification sender and stream logic.
+
+`NotificationBatch` is the unit of work: it collects notifications and order
+counts and writes them in one content.db transaction, one executemany per
+table, `Project.orders` bumped with atomic `column = column + n` updates.
+
+The user counters they change (`User.unread_notifications`, `total_orders`,
+`project_count`) live in users.db, a separate SQLite file committed on its own afterwards.
+The two commits are not atomic, so the counters are never incremented:
+`recount` sets them from the content rows, repairing any earlier drift. A
+failed or missed counter commit leaves them behind until the next recount
+of those users
+'''
+from flask import abort, current_app, json
+from .models import Notification, Project, User
+from sqlalchemy import bindparam, func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import selectinload
+from collections import Counter
+from app import db, events
+
+import time
 
 welcome='''
 Bem-vindo ao projeto Ikebana Sanguetsu. Este website é uma plataforma de
@@ -28,21 +47,16 @@ Mensagem do solicitador:
 Faça-o se puder
 '''
 
-def notify_user(user_id, content, *args):
-    '''Wrapper function to create Notification object and attempt to store in
-    DB
+def render(content, *args):
+    '''
+    Build a notification message
 
     Args:
-        user_id (int): User id (primary key)
-        content (str): Message text, pick from above
+        content (str): Message kind, pick from above
         *args: value string to be replaced on content message
-        response: placeholder for return message
 
-    Raises:
-        IntegrityError: Couldn't add notification object to database
-    
-    Return:
-        void
+    Returns:
+        response (str): Message text
     '''
     if 'request' in content:
         response = new_request
@@ -56,10 +70,219 @@ def notify_user(user_id, content, *args):
         response = turned_member
     elif 'welcome' in content:
         response = welcome
-    notif = Notification(user_id=user_id, content=response)
+    return response
+
+
+def _increment(model, column, amounts):
+    '''Atomically add {id: amount} to a counter column, one executemany'''
+    if not amounts:
+        return
+    table = model.__table__
+    db.session.execute(
+        table.update().where(table.c.id == bindparam('row_id')).values(
+            {column: table.c[column] + bindparam('amount')}),
+        [{'row_id': row_id, 'amount': amount}
+         for row_id, amount in sorted(amounts.items())],
+        mapper=model.__mapper__)
+
+
+def recount(unread=(), projects=()):
+    '''
+    Set users.db counters from the content.db rows they summarize, the
+    caller commits
+
+    Args:
+        unread (iterable): User ids to recount unread notifications of
+        projects (iterable): User ids to recount the projects and project
+            orders of
+
+    Returns:
+        void
+    '''
+    counters = dict()
+    if unread:
+        counts = dict.fromkeys(unread, 0)
+        counts.update(db.session.query(
+            Notification.user_id, func.count(Notification.id)).filter(
+            Notification.user_id.in_(counts),
+            Notification.is_read == False).group_by(Notification.user_id))
+        for user_id, count in counts.items():
+            counters.setdefault(user_id, dict(id=user_id)).update(
+                unread_notifications=count)
+    if projects:
+        totals = dict.fromkeys(projects, (0, 0))
+        rows = db.session.query(
+            Project.autor_id, func.count(Project.id),
+            func.coalesce(func.sum(Project.orders), 0)).filter(
+            Project.autor_id.in_(totals)).group_by(Project.autor_id)
+        totals.update((autor_id, (count, orders))
+                      for autor_id, count, orders in rows)
+        for user_id, (count, orders) in totals.items():
+            counters.setdefault(user_id, dict(id=user_id)).update(
+                project_count=count, total_orders=orders)
+    if counters:
+        '''One UPDATE per set of recounted columns'''
+        db.session.bulk_update_mappings(User, [
+            counters[user_id] for user_id in sorted(counters)])
+
+
+def commit_counters(unread=(), projects=()):
+    '''
+    Recount and commit users counters after their content rows committed.
+    A failure is logged, not raised: the content change already stands
+
+    Returns:
+        void
+    '''
     try:
-        db.session.add(notif)
-    except IntegrityError:
-        abort(500)
-    else:
+        recount(unread, projects)
         db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        current_app.logger.exception('user counters recount failed')
+
+
+class NotificationBatch(object):
+    '''
+    Notifications and order counts pending for a single transaction
+
+    Usage:
+        batch = NotificationBatch()
+        batch.notify(user_id, 'welcome')
+        batch.broadcast(follower_ids, 'project', proj_q.name)
+        batch.recount_projects(user_id)
+        batch.commit()
+    '''
+
+    def __init__(self):
+        self.notifications = []
+        self.unread = Counter()
+        self.orders = Counter()
+        self.autors = set()
+
+    def notify(self, user_id, content, *args):
+        '''Queue a notification to one user'''
+        self.broadcast([user_id], content, *args)
+
+    def broadcast(self, user_ids, content, *args):
+        '''Queue the same notification to many users, rendered once'''
+        response = render(content, *args)
+        for user_id in user_ids:
+            self.notifications.append(dict(user_id=user_id,
+                                           content=response))
+            self.unread[user_id] += 1
+
+    def count_order(self, project_id, autor_id):
+        '''Queue one more order of a project and its autor'''
+        self.orders[project_id] += 1
+        self.autors.add(autor_id)
+
+    def recount_projects(self, autor_id):
+        '''Recount an autor project counters along, e.g. after adding one'''
+        self.autors.add(autor_id)
+
+    def flush(self):
+        '''
+        Send the content rows queued to the session, the caller commits and
+        then recounts the user counters
+
+        Returns:
+            void
+        '''
+        if self.notifications:
+            db.session.bulk_insert_mappings(Notification, self.notifications)
+        _increment(Project, 'orders', self.orders)
+        self.__init__()
+
+    def commit(self):
+        '''
+        Flush and commit the content rows in one transaction, recount the
+        counters of their users, then wake the recipients notification
+        streams
+
+        Raises:
+            500: Couldn't store notifications
+        '''
+        recipients, autors = list(self.unread), list(self.autors)
+        try:
+            self.flush()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            abort(500)
+        commit_counters(unread=recipients, projects=autors)
+        events.publish(*recipients)
+
+
+def notify_user(user_id, content, *args):
+    '''Wrapper function to create Notification object and attempt to store in
+    DB
+
+    Args:
+        user_id (int): User id (primary key)
+        content (str): Message text, pick from above
+        *args: value string to be replaced on content message
+
+    Raises:
+        500: Couldn't add notification object to database
+
+    Return:
+        void
+    '''
+    batch = NotificationBatch()
+    batch.notify(user_id, content, *args)
+    batch.commit()
+
+
+def _event(notif):
+    '''Server-Sent Event of a notification'''
+    return 'id: {}\nevent: notification\ndata: {}\n\n'.format(
+        notif.id, json.dumps(notif.json_dump))
+
+
+def stream(app, user_id, last_id=None):
+    '''
+    Server-Sent Events of a user new notifications. Sleeps on the user
+    subscription between reads, no database connection is held meanwhile
+
+    Args:
+        app (Flask): Application, for config and database access
+        user_id (int): User primary key
+        last_id (int): Last notification id the client has seen, defaults
+            to the newest one, so only later notifications are sent
+
+    Returns:
+        (generator): Event stream chunks
+    '''
+    config = app.config
+    subscription = events.subscribe(user_id)
+    try:
+        if last_id is None:
+            with app.app_context():
+                last_id = db.session.query(func.max(Notification.id)).filter(
+                    Notification.user_id == user_id).scalar() or 0
+                db.session.remove()
+        yield 'retry: {}\n\n'.format(config['EVENTS_RETRY'])
+        written = time.monotonic()
+        while True:
+            with app.app_context():
+                batch = Notification.query.options(
+                    selectinload(Notification.user)).filter(
+                    Notification.user_id == user_id,
+                    Notification.id > last_id).order_by(
+                    Notification.id).limit(config['EVENTS_BATCH_SIZE']).all()
+                chunk = ''.join(_event(notif) for notif in batch)
+                db.session.remove()
+            if batch:
+                last_id = batch[-1].id
+                written = time.monotonic()
+                yield chunk
+                if len(batch) == config['EVENTS_BATCH_SIZE']:
+                    continue
+            elif time.monotonic() - written >= config['EVENTS_KEEPALIVE']:
+                '''Comment line, keeps proxies from closing the connection'''
+                written = time.monotonic()
+                yield ': keepalive\n\n'
+            subscription.wait(config['EVENTS_POLL_INTERVAL'])
+    finally:
+        subscription.close()
@@ -0,0 +1,207 @@
+# oidc.py
+'''
+OpenID Connect provider client (Google by default).
+
+The discovery document and JWKS are cached per process and revalidated with
+their ETag once `Cache-Control: max-age` (or `OIDC_CACHE_TTL`) runs out.
+Every call goes through one pooled keep-alive `requests.Session` with
+timeouts. ID tokens are checked locally against the provider keys, userinfo
+is only requested when the token lacks a claim we need.
+'''
+
+from flask import abort, current_app
+from jwt.algorithms import RSAAlgorithm
+from oauthlib.oauth2 import OAuth2Error, WebApplicationClient
+from requests.adapters import HTTPAdapter
+from .metrics import timed
+
+import os
+import re
+import json
+import jwt
+import time
+import threading
+import requests
+
+CLAIMS = ('sub', 'email', 'email_verified', 'picture', 'given_name')
+
+_sessions = dict()
+_documents = dict()
+_lock = threading.Lock()
+
+
+def session():
+    '''Pooled HTTP session of this process'''
+    with _lock:
+        http, pid = _sessions.get('session', (None, None))
+        if http is None or pid != os.getpid():
+            http = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=current_app.config['OIDC_POOL_SIZE'])
+            http.mount('https://', adapter)
+            http.mount('http://', adapter)
+            _sessions['session'] = (http, os.getpid())
+        return http
+
+
+def _max_age(response):
+    match = re.search(r'max-age=(\d+)',
+                      response.headers.get('Cache-Control', ''))
+    if match:
+        return int(match.group(1))
+    return current_app.config['OIDC_CACHE_TTL']
+
+
+def fetch_json(url, refresh=False):
+    '''
+    Cached GET of a provider json document
+
+    Args:
+        url (str): Document url
+        refresh (bool): Revalidate even if still fresh, e.g. unknown key id
+
+    Raises:
+        502: Provider unreachable or answered with an error
+
+    Returns:
+        (dict): Parsed document
+    '''
+    with _lock:
+        document = _documents.get(url)
+    if document and not refresh and document['expires'] > time.monotonic():
+        return document['body']
+    headers = dict()
+    if document and document['etag']:
+        headers['If-None-Match'] = document['etag']
+    try:
+        with timed('oidc', 'document'):
+            response = session().get(
+                url, headers=headers,
+                timeout=current_app.config['OIDC_TIMEOUT'])
+        if response.status_code != 304:
+            response.raise_for_status()
+            document = dict(body=response.json(),
+                            etag=response.headers.get('ETag'))
+    except (requests.RequestException, ValueError):
+        if document:
+            '''Provider hiccup, keep serving the last good copy'''
+            return document['body']
+        abort(502)
+    document['expires'] = time.monotonic() + _max_age(response)
+    with _lock:
+        _documents[url] = document
+    return document['body']
+
+
+def discovery():
+    '''Provider configuration document'''
+    return fetch_json(current_app.config['OIDC_DISCOVERY_URL'])
+
+
+def signing_key(kid):
+    '''
+    Public key of a provider key id, JWKS is refreshed once when the id is
+    unknown since providers rotate keys
+
+    Returns:
+        key (RSAPublicKey): None if the provider doesn't know the id
+    '''
+    for refresh in (False, True):
+        jwks = fetch_json(discovery()['jwks_uri'], refresh=refresh)
+        for jwk in jwks.get('keys', ()):
+            if jwk.get('kid') == kid:
+                return RSAAlgorithm.from_jwk(json.dumps(jwk))
+    return None
+
+
+def verify_id_token(id_token):
+    '''
+    Validate an ID token signature, audience, issuer and expiry
+
+    Args:
+        id_token (str): Encoded ID token from the token endpoint
+
+    Raises:
+        401: Invalid token
+
+    Returns:
+        claims (dict): Token claims
+    '''
+    config = current_app.config
+    try:
+        key = signing_key(jwt.get_unverified_header(id_token).get('kid'))
+        if key is None:
+            abort(401)
+        claims = jwt.decode(id_token, key, algorithms=['RS256'],
+                            audience=config['OIDC_CLIENT_ID'],
+                            leeway=config['OIDC_LEEWAY'])
+    except jwt.InvalidTokenError:
+        abort(401)
+    issuer = discovery()['issuer']
+    '''Google also issues tokens without the scheme'''
+    if claims.get('iss') not in (issuer, issuer.split('://')[-1]):
+        abort(401)
+    return claims
+
+
+def authorization_url(client, redirect_uri):
+    '''Provider approval url to send the user to'''
+    return client.prepare_request_uri(
+        discovery()['authorization_endpoint'], redirect_uri=redirect_uri,
+        scope=['openid', 'email', 'profile'])
+
+
+def exchange_code(code, authorization_response, redirect_uri):
+    '''
+    Trade an authorization code for the user claims
+
+    Args:
+        code (str): Authorization code from the callback query string
+        authorization_response (str): Full callback url
+        redirect_uri (str): Redirect uri sent on authorization
+
+    Raises:
+        401: Code refused or invalid ID token
+        502: Provider unreachable
+
+    Returns:
+        claims (dict): At least the `CLAIMS` the provider has for the user
+    '''
+    config = current_app.config
+    provider = discovery()
+    '''One client per exchange, oauthlib clients keep the token on self'''
+    client = WebApplicationClient(config['OIDC_CLIENT_ID'])
+    token_url, headers, body = client.prepare_token_request(
+        provider['token_endpoint'],
+        authorization_response=authorization_response,
+        redirect_url=redirect_uri, code=code)
+    try:
+        with timed('oidc', 'token'):
+            response = session().post(
+                token_url, headers=headers, data=body,
+                auth=(config['OIDC_CLIENT_ID'], config['OIDC_CLIENT_SECRET']),
+                timeout=config['OIDC_TIMEOUT'])
+    except requests.RequestException:
+        abort(502)
+    try:
+        token = client.parse_request_body_response(response.text)
+    except OAuth2Error:
+        abort(401)
+    claims = dict()
+    if token.get('id_token'):
+        claims = verify_id_token(token['id_token'])
+    if all(claim in claims for claim in CLAIMS):
+        return claims
+    uri, headers, body = client.add_token(provider['userinfo_endpoint'])
+    try:
+        with timed('oidc', 'userinfo'):
+            userinfo = session().get(uri, headers=headers, data=body,
+                                     timeout=config['OIDC_TIMEOUT'])
+        userinfo.raise_for_status()
+        userinfo = userinfo.json()
+    except (requests.RequestException, ValueError):
+        abort(502)
+    if claims and userinfo.get('sub') != claims['sub']:
+        abort(401)
+    return dict(userinfo, **claims)
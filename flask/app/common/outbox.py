@@ -0,0 +1,159 @@
+# outbox.py
+'''
+Background e-mail sender. Drains the `OutboxEmail` table over one reused
+SMTP connection, retrying failures with exponential backoff and holding
+back recipient domains that reached `MAIL_DOMAIN_RATE` sends per minute.
+Meant to run as a single process, see `mail_worker.py`
+'''
+
+from flask import current_app
+from flask_mail import Message
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from app import db, mail
+from .metrics import timed
+from .models import OutboxEmail
+
+import smtplib
+import time
+
+
+class DomainLimiter(object):
+    '''Sliding one minute window of sends per recipient domain'''
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.sent = defaultdict(deque)
+
+    def _window(self, domain, now):
+        window = self.sent[domain]
+        while window and window[0] <= now - 60:
+            window.popleft()
+        return window
+
+    def wait(self, domain):
+        '''Seconds until the domain accepts another message, 0 if now'''
+        now = time.monotonic()
+        window = self._window(domain, now)
+        if len(window) < self.per_minute:
+            return 0
+        return window[0] + 60 - now
+
+    def record(self, domain):
+        self.sent[domain].append(time.monotonic())
+
+
+class SMTPSession(object):
+    '''Persistent SMTP connection, opened on demand and closed when idle'''
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.connection = None
+        self.last_used = 0
+
+    def send(self, message, retry=True):
+        reused = self.connection is not None
+        if not reused:
+            connection = mail.connect()
+            connection.__enter__()
+            self.connection = connection
+        try:
+            self.connection.send(message)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            if not (reused and retry):
+                raise
+            '''Server dropped an idle connection, retry once on a new one'''
+            self.send(message, retry=False)
+        finally:
+            self.last_used = time.monotonic()
+
+    def close(self, idle_only=False):
+        if self.connection is None:
+            return
+        if idle_only and time.monotonic() - self.last_used < self.idle_timeout:
+            return
+        try:
+            self.connection.__exit__(None, None, None)
+        except smtplib.SMTPException:
+            pass
+        self.connection = None
+
+
+def due_batch(limit):
+    '''Pending messages whose next attempt is due, oldest first'''
+    return OutboxEmail.query.filter(
+        OutboxEmail.status == 'pending',
+        OutboxEmail.next_attempt_on <= datetime.now()
+    ).order_by(OutboxEmail.id).limit(limit).all()
+
+
+def deliver(batch, session, limiter):
+    '''
+    Try to send a batch of messages and record the outcome
+
+    Args:
+        batch (list): OutboxEmail objects
+        session (SMTPSession): Connection to send through
+        limiter (DomainLimiter): Per domain rate limiter
+
+    Returns:
+        sent (int): Amount of messages sent
+    '''
+    config = current_app.config
+    sent = 0
+    for email in batch:
+        wait = limiter.wait(email.domain)
+        if wait:
+            email.next_attempt_on = datetime.now() + timedelta(seconds=wait)
+            continue
+        message = Message(email.subject, sender=email.sender,
+                          recipients=[email.recipient], html=email.html)
+        try:
+            with timed('smtp', 'send'):
+                session.send(message)
+        except (smtplib.SMTPException, OSError) as error:
+            session.close()
+            email.attempts += 1
+            email.last_error = repr(error)
+            if email.attempts >= config['MAIL_MAX_ATTEMPTS']:
+                email.status = 'failed'
+            else:
+                backoff = config['MAIL_RETRY_BASE'] * 2 ** (email.attempts - 1)
+                email.next_attempt_on = (datetime.now() +
+                                         timedelta(seconds=backoff))
+        else:
+            limiter.record(email.domain)
+            email.status = 'sent'
+            email.sent_on = datetime.now()
+            sent += 1
+    db.session.commit()
+    return sent
+
+
+def run(app, once=False):
+    '''
+    Outbox worker loop
+
+    Args:
+        app (Flask): Application whose config and database to use
+        once (bool): Drain what is due and return, for scripts and debugging
+
+    Returns:
+        void
+    '''
+    config = app.config
+    session = SMTPSession(config['MAIL_IDLE_TIMEOUT'])
+    limiter = DomainLimiter(config['MAIL_DOMAIN_RATE'])
+    while True:
+        with app.app_context():
+            batch = due_batch(config['MAIL_BATCH_SIZE'])
+            if batch:
+                deliver(batch, session, limiter)
+            db.session.remove()
+        if once and not batch:
+            session.close()
+            return
+        if not batch:
+            session.close(idle_only=True)
+            time.sleep(config['MAIL_POLL_INTERVAL'])
@@ -0,0 +1,148 @@
+# pagination.py
+'''Keyset (seek) pagination helpers'''
+
+from flask import abort, current_app
+from sqlalchemy import and_, or_
+from datetime import datetime
+import base64
+import json
+
+
+def encode_cursor(created_on, id):
+    '''
+    Build an opaque cursor pointing right after the given row
+
+    Args:
+        created_on (datetime): Row `created_on` value
+        id (int): Row primary key
+
+    Returns:
+        cursor (str): Url-safe token to be sent back by the client
+    '''
+    raw = json.dumps([created_on.isoformat() if created_on else None, id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''
+    Parse a cursor generated by `encode_cursor`
+
+    Args:
+        cursor (str): Opaque cursor token
+
+    Raises:
+        400: Malformed cursor
+
+    Returns:
+        (created_on, id) tuple
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        created_on, id = json.loads(raw.decode('utf-8'))
+        if created_on is not None:
+            created_on = datetime.fromisoformat(created_on)
+        return created_on, int(id)
+    except (ValueError, TypeError):
+        abort(400)
+
+
+def page_limit(value):
+    '''
+    Sanitize `limit` query parameter against configured bounds
+
+    Args:
+        value (str): Raw `limit` argument, may be None
+
+    Raises:
+        400: Non numeric limit
+
+    Returns:
+        limit (int)
+    '''
+    if value is None:
+        return current_app.config['LIST_PAGE_SIZE']
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        abort(400)
+    return max(1, min(limit, current_app.config['LIST_MAX_PAGE_SIZE']))
+
+
+def keyset_query(query, model, cursor=None, limit=20, column=None):
+    '''
+    Query of one page ordered by newest first using (timestamp, id) as key.
+    It fetches one row past the page, telling whether another page follows
+
+    Args:
+        query (Query): Base query, filters and loader options already set
+        model (Model): Mapped class holding the timestamp and `id` columns
+        cursor (str): Cursor returned by a previous page, None for first page
+        limit (int): Page size
+        column (Column): Timestamp column, defaults to `model.created_on`
+
+    Returns:
+        (Query)
+    '''
+    column = model.created_on if column is None else column
+    if cursor:
+        created_on, id = decode_cursor(cursor)
+        if created_on is None:
+            query = query.filter(column.is_(None), model.id < id)
+        else:
+            query = query.filter(or_(
+                column < created_on,
+                and_(column == created_on, model.id < id),
+                column.is_(None)))
+    return query.order_by(column.desc(), model.id.desc()).limit(limit + 1)
+
+
+def keyset_page(query, model, cursor=None, limit=20, column=None):
+    '''
+    Fetch one page ordered by newest first using (timestamp, id) as key
+
+    Args:
+        query (Query): Base query, filters and loader options already set
+        model (Model): Mapped class holding the timestamp and `id` columns
+        cursor (str): Cursor returned by a previous page, None for first page
+        limit (int): Page size
+        column (Column): Timestamp column, defaults to `model.created_on`
+
+    Returns:
+        (rows, next_cursor) tuple, next_cursor is None on last page
+    '''
+    column = model.created_on if column is None else column
+    rows = keyset_query(query, model, cursor, limit, column).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], column.key),
+                                    rows[-1].id)
+    return rows, next_cursor
+
+
+class KeysetStream(object):
+    '''
+    One `keyset_page` page fetched `yield_per` batches at a time, for
+    streamed responses. `next_cursor` is set once iterated
+
+    Args:
+        batch (int): Rows per fetch, other args as `keyset_page`
+    '''
+
+    def __init__(self, query, model, cursor=None, limit=20, column=None,
+                 batch=100):
+        self.column = model.created_on if column is None else column
+        self.query = keyset_query(query, model, cursor, limit,
+                                  self.column).yield_per(batch)
+        self.limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for count, row in enumerate(self.query):
+            if count == self.limit:
+                self.next_cursor = encode_cursor(
+                    getattr(last, self.column.key), last.id)
+                break
+            last = row
+            yield row
@@ -0,0 +1,52 @@
+# pools.py
+'''
+Lazily created worker pools shared by background services.
+
+Pools are created on first use inside each process and recreated when the
+current pid differs from the creator's, so a pool built before uWSGI forks
+its workers is never reused by a child. Broken pools, e.g. a process pool
+which lost a worker, are replaced too.
+'''
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import threading
+
+_pools = dict()
+_lock = threading.Lock()
+
+
+def get_pool(name, max_workers, processes=False):
+    '''
+    Fetch a named executor, creating it for the current process if needed
+
+    Args:
+        name (str): Pool name, one pool per name and process
+        max_workers (int): Pool size, only used on creation
+        processes (bool): Process pool if True, thread pool otherwise
+
+    Returns:
+        (Executor)
+    '''
+    with _lock:
+        pool, pid = _pools.get(name, (None, None))
+        if (pool is None or pid != os.getpid() or
+                getattr(pool, '_broken', False)):
+            kind = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            pool = kind(max_workers=max_workers)
+            _pools[name] = (pool, os.getpid())
+        return pool
+
+
+def shutdown(wait=True):
+    '''
+    Stop every pool owned by the current process
+
+    Returns:
+        void
+    '''
+    with _lock:
+        for name, (pool, pid) in list(_pools.items()):
+            if pid == os.getpid():
+                pool.shutdown(wait=wait)
+            del _pools[name]
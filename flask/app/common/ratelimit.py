@@ -0,0 +1,211 @@
+# ratelimit.py
+'''
+Request rate limiting.
+
+Every request takes a token from the buckets of the rules covering its
+endpoint, `RATELIMIT_RULES` maps endpoints (`user_auths.login`) or whole
+blueprints (`user_auths`) to rules, endpoint rules replace blueprint ones.
+A rule `(requests, period, scope)` allows bursts of `requests` refilled
+over `period` seconds, counted per scope value:
+
+    ip      client address
+    email   `email` field of the json payload, skipped when missing
+    user    signature of the request token, client address without one.
+            Tokens aren't verified here, forged ones get a fresh bucket
+            but are refused by the endpoint itself right after
+
+Over the limit requests are answered with 429 and `Retry-After`. Buckets
+live in the backend picked by `RATELIMIT_BACKEND`, like `cache.py`.
+'''
+
+from flask import abort, jsonify, request
+from collections import OrderedDict
+from .cache import uwsgi_caches
+
+import math
+import struct
+import threading
+import time
+
+_state = struct.Struct('dd')
+
+
+def _take(state, capacity, rate, now):
+    '''
+    Refill a bucket and take one token from it
+
+    Args:
+        state (tuple): Stored (tokens, timestamp), None for a full bucket
+        capacity (float): Bucket size
+        rate (float): Tokens refilled per second
+        now (float): Epoch seconds
+
+    Returns:
+        (tuple): New (tokens, timestamp) and seconds to wait, 0 if allowed
+    '''
+    tokens, stamp = state or (capacity, now)
+    tokens = min(capacity, tokens + max(0, now - stamp) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBuckets(object):
+    '''Per-process buckets, limits are multiplied by the process count'''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            state, wait = _take(self.buckets.pop(key, None), capacity, rate,
+                                now)
+            self.buckets[key] = state
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class UwsgiBuckets(object):
+    '''uWSGI cache2 buckets shared by every worker of the instance'''
+
+    def __init__(self, name):
+        self.uwsgi = uwsgi_caches(name)
+        self.name = name
+
+    def take(self, key, capacity, rate, now):
+        self.uwsgi.lock()
+        try:
+            value = self.uwsgi.cache_get(key, self.name)
+            state, wait = _take(value and _state.unpack(value), capacity,
+                                rate, now)
+            '''Dropped once refilled, a missing bucket is a full one'''
+            self.uwsgi.cache_update(key, _state.pack(*state),
+                                    math.ceil(capacity / rate), self.name)
+        finally:
+            self.uwsgi.unlock()
+        return wait
+
+
+class RedisBuckets(object):
+    '''Redis buckets, shared by every host pointed at the same server'''
+
+    script = '''
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local tokens = tonumber(state[1]) or capacity
+        local stamp = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - stamp) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return tostring(wait)
+    '''
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.take_script = self.redis.register_script(self.script)
+
+    def take(self, key, capacity, rate, now):
+        return float(self.take_script(
+            keys=[key], args=[capacity, rate, now,
+                              math.ceil(capacity / rate)]))
+
+
+class Limiter(object):
+    '''
+    Rate limiting extension, backend picked from `RATELIMIT_BACKEND`
+    config: `memory` (default), `uwsgi` or `redis`
+    '''
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.rules = dict()
+        self.resolved = dict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config.get('RATELIMIT_BACKEND', 'memory')
+        if kind == 'uwsgi':
+            try:
+                self.backend = UwsgiBuckets(app.config['RATELIMIT_UWSGI_NAME'])
+            except ImportError:
+                app.logger.warning('uwsgi cache unavailable, rate limits '
+                                   'are per process')
+                kind = 'memory'
+        elif kind == 'redis':
+            self.backend = RedisBuckets(app.config['RATELIMIT_REDIS_URL'])
+        if kind == 'memory':
+            self.backend = MemoryBuckets(app.config['RATELIMIT_MAX_ENTRIES'])
+        self.rules = {
+            name: [(float(requests), requests / period, scope)
+                   for requests, period, scope in rules]
+            for name, rules in app.config['RATELIMIT_RULES'].items()}
+        self.resolved = dict()
+        self.header_name = app.config['JWT_HEADER_NAME']
+        self.query_name = app.config['JWT_QUERY_STRING_NAME']
+        if app.config['RATELIMIT_ENABLED']:
+            app.before_request(self.check)
+        app.extensions['limiter'] = self
+
+    def rules_for(self, endpoint):
+        '''Rule owner name and rules of an endpoint, memoized'''
+        resolved = self.resolved.get(endpoint)
+        if resolved is None:
+            owner = endpoint if endpoint in self.rules else (
+                endpoint or '').partition('.')[0]
+            resolved = (owner, self.rules.get(owner, ()))
+            self.resolved[endpoint] = resolved
+        return resolved
+
+    def identify(self, scope):
+        '''Value a scope counts requests by, None to skip the rule'''
+        if scope == 'email':
+            payload = request.get_json(silent=True)
+            email = isinstance(payload, dict) and payload.get('email')
+            return email.lower()[:96] if isinstance(email, str) else None
+        if scope == 'user':
+            token = (request.headers.get(self.header_name) or
+                     request.args.get(self.query_name))
+            if token:
+                return 'token:' + token[-43:]
+        return 'ip:' + str(request.remote_addr)
+
+    def check(self):
+        '''
+        Take a token from every bucket of the request endpoint
+
+        Raises:
+            429: Over the limit of any bucket
+
+        Returns:
+            void
+        '''
+        if request.method == 'OPTIONS':
+            return
+        owner, rules = self.rules_for(request.endpoint)
+        wait = 0
+        now = time.time()
+        for index, (capacity, rate, scope) in enumerate(rules):
+            value = self.identify(scope)
+            if value is None:
+                continue
+            wait = max(wait, self.backend.take(
+                'rl:{}:{}:{}'.format(owner, index, value), capacity, rate,
+                now))
+        if wait:
+            response = jsonify({'error': 'too many requests'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            abort(response)
@@ -0,0 +1,300 @@
+# revocation.py
+'''
+JWT revocation.
+
+Revoked token ids (`jti`) are stored in `RevokedToken` until the token would
+have expired anyway. Every process mirrors the table in a Bloom filter,
+which clears almost every token with a few bit tests, and a set removing
+its false positives, so the hot path never touches the database. Processes
+catch up on new rows past their watermark when the `revocations` cache
+version moves, or every `REVOCATION_SYNC_INTERVAL` seconds with per-process
+cache backends.
+
+Password resets revoke every token of a user at once through
+`User.tokens_revoked_on`. Verification and recovery links are single-use
+tokens, consumed on first use. Their `purpose` claim is refused by every
+view but the ones declaring it with `link_token`.
+'''
+
+from flask import abort, current_app, jsonify, request
+from flask_jwt_extended import (create_access_token, get_raw_jwt,
+                                get_jwt_claims)
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from datetime import datetime, timedelta
+from app import cache, db, jwt
+from .identity import snapshot, token_headers, user_claims
+from .models import RevokedToken
+from .services import in_workers
+
+import hashlib
+import threading
+import time
+
+
+class BloomFilter(object):
+    '''Fixed size Bloom filter of strings'''
+
+    def __init__(self, bits, hashes):
+        self.size = bits
+        self.hashes = hashes
+        self.bits = bytearray((bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:16], 'little') | 1
+        for index in range(self.hashes):
+            yield (first + index * second) % self.size
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class Denylist(object):
+    '''Per-process mirror of the `RevokedToken` table'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.jtis = set()
+        self.watermark = 0
+        self.version = None
+        self.next_sync = 0
+        self.next_rebuild = 0
+
+    def _rebuild(self, config):
+        '''Reload unexpired rows, dropping expired ones from memory'''
+        self.bloom = BloomFilter(config['REVOCATION_BLOOM_BITS'],
+                                 config['REVOCATION_BLOOM_HASHES'])
+        self.jtis = set()
+        self.watermark = 0
+        self._load(RevokedToken.expires_on > datetime.now())
+        self.next_rebuild = (time.monotonic() +
+                             config['REVOCATION_PRUNE_INTERVAL'])
+
+    def _load(self, *criteria):
+        for row_id, jti in db.session.query(
+                RevokedToken.id, RevokedToken.jti).filter(
+                RevokedToken.id > self.watermark, *criteria).order_by(
+                RevokedToken.id):
+            self.add(jti)
+            self.watermark = row_id
+
+    def add(self, jti):
+        self.bloom.add(jti)
+        self.jtis.add(jti)
+
+    def sync(self):
+        '''Catch up with rows revoked by other processes'''
+        config = current_app.config
+        now = time.monotonic()
+        version = cache.backend.version('revocations')
+        if (self.bloom is not None and version == self.version and
+                now < self.next_sync):
+            return
+        with self.lock:
+            if self.bloom is None or now >= self.next_rebuild:
+                self._rebuild(config)
+            else:
+                self._load()
+            self.version = version
+            self.next_sync = now + config['REVOCATION_SYNC_INTERVAL']
+
+    def __contains__(self, jti):
+        self.sync()
+        return jti in self.bloom and jti in self.jtis
+
+
+denylist = Denylist()
+
+
+def _record(decoded_token):
+    '''Add the revoked token row to the session'''
+    claims = decoded_token.get(current_app.config['JWT_USER_CLAIMS'], {})
+    db.session.add(RevokedToken(
+        jti=decoded_token['jti'], token_type=decoded_token['type'],
+        user_id=claims.get('id'),
+        expires_on=datetime.fromtimestamp(decoded_token['exp'])))
+
+
+def _announce(jti):
+    '''Publish a committed revocation to this and the other processes'''
+    with denylist.lock:
+        if denylist.bloom is not None:
+            denylist.add(jti)
+    cache.backend.bump('revocations')
+
+
+def revoke(decoded_token):
+    '''
+    Revoke a decoded token
+
+    Args:
+        decoded_token (dict): Raw token claims
+
+    Raises:
+        IntegrityError: Token already revoked
+
+    Returns:
+        void
+    '''
+    _record(decoded_token)
+    db.session.commit()
+    _announce(decoded_token['jti'])
+
+
+def revoke_user_tokens(user):
+    '''
+    Refuse every token issued to a user so far. The caller commits, then
+    bumps `autor` so snapshots are reloaded from the committed row, e.g.
+    `cache.bump('autor', user.id)`. Bumping first lets a concurrent request
+    cache the old cutoff under the new version
+
+    Args:
+        user (User): User row
+
+    Returns:
+        void
+    '''
+    user.tokens_revoked_on = datetime.now()
+
+
+def link_token(purpose):
+    '''
+    Let a view accept the link tokens of a purpose, right under its route
+    decorator
+
+    Args:
+        purpose (str): `verify` or `recover`
+
+    Returns:
+        decorator
+    '''
+    def decorator(view):
+        view.link_purpose = purpose
+        return view
+    return decorator
+
+
+@jwt.claims_verification_loader
+def verify_purpose(user_claims):
+    '''Link tokens only open the view consuming them, not a login'''
+    purpose = user_claims.get('purpose')
+    if purpose is None:
+        return True
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'link_purpose', None) == purpose
+
+
+@jwt.claims_verification_failed_loader
+def purpose_refused():
+    return jsonify({'msg': 'Link token not valid here'}), 401
+
+
+def issue_link_token(username, purpose):
+    '''
+    Single-use access token for e-mailed links
+
+    Args:
+        username (str): Token identity
+        purpose (str): `verify` or `recover`, see `link_token`
+
+    Returns:
+        access_token (str)
+    '''
+    return create_access_token(
+        identity=username, user_claims=dict(user_claims(username),
+                                            purpose=purpose),
+        expires_delta=timedelta(
+            seconds=current_app.config['LINK_TOKEN_EXPIRES']),
+        headers=token_headers())
+
+
+def consume(purpose):
+    '''
+    Use up the single-use token of the current request. The token is only
+    spent once the action it authorizes commits with `commit_consumed`
+
+    Args:
+        purpose (str): Purpose the token must have been issued for
+
+    Raises:
+        401: Token of another purpose
+
+    Returns:
+        void
+    '''
+    if get_jwt_claims().get('purpose') != purpose:
+        abort(401)
+    _record(get_raw_jwt())
+
+
+def commit_consumed():
+    '''
+    Commit the action of a single-use token together with its revocation
+
+    Raises:
+        401: Token consumed concurrently
+
+    Returns:
+        void
+    '''
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(401)
+    _announce(get_raw_jwt()['jti'])
+
+
+def prune():
+    '''
+    Delete rows of tokens past their expiry
+
+    Returns:
+        removed (int): Amount of rows deleted
+    '''
+    removed = RevokedToken.query.filter(
+        RevokedToken.expires_on <= datetime.now()).delete(
+        synchronize_session=False)
+    db.session.commit()
+    return removed
+
+
+@jwt.token_in_blacklist_loader
+def is_revoked(decoded_token):
+    '''Denylisted token, or issued before its user revocation cutoff'''
+    if decoded_token['jti'] in denylist:
+        return True
+    claims = decoded_token.get(current_app.config['JWT_USER_CLAIMS'], {})
+    user = snapshot(decoded_token[current_app.config['JWT_IDENTITY_CLAIM']],
+                    claims.get('id'))
+    return user is None or decoded_token['iat'] < user.tokens_valid_after
+
+
+def init_app(app):
+    '''
+    Prune expired rows from a daemon thread. Every worker runs one, the
+    delete is idempotent and cheap next to keeping a single pruner alive.
+    Threads don't survive a fork, a preloading uWSGI master starts none
+
+    Returns:
+        void
+    '''
+    interval = app.config['REVOCATION_PRUNE_INTERVAL']
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    prune()
+                except SQLAlchemyError:
+                    app.logger.exception('revoked token pruning failed')
+                db.session.remove()
+    in_workers(lambda: threading.Thread(target=loop, daemon=True).start())
@@ -0,0 +1,162 @@
+# search.py
+'''
+Project full-text search index, backed by an SQLite FTS5 virtual table.
+The table is created by the `project_search` migration step, helpers here
+run inside the caller transaction and never commit
+'''
+
+from sqlalchemy import text
+from sqlalchemy.orm import selectinload
+from app import db
+from .models import Project
+import re
+
+INDEX = 'project_search'
+
+'''Diacritics folded by the tokenizer so "cerâmica" matches "ceramica",
+prefix indexes keep short prefix queries from scanning the whole vocabulary'''
+CREATE_INDEX = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(
+    name, description, type, autor_fullname,
+    tokenize = "unicode61 remove_diacritics 2",
+    prefix = '2 3'
+)
+'''.format(INDEX)
+
+'''bm25 column weights: name, description, type, autor_fullname'''
+RANK = 'bm25({}, 10.0, 2.0, 1.0, 4.0)'.format(INDEX)
+
+
+def _execute(statement, params=None):
+    '''Run raw SQL against the database holding the `Project` table'''
+    return db.session.execute(text(statement), params or {},
+                              mapper=Project.__mapper__)
+
+
+def create_index():
+    '''
+    Create the search index if missing and fill it from existing projects.
+    Caller commits
+
+    Returns:
+        void
+    '''
+    _execute(CREATE_INDEX)
+    rebuild_index()
+
+
+def rebuild_index():
+    '''
+    Drop every index entry and reindex all projects. Caller commits
+
+    Returns:
+        void
+    '''
+    _execute('DELETE FROM {}'.format(INDEX))
+    projects = Project.query.options(selectinload(Project.autor)).all()
+    if projects:
+        _insert(projects)
+
+
+def _insert(projects):
+    '''Add index entries, one executemany for every given project'''
+    _execute(
+        'INSERT INTO {} (rowid, name, description, type, autor_fullname) '
+        'VALUES (:id, :name, :description, :type, :autor_fullname)'.format(INDEX),
+        [{'id': project.id, 'name': project.name,
+          'description': project.description or '',
+          'type': project.type or '',
+          'autor_fullname': project.autor.fullname or ''}
+         for project in projects])
+
+
+def index_project(project):
+    '''
+    Insert or refresh a project entry. Runs inside the caller transaction
+
+    Args:
+        project (Project): Flushed project object (must have an id)
+
+    Returns:
+        void
+    '''
+    remove_project(project.id)
+    _insert([project])
+
+
+def remove_project(project_id):
+    '''
+    Drop a project entry. Runs inside the caller transaction
+
+    Args:
+        project_id (int): Project primary key
+
+    Returns:
+        void
+    '''
+    _execute('DELETE FROM {} WHERE rowid = :id'.format(INDEX),
+             {'id': project_id})
+
+
+def reindex_autor(user):
+    '''
+    Refresh every project entry of an author, e.g. after a fullname change
+
+    Args:
+        user (User): Project author
+
+    Returns:
+        void
+    '''
+    projects = user.projects
+    if not projects:
+        return
+    '''One executemany each way, not two statements per project'''
+    _execute('DELETE FROM {} WHERE rowid = :id'.format(INDEX),
+             [{'id': project.id} for project in projects])
+    _insert(projects)
+
+
+def match_expression(string):
+    '''
+    Turn free user input into an FTS5 query: every word is a quoted prefix
+    term, all of them required
+
+    Args:
+        string (str): Raw search string
+
+    Returns:
+        expression (str): FTS5 MATCH expression, empty if nothing searchable
+    '''
+    terms = re.findall(r'\w+', string.lower())
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+
+def search_projects(string, page=1, limit=20, options=None):
+    '''
+    Ranked project search
+
+    Args:
+        string (str): Raw search string
+        page (int): 1-based page number
+        limit (int): Page size
+        options (list): Query options of the project load, defaults to
+            loading authors along
+
+    Returns:
+        (projects, has_more) tuple, projects ordered by relevance
+    '''
+    expression = match_expression(string)
+    if not expression:
+        return [], False
+    rows = _execute(
+        'SELECT rowid FROM {} WHERE {} MATCH :expression '
+        'ORDER BY {} LIMIT :limit OFFSET :offset'.format(INDEX, INDEX, RANK),
+        {'expression': expression, 'limit': limit + 1,
+         'offset': (page - 1) * limit}).fetchall()
+    ids = [row[0] for row in rows[:limit]]
+    if options is None:
+        options = [selectinload(Project.autor)]
+    found = {proj.id: proj for proj in Project.query.options(
+        *options).filter(Project.id.in_(ids))}
+    return [found[id] for id in ids if id in found], len(rows) > limit
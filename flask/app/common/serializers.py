@@ -0,0 +1,314 @@
+# serializers.py
+'''
+Response serialization.
+
+Every model has one `Serializer` listing its response fields. For each
+requested fieldset it is compiled once into a list of getters, so dumping a
+row is a dict comprehension with no per-field dispatch. Datetimes are
+formatted as HTTP dates before reaching the encoder, the same way Flask's
+encoder did. Sparse fieldsets come from the `fields` query string
+(`?fields=name,pictures`), and `load_options` narrows the SQL to the columns
+and relationships they need.
+
+`JSON_ENCODER` picks the encoder: `json` (stdlib, default), `orjson` or
+`msgspec`. It falls back to `json` when the package is missing.
+'''
+
+from flask import abort, current_app, request, stream_with_context
+from sqlalchemy import DateTime, inspect
+from sqlalchemy.orm import load_only, selectinload
+from collections import OrderedDict
+from datetime import timezone
+from operator import attrgetter
+from .models import Notification, PictureUpload, Project, User
+
+import json
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+           'Sep', 'Oct', 'Nov', 'Dec')
+_encoders = dict()
+
+
+def http_date(value):
+    '''
+    RFC 1123 date, naive datetimes are taken as UTC like Flask's encoder
+
+    Args:
+        value (datetime): May be None
+
+    Returns:
+        (str): e.g. `Wed, 21 Oct 2015 07:28:00 GMT`, None for None
+    '''
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return '{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT'.format(
+        _DAYS[value.weekday()], value.day, _MONTHS[value.month], value.year,
+        value.hour, value.minute, value.second)
+
+
+class Computed(object):
+    '''Field computed from the object, loading the given columns'''
+
+    def __init__(self, function, *columns):
+        self.function = function
+        self.columns = columns
+
+
+class Serializer(object):
+    '''
+    Field list of a model
+
+    Args:
+        model (Model): Mapped class
+        fields (list): (name, source) pairs in output order. Sources are
+            attribute names, `relationship.attribute` paths or `Computed`
+    '''
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = OrderedDict()
+        self.compiled = dict()
+        for name, source in fields:
+            if isinstance(source, Computed):
+                self.fields[name] = (source.function, source.columns, ())
+                continue
+            relation, _, attribute = source.rpartition('.')
+            getter = attrgetter(source)
+            target = self.model
+            if relation:
+                target = inspect(self.model).relationships[
+                    relation].mapper.class_
+            if isinstance(getattr(target, attribute).type, DateTime):
+                getter = (lambda get: lambda obj: http_date(get(obj)))(getter)
+            if relation:
+                self.fields[name] = (getter, (), ((relation, attribute),))
+            else:
+                self.fields[name] = (getter, (attribute,), ())
+
+    def compile(self, fields=None):
+        '''(name, getter) pairs of a fieldset, all fields when None'''
+        compiled = self.compiled.get(fields)
+        if compiled is None:
+            names = self.fields if fields is None else fields
+            compiled = tuple((name, self.fields[name][0]) for name in names)
+            if len(self.compiled) < 256:
+                self.compiled[fields] = compiled
+        return compiled
+
+    def dump(self, obj, fields=None):
+        '''Json serializable dict of an object'''
+        return {name: get(obj) for name, get in self.compile(fields)}
+
+    def dump_many(self, objs, fields=None):
+        '''Dump objects one at a time, as they are iterated'''
+        getters = self.compile(fields)
+        for obj in objs:
+            yield {name: get(obj) for name, get in getters}
+
+    def load_options(self, fields=None, *extra):
+        '''
+        Query options loading only what a fieldset reads
+
+        Args:
+            fields (tuple): Requested fields, all when None
+            *extra: Attribute names needed besides, e.g. ordering columns
+
+        Returns:
+            (list): `load_only` and `selectinload` options
+        '''
+        mapper = inspect(self.model)
+        columns = set(extra)
+        relations = dict()
+        for name in self.fields if fields is None else fields:
+            _, needed, related = self.fields[name]
+            columns.update(needed)
+            for relation, attribute in related:
+                relations.setdefault(relation, set()).add(attribute)
+        options = []
+        for relation, attributes in relations.items():
+            columns.update(column.key for column in
+                           mapper.relationships[relation].local_columns)
+            options.append(selectinload(getattr(self.model, relation))
+                           .load_only(*attributes))
+        return [load_only(*columns)] + options
+
+
+def requested_fields(serializer):
+    '''
+    Sparse fieldset from the `fields` query string
+
+    Args:
+        serializer (Serializer): Serializer the fields belong to
+
+    Raises:
+        400: Unknown field
+
+    Returns:
+        (tuple): Field names, None for every field
+    '''
+    value = request.args.get('fields')
+    if not value:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    if not names or not names.issubset(serializer.fields):
+        abort(400)
+    '''Declaration order, so each fieldset compiles once'''
+    return tuple(name for name in serializer.fields if name in names)
+
+
+def _encoder(app):
+    name = app.config['JSON_ENCODER']
+    encode = _encoders.get(name)
+    if encode is None:
+        try:
+            if name == 'orjson':
+                import orjson
+                encode = orjson.dumps
+            elif name == 'msgspec':
+                import msgspec
+                encode = msgspec.json.Encoder().encode
+        except ImportError:
+            app.logger.warning('%s unavailable, using json', name)
+        if encode is None:
+            encode = json.JSONEncoder(
+                separators=(',', ':'),
+                ensure_ascii=app.config['JSON_AS_ASCII']).encode
+        _encoders[name] = encode
+    return encode
+
+
+def _bytes_encoder(app):
+    encode = _encoder(app)
+
+    def encode_bytes(payload):
+        value = encode(payload)
+        return value if isinstance(value, bytes) else value.encode('utf-8')
+    return encode_bytes
+
+
+def dumps(payload):
+    '''
+    Encode json serializable primitives with the configured encoder
+
+    Returns:
+        (str or bytes)
+    '''
+    return _encoder(current_app)(payload)
+
+
+def respond(payload, status=200):
+    '''
+    Json response, replaces `jsonify` for serialized payloads
+
+    Args:
+        payload: Primitives only, datetimes already formatted
+        status (int): Response status code
+
+    Returns:
+        Response
+    '''
+    return current_app.response_class(
+        dumps(payload), status=status,
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def stream(items, key=None, trailer=None):
+    '''
+    Json response written as items are produced, sent with chunked
+    transfer every `JSON_STREAM_BUFFER` bytes. Memory stays bounded by the
+    buffer plus whatever batch `items` holds, no matter the result size
+
+    Args:
+        items (iterable): Json serializable array items
+        key (str): Wraps the array in an object under this key
+        trailer (function): Called once items are exhausted, returns more
+            keys of the wrapping object, e.g. the next page cursor
+
+    Returns:
+        Response
+    '''
+    encode = _bytes_encoder(current_app)
+    size = current_app.config['JSON_STREAM_BUFFER']
+
+    def generate():
+        buffer = bytearray(b'{' + encode(key) + b':[' if key else b'[')
+        separator = b''
+        for item in items:
+            buffer += separator
+            buffer += encode(item)
+            separator = b','
+            if len(buffer) >= size:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b']'
+        if key:
+            for name, value in (trailer() if trailer else {}).items():
+                buffer += b',' + encode(name) + b':' + encode(value)
+            buffer += b'}'
+        yield bytes(buffer)
+    return current_app.response_class(
+        stream_with_context(generate()),
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+project = Serializer(Project, [
+    ('project_id', 'id'),
+    ('name', 'name'),
+    ('orders', 'orders'),
+    ('type', 'type'),
+    ('autor', 'autor.username'),
+    ('likes', 'like_count'),
+    ('description', 'description'),
+    ('pictures', 'picture'),
+    ('picture_sources', Computed(attrgetter('picture_sources'),
+                                 'picture_meta')),
+    ('created_on', 'created_on'),
+    ('video', 'video'),
+    ('avaiable_on', 'autor.city'),
+    ('autor_pic', 'autor.picture'),
+    ('autor_fullname', 'autor.fullname'),
+    ('liked_by_me', Computed(lambda proj: False)),
+    ('allow', 'allow'),
+])
+
+user = Serializer(User, [
+    ('id', 'id'),
+    ('username', 'username'),
+    ('email', 'email'),
+    ('tel', 'tel'),
+    ('fullname', 'fullname'),
+    ('isPartner', 'partner'),
+    ('partnerWhen', 'partner_on'),
+    ('createdOn', 'created_on'),
+    ('isConfirmed', 'confirmed'),
+    ('bio', 'bio'),
+    ('picture', 'picture'),
+    ('city', 'city'),
+    ('projects_amount', 'project_count'),
+    ('total_orders', 'total_orders'),
+    ('unread_notifications', 'unread_notifications'),
+    ('location', 'location'),
+    ('work_address', 'work_address'),
+    ('personal_address', 'personal_address'),
+    ('is_oauth', Computed(lambda user: bool(user.oauth_id), 'oauth_id')),
+])
+
+notification = Serializer(Notification, [
+    ('user_id', 'user_id'),
+    ('user', 'user.email'),
+    ('id', 'id'),
+    ('sended_on', 'sended_on'),
+    ('content', 'content'),
+    ('is_read', 'is_read'),
+])
+
+upload = Serializer(PictureUpload, [
+    ('name', 'name'),
+    ('status', 'status'),
+    ('key', 'key'),
+    ('error', 'error'),
+    ('updated_on', 'updated_on'),
+])
@@ -0,0 +1,126 @@
+# services.py
+'''
+Lazily created clients of outside services, and post-fork hooks.
+
+Clients are built on first use inside each process and rebuilt when the
+current pid differs from the creator's, like the pools of `pools.py`.
+Importing the app therefore loads neither boto3 nor its service models,
+and `instance()` can run once in the uWSGI master (`lazy-apps = false`)
+with the workers sharing the loaded modules copy-on-write.
+
+Whatever must not cross a fork (pooled connections, threads) is set up from
+`postfork` hooks, which uWSGI runs in every worker it forks. `in_workers`
+also runs its function right away unless the app is being preloaded in the
+master, so the same code works with `lazy-apps = true` and outside uWSGI.
+
+E-mail needs no client here: `Mail` only holds settings and SMTP
+connections are opened by the outbox worker, a process of its own.
+'''
+
+from flask import current_app
+
+import os
+import threading
+
+_clients = dict()
+_hooks = []
+_lock = threading.Lock()
+_forked = set()
+
+
+def client(name, factory):
+    '''
+    Fetch a named client, creating it for the current process if needed
+
+    Args:
+        name (str): Client name, one client per name and process
+        factory (callable): Builds the client, called with the lock held
+
+    Returns:
+        The client
+    '''
+    with _lock:
+        instance, pid = _clients.get(name, (None, None))
+        if instance is None or pid != os.getpid():
+            instance = factory()
+            _clients[name] = (instance, os.getpid())
+        return instance
+
+
+def s3():
+    '''S3 client of this process, low level clients are thread-safe'''
+    def build():
+        '''Own session, the default one is not safe to share between threads'''
+        from boto3.session import Session
+        return Session().client(
+            's3', endpoint_url=current_app.config['S3_ENDPOINT_URL'])
+    return client('s3', build)
+
+
+def oauth():
+    '''
+    OAuth client of this process, for authorization urls only: oauthlib
+    clients keep the token of an exchange on self
+    '''
+    def build():
+        from oauthlib.oauth2 import WebApplicationClient
+        return WebApplicationClient(current_app.config['OIDC_CLIENT_ID'])
+    return client('oauth', build)
+
+
+def preloading():
+    '''True while the app is loaded in the uWSGI master, before forking'''
+    try:
+        import uwsgi
+    except ImportError:
+        return False
+    return uwsgi.worker_id() == 0
+
+
+def postfork(function):
+    '''
+    Call `function` in every worker uWSGI forks from now on
+
+    Returns:
+        function
+    '''
+    if not _hooks:
+        try:
+            from uwsgidecorators import postfork as uwsgi_postfork
+        except ImportError:
+            '''Not running under uWSGI'''
+        else:
+            uwsgi_postfork(forked)
+    _hooks.append(function)
+    return function
+
+
+def in_workers(function):
+    '''
+    Call `function` in the worker processes: now, or once forked when the
+    app is being preloaded in the master
+
+    Returns:
+        function
+    '''
+    postfork(function)
+    if not preloading():
+        function()
+    return function
+
+
+def forked():
+    '''
+    Run the post-fork hooks, once per process. Dropped clients are rebuilt
+    on first use
+
+    Returns:
+        void
+    '''
+    if os.getpid() in _forked:
+        return
+    _forked.add(os.getpid())
+    '''Only the forking thread lives on in the child, no lock needed'''
+    _clients.clear()
+    for function in _hooks:
+        function()
@@ -1,14 +1,104 @@
 # uploads.py
-'''Upload user and project pictures'''
+'''
+Upload user and project pictures.
 
-from app import s3
+Incoming files are spooled to local disk, turned into size renditions by
+the image process pool and sent to S3 by a thread pool sharing one boto3
+client per process, loaded on the first upload. Large files go through
+multipart uploads. Picture urls are written
+to the owning `Project`/`User` once the upload completes, progress is
+tracked in `PictureUpload` rows. Uploads of a request answered with an
+error are dropped, spooled file and row, instead of being sent.
+'''
+
+from flask import abort, current_app, after_this_request, g
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL.Image import DecompressionBombError
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from app import db, cache
+from .images import render_variants, variant_key
+from .metrics import timed
+from .models import PictureUpload, Project, User
+from .pools import get_pool
+from .services import s3
+from . import serializers
+
+import json
+import os
+import tempfile
+
+
+def picture_key(file, user_id=None, project_id=None, file_name=None):
+    '''S3 key of a profile picture (user_id) or project picture'''
+    extension = file.mimetype.split('image/')[1]
+    if user_id:
+        return 'profile_pictures/'+str(user_id)+'_profile_pic.'+extension
+    return ('projects/'+str(project_id)+'_'+file_name+'_arrang_pic.' +
+            extension)
+
+
+def picture_url(bucket, key):
+    '''Public url of an uploaded object'''
+    return current_app.config['S3_PUBLIC_URL'].format(bucket=bucket, key=key)
+
+
+def spool(file):
+    '''
+    Copy an incoming file to the local spool folder
+
+    Args:
+        file (FileStorage): Incoming file
+
+    Returns:
+        path (str): Spooled file path
+    '''
+    folder = current_app.config['UPLOAD_SPOOL_DIR']
+    os.makedirs(folder, exist_ok=True)
+    handle, path = tempfile.mkstemp(dir=folder)
+    with os.fdopen(handle, 'wb') as spooled:
+        file.save(spooled)
+    return path
+
+
+def file_size(file):
+    '''Size in bytes of an incoming file, leaving its stream position'''
+    stream = file.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def check_sizes(files):
+    '''
+    Refuse the request when a file is too large, call it before writing
+    anything so a refused request leaves no rows or uploads behind
+
+    Args:
+        files (MultiDict): Incoming files, e.g. `request.files`
+
+    Raises:
+        413: File over `IMAGE_MAX_UPLOAD_BYTES`
+
+    Returns:
+        void
+    '''
+    limit = current_app.config['IMAGE_MAX_UPLOAD_BYTES']
+    if any(file_size(file) > limit for file in files.values()):
+        abort(413)
 
 
 def upload_to_s3(bucket=None, file=None, user_id=None, project_id=None,
                  file_name=None):
     '''
     Main function to S3 uploading, depends on properly placed .aws folder at
-    home directory
+    home directory. Returns right after spooling, the upload starts once the
+    current request is over so it never races the request own commit, and
+    only if the request succeeds. Sizes are checked up front with
+    `check_sizes`
 
     Args:
         bucket (str): Bucket which the incoming file should be placed
@@ -17,19 +107,200 @@ def upload_to_s3(bucket=None, file=None, user_id=None, project_id=None,
         project_id (int): Project_id for indentifications purposes
         file_name (str): Name string that will be placed on upload
 
-    Raises:
-        Custom Exception when can't properly connect to AWS bucket.
+    Returns:
+        upload (PictureUpload): Upload status row
+    '''
+    path = spool(file)
+    key = picture_key(file, user_id, project_id, file_name)
+    upload = PictureUpload(project_id=project_id, user_id=user_id,
+                           name=file_name, bucket=bucket, key=key)
+    db.session.add(upload)
+    db.session.commit()
+    app = current_app._get_current_object()
+    upload_id, content_type = upload.id, file.mimetype
+    spooled = (upload_id, path)
+    pending = g.setdefault('pending_uploads', [])
+    pending.append(spooled)
+
+    @after_this_request
+    def submit(response):
+        pending.remove(spooled)
+        if response.status_code >= 400:
+            discard([spooled])
+        else:
+            get_pool('uploads', app.config['UPLOAD_WORKERS']).submit(
+                run_upload, app, upload_id, path, content_type)
+        return response
+    return upload
+
+
+def discard(spooled):
+    '''
+    Drop uploads which will never run: spooled files and status rows
+
+    Args:
+        spooled (list): (PictureUpload id, spooled file path) tuples
 
     Returns:
         void
     '''
-    if s3.buckets.all() is None:
-        raise Exception("No s3 bucket found")
-    if user_id:
-        s3.Bucket(bucket).put_object(
-            Key='profile_pictures/'+str(user_id)+'_profile_pic.'+file.mimetype.split('image/')[1],
-            Body=file, ACL='public-read')
+    for _, path in spooled:
+        if os.path.exists(path):
+            os.remove(path)
+    try:
+        '''The failed request may have left the session unusable'''
+        db.session.rollback()
+        PictureUpload.query.filter(PictureUpload.id.in_(
+            [upload_id for upload_id, _ in spooled])).delete(
+            synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        current_app.logger.exception('dropping uploads failed')
+
+
+def _discard_pending(exception=None):
+    '''Uploads of a request that raised before its response hooks ran'''
+    spooled = g.pop('pending_uploads', None)
+    if spooled:
+        discard(spooled)
+
+
+def run_upload(app, upload_id, path, content_type):
+    '''
+    Render a spooled picture, send every rendition to S3 and publish their
+    urls. Runs in the upload pool
+
+    Args:
+        app (Flask): Application, for config and database access
+        upload_id (int): PictureUpload primary key
+        path (str): Spooled file path, removed when done
+        content_type (str): File mimetype
+
+    Returns:
+        void
+    '''
+    config = app.config
+    variants = []
+    with app.app_context():
+        upload = PictureUpload.query.get(upload_id)
+        upload.status = 'uploading'
+        owner = dict(project_id=upload.project_id, user_id=upload.user_id)
+        db.session.commit()
+        '''Loads boto3, kept off the import of the app'''
+        from boto3.exceptions import S3UploadFailedError
+        from boto3.s3.transfer import TransferConfig
+        transfer = TransferConfig(
+            multipart_threshold=config['UPLOAD_MULTIPART_THRESHOLD'],
+            multipart_chunksize=config['UPLOAD_MULTIPART_CHUNKSIZE'],
+            max_concurrency=config['UPLOAD_MULTIPART_CONCURRENCY'])
+        try:
+            variants = get_pool('images', config['IMAGE_WORKERS'],
+                                processes=True).submit(
+                render_variants, path, config['IMAGE_RENDITIONS'],
+                config['IMAGE_QUALITY'], config['IMAGE_MAX_PIXELS']).result()
+            for variant in variants:
+                variant['key'] = variant_key(upload.key, variant['rendition'],
+                                             variant['format'])
+                with timed('s3', 'upload_file'):
+                    s3().upload_file(
+                        variant['path'], upload.bucket, variant['key'],
+                        Config=transfer,
+                        ExtraArgs={'ACL': 'public-read',
+                                   'ContentType': variant['content_type']})
+        except (BotoCoreError, ClientError, S3UploadFailedError, OSError,
+                DecompressionBombError, BrokenProcessPool) as error:
+            upload.status = 'failed'
+            upload.error = repr(error)
+        else:
+            upload.status = 'done'
+            publish(upload, variants)
+        finally:
+            done = upload.status == 'done'
+            db.session.commit()
+            for file in [path] + [variant['path'] for variant in variants]:
+                os.remove(file)
+        if done:
+            invalidate(**owner)
+        db.session.remove()
+
+
+def picture_meta(upload, variants):
+    '''
+    Rendition metadata of one picture
+
+    Returns:
+        (dict): {rendition: {width, height, webp: {key, url},
+        jpeg: {key, url}}}
+    '''
+    meta = dict()
+    for variant in variants:
+        entry = meta.setdefault(variant['rendition'], dict(
+            width=variant['width'], height=variant['height']))
+        entry[variant['format']] = dict(
+            key=variant['key'], url=picture_url(upload.bucket, variant['key']))
+    return meta
+
+
+def publish(upload, variants):
+    '''
+    Point the owner picture at a finished upload: full size JPEG as the
+    picture url, every rendition in `Project.picture_meta`. Project fields
+    are set with json_set so concurrent uploads of a project can't overwrite
+    each other
+
+    Args:
+        upload (PictureUpload): Finished upload
+        variants (list): Uploaded renditions
+
+    Returns:
+        void
+    '''
+    meta = picture_meta(upload, variants)
+    url = meta['full']['jpeg']['url']
+    if upload.project_id:
+        db.session.execute(text(
+            "UPDATE project SET "
+            "picture = json_set(coalesce(picture, '{}'), :path, :url), "
+            "picture_meta = json_set(coalesce(picture_meta, '{}'), :path, "
+            "json(:meta)) WHERE id = :id"),
+            {'path': '$."{}"'.format(upload.name), 'url': url,
+             'meta': json.dumps(meta), 'id': upload.project_id},
+            mapper=Project.__mapper__)
+    elif upload.user_id:
+        User.query.get(upload.user_id).picture = url
+
+
+def invalidate(project_id=None, user_id=None):
+    '''Drop cached responses showing the picture owner'''
     if project_id:
-        s3.Bucket(bucket).put_object(
-            Key='projects/'+str(project_id)+'_'+file_name+'_arrang_pic.'+file.mimetype.split('image/')[1],
-            Body=file, ACL='public-read')
+        cache.invalidate_project(project_id)
+    elif user_id:
+        cache.invalidate_autor(User.query.get(user_id))
+
+
+def upload_status(project_id):
+    '''
+    Latest upload of every picture of a project
+
+    Args:
+        project_id (int): Project primary key
+
+    Returns:
+        (list): PictureUpload json dumps
+    '''
+    latest = dict()
+    for upload in PictureUpload.query.filter_by(
+            project_id=project_id).order_by(PictureUpload.id):
+        latest[upload.name] = upload
+    return list(serializers.upload.dump_many(latest.values()))
+
+
+def init_app(app):
+    '''
+    Drop the uploads of requests failing before their response hooks
+
+    Returns:
+        void
+    '''
+    app.teardown_request(_discard_pending)
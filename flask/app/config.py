@@ -1,6 +1,7 @@
 # config.py
 '''Config file, contains main config object and parent instances'''
 import os
+import tempfile
 
 
 class Config(object):
@@ -11,15 +12,150 @@ class Config(object):
         'content': 'sqlite:///storage/content.db'
     }
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    '''Read-only copies by bind key (None is the main database), GET
+    requests read from them, e.g. for SQLite:
+    `sqlite:///file:/abs/path/content.db?mode=ro&uri=true`'''
+    SQLALCHEMY_REPLICA_BINDS = {}
+    '''Rows per committed batch of migration backfills'''
+    MIGRATION_BATCH_SIZE = 1000
+    '''`sync` or `gevent`, exported by the uWSGI ini the workers run with.
+    Read by `wsgi.py` to monkey patch before anything else is imported'''
+    WORKER_MODE = os.environ.get('WORKER_MODE', 'sync')
+    '''Per process pool, see `common/database.py`'''
+    DATABASE_POOL_SIZE = 5
+    DATABASE_MAX_OVERFLOW = 5
+    DATABASE_POOL_TIMEOUT = 10
+    '''Per bind and process under gevent, no overflow: greenlets past it
+    wait up to DATABASE_POOL_TIMEOUT for a connection'''
+    DATABASE_GEVENT_POOL_SIZE = 20
+    '''Server database behind pgbouncer in transaction mode. Only SQLite is
+    supported for now: search (FTS5), picture publishing (json_set),
+    migrations and the `User.password` length need porting first'''
+    DATABASE_PGBOUNCER = False
+    SQLITE_PRAGMAS = (
+        ('journal_mode', 'WAL'),
+        ('busy_timeout', 5000),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -20000),
+        ('temp_store', 'MEMORY'),
+    )
     JWT_SECRET_KEY = 'secret'
     JWT_TOKEN_LOCATION = ('query_string', 'headers')
     JWT_ACCESS_TOKEN_EXPIRES = 3600
     JWT_QUERY_STRING_NAME = 'code'
+    '''HS256 signs with JWT_SECRET_KEY. RS256 (or RS512/ES256) signs with a
+    PEM key pair so other services can verify tokens from
+    `/.well-known/jwks.json` without the secret'''
+    JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
+    JWT_PRIVATE_KEY_FILE = os.environ.get('JWT_PRIVATE_KEY_FILE')
+    JWT_PUBLIC_KEY_FILE = os.environ.get('JWT_PUBLIC_KEY_FILE')
+    JWT_BLACKLIST_ENABLED = True
+    JWT_BLACKLIST_TOKEN_CHECKS = ('access', 'refresh')
+    '''Revoked tokens, see `common/revocation.py`. The Bloom filter takes
+    128KB per process, ~1% false positives at 100k live revocations'''
+    REVOCATION_BLOOM_BITS = 2 ** 20
+    REVOCATION_BLOOM_HASHES = 7
+    REVOCATION_SYNC_INTERVAL = 5
+    REVOCATION_PRUNE_INTERVAL = 3600
+    '''Lifetime of single-use e-mailed link tokens, seconds'''
+    LINK_TOKEN_EXPIRES = 3600
+    '''Per process snapshots behind `current_user`, see `common/identity.py`'''
+    USER_CACHE_SIZE = 4096
+    USER_CACHE_TTL = 30
     MAIL_SERVER = 'smtp.googlemail.com'
     MAIL_PORT = 587
     MAIL_USE_TLS = True
     MAIL_USERNAME = os.environ.get('EMAIL_USER')
     MAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD')
+    MAIL_BATCH_SIZE = 50
+    MAIL_POLL_INTERVAL = 1
+    MAIL_IDLE_TIMEOUT = 30
+    MAIL_MAX_ATTEMPTS = 6
+    MAIL_RETRY_BASE = 30
+    MAIL_DOMAIN_RATE = 30
+    LIST_PAGE_SIZE = 20
+    LIST_MAX_PAGE_SIZE = 100
+    '''Response encoder, `json`, `orjson` or `msgspec` when installed'''
+    JSON_ENCODER = os.environ.get('JSON_ENCODER', 'json')
+    '''Streamed collections: rows per database fetch, bytes per chunk'''
+    JSON_STREAM_BATCH = 100
+    JSON_STREAM_BUFFER = 16 * 1024
+    CACHE_BACKEND = 'memory'
+    CACHE_TTL = 60
+    CACHE_MAX_ENTRIES = 1024
+    CACHE_UWSGI_NAME = 'ikebana'
+    '''Scope versions, a cache2 of their own so responses never evict them'''
+    CACHE_UWSGI_VERSIONS = 'ikebana_versions'
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    '''Token bucket rate limits, see `common/ratelimit.py`. Rules are
+    (requests, period seconds, scope) by endpoint or blueprint name'''
+    RATELIMIT_ENABLED = True
+    RATELIMIT_BACKEND = 'memory'
+    RATELIMIT_UWSGI_NAME = 'ratelimit'
+    RATELIMIT_REDIS_URL = os.environ.get('RATELIMIT_REDIS_URL')
+    RATELIMIT_MAX_ENTRIES = 65536
+    RATELIMIT_RULES = {
+        'user_auths': [(300, 60, 'user')],
+        'user_auths.login': [(20, 60, 'ip'), (10, 600, 'email')],
+        'user_auths.register': [(5, 600, 'ip')],
+        'user_auths.recover_pass': [(5, 600, 'ip'), (3, 3600, 'email')],
+        'contents': [(600, 60, 'user')],
+        'contents.search': [(60, 60, 'user'), (120, 60, 'ip')],
+        'oauth': [(30, 60, 'ip')],
+    }
+    '''OpenID Connect provider, see `common/oidc.py`. Timeouts are
+    (connect, read) seconds'''
+    OIDC_DISCOVERY_URL = os.environ.get('GOOGLE_DISCOVERY_URL')
+    OIDC_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
+    OIDC_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
+    OIDC_REDIRECT_URI = os.environ.get('OIDC_REDIRECT_URI',
+                                       'https://fabricio7p.com.br/oauth')
+    OIDC_TIMEOUT = (3.05, 10)
+    OIDC_CACHE_TTL = 3600
+    OIDC_POOL_SIZE = 10
+    OIDC_LEEWAY = 60
+    '''Notification streams, see `common/events.py`. Stream workers run in
+    their own uWSGI instance (`wsgi-stream.ini`), only `redis` wakes them
+    right away, with `local` they rely on polling'''
+    EVENTS_BACKEND = 'local'
+    EVENTS_REDIS_URL = os.environ.get('EVENTS_REDIS_URL')
+    EVENTS_POLL_INTERVAL = 5
+    EVENTS_KEEPALIVE = 20
+    EVENTS_BATCH_SIZE = 50
+    EVENTS_RETRY = 3000
+    '''Instrumentation, see `common/metrics.py`. Without `METRICS_DIR`
+    every process only reports its own metrics'''
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5
+    METRICS_QUERY_WARN = 50
+    METRICS_QUERY_HEADER = False
+    METRICS_PROFILE_TOKEN = os.environ.get('METRICS_PROFILE_TOKEN')
+    METRICS_PROFILE_INTERVAL = 0.005
+    METRICS_PROFILE_DIR = os.path.join(tempfile.gettempdir(),
+                                       'ikebana-profiles')
+    PASSWORD_HASH_ALGORITHM = 'scrypt'
+    PASSWORD_PBKDF2_ITERATIONS = 100000
+    PASSWORD_SCRYPT_N = 2 ** 14
+    PASSWORD_SCRYPT_R = 8
+    PASSWORD_SCRYPT_P = 1
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE = 16
+    PASSWORD_HASH_TIMEOUT = 10
+    '''AWS when unset, e.g. `bench/fake_s3.py` otherwise'''
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    S3_PUBLIC_URL = os.environ.get(
+        'S3_PUBLIC_URL', 'https://{bucket}.s3-sa-east-1.amazonaws.com/{key}')
+    UPLOAD_SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'ikebana-uploads')
+    UPLOAD_WORKERS = 4
+    UPLOAD_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    UPLOAD_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    UPLOAD_MULTIPART_CONCURRENCY = 4
+    IMAGE_RENDITIONS = (('thumb', 320), ('medium', 800), ('full', 1600))
+    IMAGE_QUALITY = 82
+    IMAGE_WORKERS = 2
+    IMAGE_MAX_PIXELS = 40000000
+    IMAGE_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
 
 
 class Development(Config):
@@ -28,6 +164,11 @@ class Development(Config):
     DEBUG = True
     TESTING = False
     ENV = 'development'
+    '''Local stand-in from `debug_smtp.py`'''
+    MAIL_SERVER = 'localhost'
+    MAIL_PORT = 1025
+    MAIL_USE_TLS = False
+    METRICS_QUERY_HEADER = True
 
 class Production(Config):
     '''Production config. Debuf off'''
@@ -35,3 +176,27 @@ class Production(Config):
     DEBUG = False
     TESTING = False
     ENV = 'production'
+    CACHE_BACKEND = 'uwsgi'
+    RATELIMIT_BACKEND = 'uwsgi'
+    '''Cleared on start by `wsgi.ini`'''
+    METRICS_DIR = os.environ.get(
+        'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'ikebana-metrics'))
+    EVENTS_BACKEND = 'redis' if os.environ.get('EVENTS_REDIS_URL') else 'local'
+
+
+class Benchmark(Production):
+    '''
+    Production stack against the local stand-ins of `bench/`: SMTP from
+    `debug_smtp.py`, OpenID from `fake_oidc.py` and S3 from
+    `bench/fake_s3.py` (set `S3_ENDPOINT_URL`). Rate limits are off, the
+    load generator sends everything from one address
+    '''
+    MAIL_SERVER = 'localhost'
+    MAIL_PORT = 1025
+    MAIL_USE_TLS = False
+    OIDC_DISCOVERY_URL = os.environ.get(
+        'GOOGLE_DISCOVERY_URL',
+        'http://localhost:5055/.well-known/openid-configuration')
+    OIDC_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID', 'bench')
+    OIDC_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET', 'bench')
+    RATELIMIT_ENABLED = False
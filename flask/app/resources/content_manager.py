@@ -2,17 +2,76 @@
 
 '''Manage Ikebana database logic operations'''
 import json
-from flask import jsonify, Blueprint, request, abort
-from app import db
+from flask import jsonify, Blueprint, request, abort, current_app
+from app import db, cache
+from app.common.cache import request_key
+from app.common.budgets import query_budget
 from sqlalchemy.exc import IntegrityError
-from app.common.notifications import notify_user
-from app.common.models import Project, User
-from app.common.uploads import upload_to_s3
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from app.common.notifications import NotificationBatch, commit_counters
+from app.common.models import Project, ProjectLike
+from app.common.uploads import check_sizes, upload_to_s3, upload_status
+from app.common.pagination import KeysetStream, page_limit
+from app.common.search import index_project, remove_project, search_projects
+from app.common.serializers import project, requested_fields, respond, stream
+from flask_jwt_extended import (jwt_required, jwt_optional, get_jwt_identity,
+                                current_user)
 
 contents = Blueprint('contents', __name__)
 
+
+def dump_projects(projects, user_id=None, fields=None):
+    '''
+    Dump projects flagging the ones liked by the requesting user, if any
+
+    Args:
+        projects (list): Project objects
+        user_id (int): Requesting user id, the JWT user when not given
+        fields (tuple): Sparse fieldset, see `requested_fields`
+
+    Returns:
+        (list): Json serializable project dicts
+    '''
+    rows = list(project.dump_many(projects, fields))
+    if fields is not None and 'liked_by_me' not in fields:
+        return rows
+    if user_id is None and get_jwt_identity():
+        user_id = current_user.id
+    liked = ProjectLike.liked_among(user_id, [proj.id for proj in projects])
+    for row, proj in zip(rows, projects):
+        row['liked_by_me'] = proj.id in liked
+    return rows
+
+
+def stream_projects(projects, user_id=None, fields=None):
+    '''
+    Dump projects as they are iterated, liked flags are queried once per
+    `JSON_STREAM_BATCH` projects
+
+    Args:
+        projects (iterable): Project objects, e.g. a `yield_per` query
+        user_id (int): Requesting user id, None for anonymous requests
+        fields (tuple): Sparse fieldset, see `requested_fields`
+
+    Returns:
+        (generator): Json serializable project dicts
+    '''
+    size = current_app.config['JSON_STREAM_BATCH']
+    batch = []
+    for proj in projects:
+        batch.append(proj)
+        if len(batch) == size:
+            yield from dump_projects(batch, user_id, fields)
+            batch = []
+    if batch:
+        yield from dump_projects(batch, user_id, fields)
+
+
+def requesting_user_id():
+    '''Id of the JWT user, None for anonymous requests'''
+    return current_user.id if get_jwt_identity() else None
+
 @contents.route('/projects', methods=['POST', 'GET', 'PUT', 'DELETE'])
+@query_budget(GET=3, POST=11, PUT=6, DELETE=7)
 @jwt_required
 def register():
     '''
@@ -29,12 +88,14 @@ def register():
         200: Success
         500: Internal Error
         401: Couldn't find username in database
+        413: Picture over `IMAGE_MAX_UPLOAD_BYTES`, nothing is saved
     '''
-    user_q = User.query.filter_by(username=get_jwt_identity()).first()
+    user_q = current_user
     if request.method == 'POST':
         if user_q.partner:
             payload = request.form
             files = request.files
+            check_sizes(files)
             '''Handling allow solicitations'''
             if payload['project_allow'] == 'true':
                 allow=True
@@ -48,6 +109,7 @@ def register():
                 db.session.add(proj_q)
                 db.session.commit()
             except IntegrityError:
+                db.session.rollback()
                 abort(500)
             else:
                 proj_q.picture = dict()
@@ -55,24 +117,30 @@ def register():
                     proj_q.picture.update({'file1':
                                            'https://ikebana-app-content.s3-sa-east-1'+
                                            '.amazonaws.com/static/mainlogo.png'})
+                '''Picture urls are set as each upload completes'''
                 for file, name in zip(files.values(), files.keys()):
-                    proj_q.picture.update({name: 'https://ikebana-app-content.s3-sa-east-1.a'+
-                                           'mazonaws.com/projects/'+str(proj_q.id)+'_'+name+'_arrang_pic.'+
-                                           file.mimetype.split('image/')[1]})
                     upload_to_s3('ikebana-app-content', file,
                                  project_id=proj_q.id, file_name=name)
-            finally:
-                db.session.commit()
-                notify_user(user_q.id, 'project', proj_q.name)
+                index_project(proj_q)
+                batch = NotificationBatch()
+                batch.notify(user_q.id, 'project', proj_q.name)
+                batch.recount_projects(user_q.id)
+                batch.commit()
+                cache.invalidate_project(proj_q.id)
+                cache.bump('autor', user_q.id)
         return jsonify({'response': 'success'})
     elif request.method == 'GET':
-        proj_q = Project.query.filter_by(autor_id=user_q.id)
-        response = [project.json_dump for project in proj_q]
-        return jsonify(response)
+        fields = requested_fields(project)
+        proj_q = Project.query.options(
+            *project.load_options(fields)).filter_by(
+            autor_id=user_q.id).order_by(Project.id).yield_per(
+            current_app.config['JSON_STREAM_BATCH'])
+        return stream(stream_projects(proj_q, user_q.id, fields))
     elif request.method == 'PUT':
         if user_q.partner:
             payload = request.form
             files = request.files
+            check_sizes(files)
             try:
                 '''Update project info'''
                 proj_q = Project.query.filter_by(id=payload['project_id']).first()
@@ -88,11 +156,8 @@ def register():
             except IntegrityError:
                 abort(500)
             else:
-                '''Overwrite stored pictures'''
+                '''Overwrite stored pictures once uploads complete'''
                 for file, name in zip(files.values(), files.keys()):
-                    proj_q.picture.update({name: 'https://ikebana-app-content.s3-sa-east-1.a'+
-                                           'mazonaws.com/projects/'+str(proj_q.id)+'_'+name+'_arrang_pic.'+
-                                           file.mimetype.split('image/')[1]})
                     upload_to_s3('ikebana-app-content', file,
                                  project_id=proj_q.id, file_name=name)
                 '''Remove pictures entries marked for deletion'''
@@ -100,19 +165,31 @@ def register():
                     if 'file' in entry and entry in proj_q.picture:
                         if payload[entry] == 'del':
                             proj_q.picture.pop(entry)
+                            if proj_q.picture_meta:
+                                proj_q.picture_meta.pop(entry, None)
                 if len(proj_q.picture) == 0:
                     proj_q.picture.update({'file1':
                                            'https://ikebana-app-content.s3-sa-east-1'+
                                            '.amazonaws.com/static/mainlogo.png'})
+                index_project(proj_q)
             finally:
                 db.session.commit()
+                cache.invalidate_project(proj_q.id)
     elif request.method == 'DELETE':
         if user_q.partner:
             payload = request.json
             proj_q = Project.query.filter_by(id=payload['project_id']).first()
             try:
+                remove_project(proj_q.id)
+                ProjectLike.query.filter_by(project_id=proj_q.id).delete()
+                project_id, autor_id = proj_q.id, proj_q.autor_id
                 db.session.delete(proj_q)
                 db.session.commit()
+                '''Autor counters live in users.db, recounted once the
+                project is gone'''
+                commit_counters(projects=[autor_id])
+                cache.invalidate_project(project_id)
+                cache.bump('autor', user_q.id)
             except IntegrityError:
                 abort(500)
             finally:
@@ -123,31 +200,79 @@ def register():
 
 
 
+@contents.route('/projects/<int:id>/uploads', methods=['GET'])
+@query_budget(2)
+@jwt_required
+def project_uploads(id):
+    '''
+    Picture upload progress of a project of the requesting user
+
+    Args:
+        id (int): Project id
+
+    Methods:
+        GET
+
+    Raises:
+        404: No such project of the requesting user
+
+    Returns:
+        Latest upload of every project picture: name, status (pending,
+        uploading, done or failed), key and error
+    '''
+    Project.query.with_entities(Project.id).filter_by(
+        id=id, autor_id=current_user.id).first_or_404()
+    return respond(upload_status(id))
+
+
 @contents.route('/list', methods=['GET'])
+@query_budget(4)
+@jwt_optional
 def list_arrangements():
     '''
-    List all ikebana arrangements
+    List ikebana arrangements, newest first, one page at a time
 
     Methods:
         GET
 
+    Args:
+        limit (int): Query string page size, bounded by `LIST_MAX_PAGE_SIZE`
+        cursor (str): Query string `next_cursor` from the previous page
+        fields (str): Query string comma separated project fields to return
+
+    Raises:
+        400: Malformed limit or cursor, unknown field
+
     Returns:
-        All avaiable projects as json
+        Page of projects as json and the cursor for the next page
     '''
-    projects = [proj.json_dump for proj in Project.query.all()]
-    return jsonify(projects)
+    fields = requested_fields(project)
+    user_id = requesting_user_id()
+
+    def build():
+        query = Project.query.options(
+            *project.load_options(fields, 'created_on'))
+        page = KeysetStream(query, Project, cursor=request.args.get('cursor'),
+                            limit=page_limit(request.args.get('limit')),
+                            batch=current_app.config['JSON_STREAM_BATCH'])
+        return stream(stream_projects(page, user_id, fields), 'projects',
+                      lambda: {'next_cursor': page.next_cursor})
+    key = None if get_jwt_identity() else request_key(
+        'list', request.args.get('cursor'), request.args.get('limit'), fields)
+    return cache.response(key, [('catalog',)], build)
 
 @contents.route('/like_project', methods=['POST'])
+@query_budget(4)
 @jwt_required
 def like_project():
     '''
-    Increment project like count
+    Like a project, once per user
 
     Methods:
         POST
 
     Raises:
-        500: IntegrityError
+        500: Project not found
         401: Couldn't find username in database
     '''
     payload = request.json
@@ -156,77 +281,131 @@ def like_project():
     if proj_q is None:
         abort(500)
     '''Checks if it is a logged user'''
-    user_q = User.query.filter_by(username=get_jwt_identity()).first()
-    if user_q:
-        try:
-            proj_q.liked_by.update({user_q.id: user_q.email})
-            db.session.commit()
-        except IntegrityError:
-            abort(500)
-        else:
-            return jsonify({'response': 'success as logged'})
+    user_q = current_user
+    try:
+        db.session.add(ProjectLike(project_id=proj_q.id, user_id=user_q.id))
+        db.session.flush()
+    except IntegrityError:
+        '''Unique (project, user) constraint, already liked'''
+        db.session.rollback()
+        return jsonify({'response': 'already liked'})
+    Project.query.filter_by(id=proj_q.id).update(
+        {Project.like_count: Project.like_count + 1},
+        synchronize_session=False)
+    db.session.commit()
+    cache.invalidate_project(proj_q.id)
+    return jsonify({'response': 'success as logged'})
 
 @contents.route('/get_project/<id>', methods=['GET'])
+@query_budget(3)
+@jwt_optional
 def get_projcet(id):
     '''
     Endpoint for retrieving single project info
 
     Args:
         id (int): Project id
+        fields (str): Query string comma separated project fields to return
 
     Methods:
         GET
 
     Raises:
+        400: Unknown field
         401: Couldn't find username in database
     '''
-    proj_q = Project.query.filter_by(id=id).first()
-    return proj_q.json_dump
+    fields = requested_fields(project)
+
+    def build():
+        proj_q = Project.query.options(
+            *project.load_options(fields)).filter_by(id=id).first()
+        if proj_q is None:
+            abort(404)
+        return respond(dump_projects([proj_q], fields=fields)[0])
+    key = None if get_jwt_identity() else request_key('project', id, fields)
+    return cache.response(key, [('project', id)], build)
 
 
 @contents.route('/solicitation', methods=['POST'])
+@query_budget(10)
 @jwt_required
 def new_solicitation():
     '''
-    Create new arrangement solicitation
+    Create new arrangement solicitation. Order counts and autor
+    notifications of the whole cart are written in one transaction, autor
+    counters are recounted after it
 
     Methods:
         POST
-    
+
     Raises:
         IntegrityError
         401: Couldn't find username in database
+        404: Unknown arrangement
         500: Internal Error
 
     '''
-    user_q = User.query.filter_by(username=get_jwt_identity()).first()
+    user_q = current_user
     arrangements = request.json[0]
     msg = request.json[1]
-    for arr in arrangements.values():
-        proj_q = Project.query.filter_by(id=arr['project_id']).first()
-        try:
-            proj_q.orders += 1
-            db.session.commit()
-        except IntegrityError:
-            abort(500)
-        else:
-            notify_user(proj_q.autor.id, 'new_request', proj_q.name, user_q.fullname,
-                        msg['autor_msg'])
+    project_ids = [int(arr['project_id']) for arr in arrangements.values()]
+    projects = {proj.id: proj for proj in
+                Project.query.filter(Project.id.in_(project_ids))}
+    batch = NotificationBatch()
+    for project_id in project_ids:
+        proj_q = projects.get(project_id)
+        if proj_q is None:
+            abort(404)
+        batch.count_order(proj_q.id, proj_q.autor_id)
+        batch.notify(proj_q.autor_id, 'new_request', proj_q.name,
+                     user_q.fullname, msg['autor_msg'])
+    batch.commit()
+    cache.invalidate_project(*projects)
+    for autor_id in {proj.autor_id for proj in projects.values()}:
+        cache.bump('autor', autor_id)
     return jsonify({'response': 'success'})
 
 
 @contents.route('/search', methods=['POST'])
+@query_budget(4)
+@jwt_optional
 def search():
     '''
-    Search queries endpoint
+    Search queries endpoint. Matches word prefixes of project name,
+    description, type and autor name, ignoring accents
 
     Methods:
         POST
 
+    Args:
+        string (str): Json payload search text
+        page (int): Json payload 1-based page number, defaults to 1
+        limit (int): Json payload page size, bounded by `LIST_MAX_PAGE_SIZE`
+        fields (str): Query string comma separated project fields to return
+
+    Raises:
+        400: Malformed page or limit, unknown field
+
     Returns:
-        Search results as json
+        Page of search results ranked by relevance as json
     '''
-    query = '%{}%'.format(request.json['string'])
-    proj_results = Project.query.filter(Project.name.like(query)).all()
-    proj_results = [proj.json_dump for proj in proj_results]
-    return jsonify(proj_results)
+    payload = request.json
+    try:
+        page = max(1, int(payload.get('page', 1)))
+    except (TypeError, ValueError):
+        abort(400)
+    limit = page_limit(payload.get('limit'))
+    fields = requested_fields(project)
+
+    user_id = requesting_user_id()
+
+    def build():
+        '''Ranked ids come first, a page is fetched whole and streamed out'''
+        projects, has_more = search_projects(
+            payload['string'], page=page, limit=limit,
+            options=project.load_options(fields))
+        return stream(stream_projects(projects, user_id, fields), 'projects',
+                      lambda: {'next_page': page + 1 if has_more else None})
+    key = None if get_jwt_identity() else request_key(
+        'search', payload['string'], page, limit, fields)
+    return cache.response(key, [('catalog',)], build)
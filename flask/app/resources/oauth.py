@@ -1,21 +1,23 @@
 # oauth.py
 '''Oauth endpoints'''
-from flask import Blueprint, jsonify, request, abort
+from flask import Blueprint, jsonify, request, abort, current_app
 
-from app import client, db
+from app import db
 from app.common.models import User
+from app.common.budgets import query_budget
 from app.common.hashing import hash_password
-from app.common.jwt import user_gen_jwt
+from app.common.jwt import issue_tokens
+from app.common.oidc import authorization_url, exchange_code
+from app.common import services
 from sqlalchemy.exc import IntegrityError
 
-import json
 import os
-import requests
 
 oauth = Blueprint('oauth', __name__)
 
 
 @oauth.route('/oauth_login', methods=['GET'])
+@query_budget(0)
 def login_endpoint():
     '''
     oAuth2 login endpoint
@@ -23,79 +25,52 @@ def login_endpoint():
     Methods:
         GET
 
+    Raises:
+        502: Provider unreachable
+
     Returns:
         First request redirect to google approval
     '''
-
-    '''Fetch oauth configuration json'''
-    config_payload = requests.get(
-        os.environ.get('GOOGLE_DISCOVERY_URL')
-    ).json()
-    auth_endpoint = config_payload['authorization_endpoint']
-    '''Generate authorization request'''
-    request_uri = client.prepare_request_uri(
-        auth_endpoint,
-        redirect_uri='https://fabricio7p.com.br/oauth',
-        scope=['openid', 'email', 'profile'],
-    )
+    request_uri = authorization_url(
+        services.oauth(), current_app.config['OIDC_REDIRECT_URI'])
     return jsonify({'request_uri': '{}'.format(request_uri)})
 
 
 @oauth.route('/callback')
+@query_budget(3)
 def oauth_callback():
     '''
     oAuth2 Callback endpoint, expects google accepted query string
+
+    Raises:
+        401: Authorization code refused or invalid ID token
+        500: Couldn't store the new user
+        502: Provider unreachable
     '''
-    '''Parse given authorization code'''
-    code = request.args.get('code')
-    config_payload = requests.get(
-        os.environ.get('GOOGLE_DISCOVERY_URL')
-    ).json()
-    token_endpoint = config_payload['token_endpoint']
-    '''Prepare the token request'''
-    '''Spits out token_url, headers and body'''
-    token_url, headers, body = client.prepare_token_request(
-        token_endpoint,
-        authorization_response=request.url,
-        redirect_url='https://fabricio7p.com.br/oauth',
-        code=code
-    )
-    '''Send the actual request that gets access to user info'''
-    token_response = requests.post(
-        token_url,
-        headers=headers,
-        data=body,
-        auth=(os.environ.get('GOOGLE_CLIENT_ID'),
-              os.environ.get('GOOGLE_CLIENT_SECRET')),
-    )
-    '''Parse received token'''
-    '''Retrieve user information from google response'''
-    client.parse_request_body_response(json.dumps(token_response.json()))
-    userinfo_endpoint = config_payload['userinfo_endpoint']
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
-    if userinfo_response.json().get('email_verified'):
-        unique_id = userinfo_response.json()['sub']
-        users_email = userinfo_response.json()['email']
-        picture = userinfo_response.json()['picture']
-        users_name = userinfo_response.json()['given_name']
+    '''ID token claims, userinfo is only fetched if some are missing'''
+    userinfo = exchange_code(request.args.get('code'), request.url,
+                             current_app.config['OIDC_REDIRECT_URI'])
+    if userinfo.get('email_verified'):
+        unique_id = userinfo['sub']
+        users_email = userinfo['email']
+        picture = userinfo.get('picture')
+        users_name = userinfo.get('given_name')
     else:
         return jsonify(
             {'response': 'User email not avaiable or not verified by Google'}
         )
     '''Finally adding google user to own app database'''
-    user_q = User(oauth_id=unique_id, username=users_email, email=users_email,
-                  picture=picture, fullname=users_name,
-                  password=hash_password(os.environ.get('APP_SECRET_KEY')))
     if not User.query.filter_by(oauth_id=unique_id).first():
+        user_q = User(oauth_id=unique_id, username=users_email,
+                      email=users_email, picture=picture, fullname=users_name,
+                      password=hash_password(os.environ.get('APP_SECRET_KEY')))
         try:
             db.session.add(user_q)
             db.session.commit()
         except IntegrityError:
             abort(500)
-    access_code = user_gen_jwt(users_email, os.environ.get('APP_SECRET_KEY'))
-    refresh_jwt = user_gen_jwt(users_email, os.environ.get('APP_SECRET_KEY'), 
-                               refresh=True)
+    '''Google already authenticated the user, no password check needed'''
+    access_code, refresh_jwt = issue_tokens(users_email)
     '''Returns jwt to client'''
     return jsonify({'key': '{}'.format(access_code),
                     'refresh_key': '{}'.format(refresh_jwt)})
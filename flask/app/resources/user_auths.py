@@ -1,15 +1,29 @@
 # user_auths.py
 '''User logic and endpoints'''
 
-from flask import jsonify, Blueprint, request, abort
-from flask_jwt_extended import (jwt_required, get_jwt_identity, 
-                                jwt_refresh_token_required)
-from app import db
-from app.common.notifications import notify_user
-from app.common.hashing import hash_password, verify_password
-from app.common.uploads import upload_to_s3
+from flask import (jsonify, Blueprint, request, abort, current_app,
+                   Response)
+from flask_jwt_extended import (jwt_required, jwt_refresh_token_required,
+                                create_access_token, current_user,
+                                decode_token, get_raw_jwt)
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
+from app import db, cache
+from app.common.cache import request_key
+from app.common.budgets import query_budget
+from app.common.notifications import commit_counters, notify_user, stream
+from app.common.hashing import hash_password, verify_password, needs_rehash
+from app.common.uploads import check_sizes, upload_to_s3
 from app.common.models import User, Notification, Project
-from app.common.jwt import user_gen_jwt
+from app.common.jwt import issue_tokens
+from app.common.identity import token_headers
+from app.common.revocation import (commit_consumed, consume,
+                                   issue_link_token, link_token, revoke,
+                                   revoke_user_tokens)
+from app.common.pagination import keyset_page, page_limit
+from app.common.search import reindex_autor
+from app.common import serializers
+from app.common.serializers import requested_fields, respond
 from app.common.email import (
     send_confirmation_link, send_partner_notification_email,
     send_recover_email)
@@ -22,6 +36,7 @@ import json
 user_auths = Blueprint('user_auths', __name__)
 
 @user_auths.route('/login', methods=['POST'])
+@query_budget(2)
 def login():
     '''
     Main user login endpoint
@@ -47,9 +62,13 @@ def login():
             abort(400)
         if user_q.confirmed is False:
             abort(403)
-        jwt = user_gen_jwt(payload['email'], payload['password'])
-        refresh_jwt = user_gen_jwt(payload['email'], payload['password'],
-                                   refresh=True)
+        if not verify_password(user_q.password, payload['password']):
+            abort(401)
+        if needs_rehash(user_q.password):
+            '''Hashing parameters changed since this password was stored'''
+            user_q.password = hash_password(payload['password'])
+            db.session.commit()
+        jwt, refresh_jwt = issue_tokens(user_q.username)
         return jsonify({'key': '{}'.format(jwt),
                         'refresh_key': '{}'.format(refresh_jwt)})
     else:
@@ -57,6 +76,7 @@ def login():
 
 
 @user_auths.route('/user_register', methods=['POST'])
+@query_budget(4)
 def register():
     '''
     Main endpoint for register new user. No relation with oauth
@@ -82,18 +102,17 @@ def register():
     except IntegrityError:
         abort(401)
     else:
-        response = {
+        '''Generate single-use JWT and send confirmation link'''
+        access_code = issue_link_token(aux.username, 'verify')
+        send_confirmation_link(aux.email, access_code)
+        return jsonify({
             'registration': 'success',
             'user': '{}'.format(payload['email'])
-        }
-    finally:
-        '''Generate JWT and send confirmation link'''
-        access_code = user_gen_jwt(payload['email'], payload['password'])
-        send_confirmation_link(aux.email, access_code)
-        return jsonify(response)
+        })
 
 
 @user_auths.route('/recover_pass', methods=['POST'])
+@query_budget(2)
 def recover_pass():
     '''
     Send recovery link to user email
@@ -120,16 +139,19 @@ def recover_pass():
             abort(403)
         else:
             '''Send recover message if email exists in database'''
-            access_code = user_gen_jwt(user_q.email)
+            access_code = issue_link_token(user_q.email, 'recover')
             send_recover_email(user_q.email, access_code)
             return jsonify({'response': 'email sent'})
 
 
 @user_auths.route('/reset_pass', methods=['POST'])
+@query_budget(3)
+@link_token('recover')
 @jwt_required
 def reset_pass():
     '''
-    Reset password endpoint, expects JWT key
+    Reset password endpoint, expects the single-use JWT key of the recovery
+    link. Every token issued to the user before is revoked
 
     Methods:
         POST
@@ -137,12 +159,14 @@ def reset_pass():
     Raises:
         IntegrityError
         500: Internal Error
-        401: Couldn't find username in database
+        401: Couldn't find username in database, not a recovery token or
+        link already used
     '''
+    consume('recover')
     try:
         '''Fetch user object from database
         returns error if jwt identity doesnt match an user'''
-        user_q = User.query.filter_by(username=get_jwt_identity()).first()
+        user_q = User.query.get(current_user.id)
         if user_q is None:
             '''User does not exist'''
             abort(401)
@@ -151,11 +175,15 @@ def reset_pass():
     else:
         payload = request.json
         user_q.password = hash_password(payload['password'])
-        db.session.commit()
+        revoke_user_tokens(user_q)
+        commit_consumed()
+        cache.bump('autor', current_user.id)
         return jsonify({'response': 'success'})
 
 
 @user_auths.route('/verify', methods=['GET'])
+@query_budget(9)
+@link_token('verify')
 @jwt_required
 def verify():
     '''
@@ -165,33 +193,29 @@ def verify():
         GET
 
     Raises:
-        IntegrityError
-        500: Internal Error
-        401: Couldn't find username in database or user already confirmed email
+        401: Couldn't find username in database, user already confirmed email,
+        not a confirmation token or link already used
     '''
-    try:
-        '''Fetch user object from database
-        returns error if jwt identity doesnt match an user'''
-        user_q = User.query.filter_by(username=get_jwt_identity()).first()
-        if user_q is None:
-            abort(401)
-    except IntegrityError:
-        abort(500)
-    else:
-        '''Throw error if user is already confirmed'''
-        if user_q.confirmed is True:
-            abort(401)
-        else:
-            '''Confirms and commit changes'''
-            user_q.confirm_email
-            db.session.commit()
-    finally:
-        notify_user(user_q.id, 'welcome')
-        return jsonify({'confirmation': 'success',
-                        'user': '{}'.format(user_q.username)})
+    consume('verify')
+    '''Fetch user object from database
+    returns error if jwt identity doesnt match an user'''
+    user_q = User.query.get(current_user.id)
+    if user_q is None:
+        abort(401)
+    '''Throw error if user is already confirmed'''
+    if user_q.confirmed is True:
+        abort(401)
+    '''Confirms and commit changes with the spent link'''
+    user_q.confirm_email
+    commit_consumed()
+    cache.invalidate_autor(user_q)
+    notify_user(user_q.id, 'welcome')
+    return jsonify({'confirmation': 'success',
+                    'user': '{}'.format(user_q.username)})
 
 
 @user_auths.route('/become_partner', methods=['POST'])
+@query_budget(9)
 @jwt_required
 def turn_partner():
     '''
@@ -205,7 +229,7 @@ def turn_partner():
         500: Internal Error
         401: Couldn't find username in database
     '''
-    user_q = User.query.filter_by(username=get_jwt_identity()).first()
+    user_q = User.query.get(current_user.id)
     if user_q is None:
         abort(401)
     payload = request.json
@@ -220,16 +244,19 @@ def turn_partner():
     else:
         if user_q.partner:
             db.session.commit()
+            cache.invalidate_autor(user_q)
             return jsonify({'response': 'data updated'})
         user_q.partner = True
         user_q.partner_on = datetime.now()
         db.session.commit()
+        cache.invalidate_autor(user_q)
         send_partner_notification_email(user_q.email)
         notify_user(user_q.id, 'turned_member')
     return jsonify({'success': 'notification sent'})
 
 
 @user_auths.route('/user', methods=['GET', 'POST', 'DELETE'])
+@query_budget(GET=1, POST=7, DELETE=4)
 @jwt_required
 def retrieve_user():
     '''
@@ -237,28 +264,35 @@ def retrieve_user():
 
     Methods:
         
-        GET: Retrieve full user data by `json_dump` method
+        GET: Retrieve full user data, `fields` query string narrows it
 
         POST: Updates public user info if request is form-data. Updates user
         password if request is pure json.
 
         DELETE: Delete all user notifications
 
+    Note:
+        Notifications are no longer embedded, fetch them from
+        `/notifications`
+
     Raises:
         IntegrityError: Database error
         401: Couldn't find username in database
+        413: Picture over `IMAGE_MAX_UPLOAD_BYTES`, nothing is saved
 
     Returns:
         Json response on success
     '''
-    user_q = User.query.filter_by(username=get_jwt_identity()).first()
+    user_q = User.query.get(current_user.id)
     if user_q is None:
         abort(401)
     if request.method == 'GET':
-        return jsonify(user_q.json_dump)
+        return respond(serializers.user.dump(
+            user_q, requested_fields(serializers.user)))
     elif request.method == 'POST':
         if 'form-data' in request.content_type:
             payload = request.form
+            check_sizes(request.files)
             try:
                 user_q.fullname = payload['fullname']
                 user_q.bio = payload['bio']
@@ -268,13 +302,13 @@ def retrieve_user():
                 abort(500)
             else:
                 if request.files:
-                    '''upload files if form-data payload'''
+                    '''upload files if form-data payload, picture is
+                    updated when the upload completes'''
                     upload_to_s3('ikebana-app-users', file, user_id=user_q.id)
-                    user_q.picture = ('https://ikebana-app-users.s3-sa-east-1.a'+
-                                      'mazonaws.com/profile_pictures/'+str(user_q.id)+'_profile_pic.'+
-                                      file.mimetype.split('image/')[1])
+                reindex_autor(user_q)
             finally:
                 db.session.commit()
+                cache.invalidate_autor(user_q)
             return jsonify({'response': 'data updated'})
         elif 'application/json' in request.content_type:
             '''if not form-data then password change is requested'''
@@ -284,29 +318,35 @@ def retrieve_user():
             if verify_password(user_q.password, payload['old_pass']):
                 try:
                     user_q.password = hash_password(payload['new_pass'])
+                    '''Sign out every other session'''
+                    revoke_user_tokens(user_q)
                 except IntegrityError:
                     abort(500)
                 finally:
                     db.session.commit()
-                    return jsonify({'password': 'updated'})
+                    cache.bump('autor', current_user.id)
+                    jwt, refresh_jwt = issue_tokens(user_q.username)
+                    return jsonify({'password': 'updated',
+                                    'key': '{}'.format(jwt),
+                                    'refresh_key': '{}'.format(refresh_jwt)})
             else:
                 abort(401)
     elif request.method == 'DELETE':
         '''clear notifications'''
-        notifications = Notification.query.filter_by(user_id=user_q.id).all()
         try:
-            for notif in notifications:
-                db.session.delete(notif)
+            Notification.query.filter_by(user_id=user_q.id).delete()
         except IntegrityError:
             abort(500)
         else:
             db.session.commit()
+            commit_counters(unread=[current_user.id])
         finally:
             return jsonify({'notifications': 'deleted'})
 
 
 
 @user_auths.route('/refresh', methods=['POST'])
+@query_budget(1)
 @jwt_refresh_token_required
 def refresh():
     '''
@@ -321,14 +361,54 @@ def refresh():
     Returns:
         New JWT session key
     '''
-    user_q = User.query.filter_by(username=get_jwt_identity()).first()
-    if user_q is None:
-        abort(401)
-    jwt = user_gen_jwt(user_q.email)
+    '''`current_user` comes from the snapshot cache, no user query'''
+    jwt = create_access_token(identity=current_user.username,
+                              headers=token_headers())
     return jsonify({'key': '{}'.format(jwt)})
 
 
+@user_auths.route('/logout', methods=['POST'])
+@query_budget(2)
+@jwt_required
+def logout():
+    '''
+    Revoke the access token of the request and, when sent, its refresh token
+
+    Methods:
+        POST
+
+    Args:
+        refresh_key (str): Optional json payload refresh token
+
+    Raises:
+        401: Refresh token invalid or of another user
+
+    Returns:
+        Response success
+    '''
+    try:
+        revoke(get_raw_jwt())
+    except IntegrityError:
+        db.session.rollback()
+    refresh_key = (request.get_json(silent=True) or {}).get('refresh_key')
+    if refresh_key:
+        try:
+            decoded = decode_token(refresh_key)
+        except (JWTExtendedException, PyJWTError):
+            abort(401)
+        if (decoded['type'] != 'refresh' or
+                decoded[current_app.config['JWT_IDENTITY_CLAIM']] !=
+                current_user.username):
+            abort(401)
+        try:
+            revoke(decoded)
+        except IntegrityError:
+            db.session.rollback()
+    return jsonify({'response': 'success'})
+
+
 @user_auths.route('/update_notif', methods=['POST'])
+@query_budget(4)
 @jwt_required
 def update_msg():
     '''
@@ -350,26 +430,142 @@ def update_msg():
     if notif_q is None:
         return jsonify({'error': 'internal'})
     try:
+        was_read, user_id = notif_q.is_read, notif_q.user_id
         notif_q.is_read = True
     except IntegrityError:
         abort(500)
     else:
         db.session.commit()
+        if not was_read:
+            commit_counters(unread=[user_id])
     finally:
         return jsonify({'response': 'success'})
 
 
+@user_auths.route('/notifications', methods=['GET'])
+@query_budget(3)
+@jwt_required
+def list_notifications():
+    '''
+    User notifications, newest first, one page at a time
+
+    Methods:
+        GET
+
+    Args:
+        limit (int): Query string page size, bounded by `LIST_MAX_PAGE_SIZE`
+        cursor (str): Query string `next_cursor` from the previous page
+        fields (str): Query string comma separated notification fields
+
+    Raises:
+        400: Malformed limit or cursor, unknown field
+        401: Couldn't find username in database
+
+    Returns:
+        Page of notifications, unread count and the next page cursor
+    '''
+    user_q = User.query.get(current_user.id)
+    if user_q is None:
+        abort(401)
+    fields = requested_fields(serializers.notification)
+    notifications, next_cursor = keyset_page(
+        Notification.query.options(*serializers.notification.load_options(
+            fields, 'sended_on')).filter_by(user_id=user_q.id), Notification,
+        cursor=request.args.get('cursor'),
+        limit=page_limit(request.args.get('limit')),
+        column=Notification.sended_on)
+    return respond({'notifications': list(serializers.notification.dump_many(
+                        notifications, fields)),
+                    'unread': user_q.unread_notifications,
+                    'next_cursor': next_cursor})
+
+
+@user_auths.route('/notifications/stream', methods=['GET'])
+@query_budget(1)
+@jwt_required
+def stream_notifications():
+    '''
+    New notifications as Server-Sent Events. Browsers' EventSource can't
+    set headers, pass the access token as the `code` query string. Served
+    by the gevent instance, see `wsgi-stream.ini`
+
+    Methods:
+        GET
+
+    Args:
+        Last-Event-ID (str): Header sent by EventSource on reconnect,
+            notifications after it are replayed. `last_event_id` query
+            string for the first connection
+
+    Raises:
+        400: Malformed event id
+        401: Couldn't find username in database
+
+    Returns:
+        text/event-stream of `notification` events
+    '''
+    last_id = request.headers.get('Last-Event-ID',
+                                  request.args.get('last_event_id'))
+    try:
+        last_id = None if last_id is None else int(last_id)
+    except ValueError:
+        abort(400)
+    user_id = current_user.id
+    db.session.remove()
+    response = Response(stream(current_app._get_current_object(), user_id,
+                               last_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@user_auths.route('/.well-known/jwks.json', methods=['GET'])
+@query_budget(0)
+def jwks():
+    '''
+    Public keys verifying our access tokens, for other services
+
+    Methods:
+        GET
+
+    Raises:
+        404: Tokens are signed with a shared secret (HS256)
+
+    Returns:
+        JWKS json
+    '''
+    keys = current_app.config.get('JWT_JWKS')
+    if not keys:
+        abort(404)
+    response = jsonify(keys)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+
 @user_auths.route('/autor_public/<int:id>', methods=['GET'])
+@query_budget(2)
 def autor_public(id):
     '''
     Endpoint for retrieving autor public info
 
     Args:
-        id (int): User id for querying
+        id (int): Project id, the info of its autor is returned
+        fields (str): Query string comma separated user fields to return
 
     Methods:
         GET
+
+    Raises:
+        400: Unknown field
+        404: Project not found
     '''
-    proj_q = Project.query.filter_by(id=id).first()
-    user_q = User.query.filter_by(email=proj_q.autor.email).first()
-    return user_q.json_dump
+    autor_id = db.session.query(Project.autor_id).filter_by(id=id).scalar()
+    if autor_id is None:
+        abort(404)
+
+    fields = requested_fields(serializers.user)
+
+    def build():
+        return respond(serializers.user.dump(User.query.get(autor_id), fields))
+    return cache.response(request_key('autor_public', autor_id, fields),
+                          [('autor', autor_id)], build)
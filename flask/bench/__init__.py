@@ -0,0 +1,32 @@
+# __init__.py
+'''
+Capacity benchmarks against the real uWSGI + nginx stack.
+
+Run from the `flask` folder, external services replaced by local stand-ins:
+
+    python debug_smtp.py 1025 /tmp/outbox &
+    python fake_oidc.py 5055 &
+    python -m bench.fake_s3 5056 &
+    export APP_CONFIG=Benchmark S3_ENDPOINT_URL=http://localhost:5056
+    export AWS_ACCESS_KEY_ID=bench AWS_SECRET_ACCESS_KEY=bench
+    python -m bench.seed --users 2000 --projects 20000 --notifications 200000
+    uwsgi --ini wsgi.ini &    # and nginx with webapp.conf
+    python -m bench.load --url https://localhost --duration 60 \
+        --out bench/results/$(git rev-parse --short HEAD).json
+
+`bench.load` prints throughput and p50/p95/p99 per endpoint. Pass an
+earlier result with `--compare` to see the difference between commits.
+
+`bench.upstream` measures concurrent requests waiting on a slow OpenID
+provider (`fake_oidc.py --delay=1`), to compare `wsgi.ini` with
+`wsgi-gevent.ini`; `bench.serve` runs a single worker of either kind where
+uWSGI isn't installed.
+
+`python -m bench.startup` times a cold `instance()` and compares the
+memory of workers loading the app after forking with workers forked from a
+preloaded master.
+
+`python -m bench.queries` needs none of the above: it checks the SQL
+statement budget of every endpoint on throwaway databases, run it before
+deploying.
+'''
@@ -0,0 +1,51 @@
+# fake_s3.py
+'''
+Local S3 stand-in for benchmarks. Accepts every object write, path or
+virtual host style, and answers like S3 without storing anything unless
+a spool folder is given.
+
+    python -m bench.fake_s3 [port] [spool_dir]
+
+Point the app at it with `S3_ENDPOINT_URL=http://localhost:<port>`
+'''
+
+from flask import Flask, request
+
+import hashlib
+import os
+import sys
+import uuid
+
+app = Flask(__name__)
+spool = next((arg for arg in sys.argv[1:] if not arg.isdigit()), None)
+
+
+@app.route('/', defaults={'key': ''}, methods=['GET', 'HEAD', 'PUT', 'POST',
+                                                'DELETE'])
+@app.route('/<path:key>', methods=['GET', 'HEAD', 'PUT', 'POST', 'DELETE'])
+def objects(key):
+    body = request.get_data()
+    if request.method == 'PUT' and spool:
+        path = os.path.join(spool, request.host.split(':')[0], key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(body)
+    if request.method == 'POST' and 'uploads' in request.args:
+        '''Multipart upload start'''
+        return ('<InitiateMultipartUploadResult><Bucket>bucket</Bucket>'
+                '<Key>{}</Key><UploadId>{}</UploadId>'
+                '</InitiateMultipartUploadResult>'.format(
+                    key, uuid.uuid4().hex), 200,
+                {'Content-Type': 'application/xml'})
+    if request.method == 'POST' and 'uploadId' in request.args:
+        return ('<CompleteMultipartUploadResult><Key>{}</Key>'
+                '</CompleteMultipartUploadResult>'.format(key), 200,
+                {'Content-Type': 'application/xml'})
+    if request.method == 'DELETE':
+        return '', 204
+    return '', 200, {'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())}
+
+
+if __name__ == '__main__':
+    port = int(next((arg for arg in sys.argv[1:] if arg.isdigit()), 5056))
+    app.run(port=port, threaded=True)
@@ -0,0 +1,266 @@
+# load.py
+'''
+Load generator replaying a realistic traffic mix against a running stack.
+
+Anonymous catalog reads (`/list` and its next pages, `/search`,
+`/get_project`) dominate, logged users read `/user` and `/notifications`,
+like projects and send solicitations, and now and then a user logs in a few
+times in a row. Workers are processes running threads, every thread keeps
+its own keep-alive session and logged user from the `bench.seed` manifest.
+
+    python -m bench.load [--url https://localhost] [--duration 60]
+                         [--processes 4] [--threads 16] [--out result.json]
+                         [--compare earlier.json]
+
+Reports requests per second and p50/p95/p99 latency per endpoint, and saves
+them as json along with the commit, so runs can be compared.
+'''
+
+from multiprocessing import Process, Queue
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+import requests
+import urllib3
+
+'''Scenario weights, out of their sum'''
+MIX = {
+    'list': 30,
+    'list_next': 10,
+    'search': 15,
+    'get_project': 15,
+    'user': 8,
+    'notifications': 6,
+    'like_project': 8,
+    'solicitation': 3,
+    'login_burst': 1,
+}
+LOGIN_BURST = 5
+
+
+class Client(object):
+    '''One simulated user: a keep-alive session and an access token'''
+
+    def __init__(self, url, manifest, rand):
+        self.url = url.rstrip('/')
+        self.manifest = manifest
+        self.rand = rand
+        self.http = requests.Session()
+        self.http.verify = False
+        self.cursor = None
+        self.samples = []
+        self.email = manifest['email'].format(
+            manifest['first_user'] + rand.randrange(manifest['users']))
+        self.headers = dict()
+        response = self.login()
+        if response is not None and response.ok:
+            self.headers = {'Authorization': 'Bearer ' +
+                            response.json()['key']}
+
+    def request(self, name, method, path, **kwargs):
+        '''Send a request, recording (name, status, seconds)'''
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.url + path,
+                                         timeout=30, **kwargs)
+            response.content
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        self.samples.append((name, status, time.perf_counter() - start))
+        return response
+
+    def project_id(self):
+        return self.manifest['first_project'] + self.rand.randrange(
+            self.manifest['projects'])
+
+    def login(self):
+        return self.request('login', 'POST', '/login', json={
+            'email': self.email, 'password': self.manifest['password']})
+
+    def list(self):
+        response = self.request('list', 'GET', '/list')
+        if response is not None and response.ok:
+            self.cursor = response.json().get('next_cursor')
+
+    def list_next(self):
+        if not self.cursor:
+            return self.list()
+        response = self.request('list_next', 'GET', '/list',
+                                params={'cursor': self.cursor})
+        if response is not None and response.ok:
+            self.cursor = response.json().get('next_cursor')
+
+    def search(self):
+        words = self.rand.sample(self.manifest['words'],
+                                 self.rand.choice((1, 1, 2)))
+        self.request('search', 'POST', '/search',
+                     json={'string': ' '.join(word[:self.rand.randrange(
+                         3, len(word) + 1)] for word in words)})
+
+    def get_project(self):
+        self.request('get_project', 'GET',
+                     '/get_project/{}'.format(self.project_id()))
+
+    def user(self):
+        self.request('user', 'GET', '/user', headers=self.headers)
+
+    def notifications(self):
+        self.request('notifications', 'GET', '/notifications',
+                     headers=self.headers)
+
+    def like_project(self):
+        self.request('like_project', 'POST', '/like_project',
+                     headers=self.headers,
+                     json={'project_id': self.project_id()})
+
+    def solicitation(self):
+        cart = {str(index): {'project_id': self.project_id()}
+                for index in range(self.rand.randint(1, 3))}
+        self.request('solicitation', 'POST', '/solicitation',
+                     headers=self.headers,
+                     json=[cart, {'autor_msg': 'Bench solicitation'}])
+
+    def login_burst(self):
+        for _ in range(LOGIN_BURST):
+            self.login()
+
+
+def worker(url, manifest, threads, duration, seed, results):
+    '''Process running `threads` clients until `duration` runs out'''
+    urllib3.disable_warnings()
+    names = list(MIX)
+    weights = [MIX[name] for name in names]
+    deadline = time.monotonic() + duration
+    clients = []
+
+    def run(index):
+        rand = random.Random(seed * 1000 + index)
+        client = Client(url, manifest, rand)
+        client.samples = []
+        clients.append(client)
+        while time.monotonic() < deadline:
+            getattr(client, rand.choices(names, weights)[0])()
+    pool = [threading.Thread(target=run, args=(index,))
+            for index in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put([sample for client in clients for sample in client.samples])
+
+
+def percentile(values, rank):
+    '''Nearest-rank percentile of sorted values'''
+    if not values:
+        return None
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+def summarize(samples, elapsed):
+    '''
+    Per endpoint statistics
+
+    Args:
+        samples (list): (name, status, seconds) tuples
+        elapsed (float): Seconds the load ran for
+
+    Returns:
+        (dict): Endpoint name to count, rps, errors, statuses and
+        latency percentiles in milliseconds, `total` for all of them
+    '''
+    groups = dict()
+    for name, status, seconds in samples:
+        groups.setdefault(name, []).append((status, seconds))
+    groups['total'] = [(status, seconds) for _, status, seconds in samples]
+    report = dict()
+    for name, entries in sorted(groups.items()):
+        latencies = sorted(seconds * 1000 for _, seconds in entries)
+        statuses = dict()
+        for status, _ in entries:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        report[name] = dict(
+            count=len(entries), rps=round(len(entries) / elapsed, 2),
+            errors=sum(1 for status, _ in entries
+                       if status == 0 or status >= 500),
+            statuses=statuses,
+            mean=round(sum(latencies) / len(latencies), 2),
+            p50=round(percentile(latencies, 50), 2),
+            p95=round(percentile(latencies, 95), 2),
+            p99=round(percentile(latencies, 99), 2),
+            max=round(latencies[-1], 2))
+    return report
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    columns = ('count', 'rps', 'errors', 'p50', 'p95', 'p99')
+    print('{:<14}'.format('endpoint') +
+          ''.join('{:>18}'.format(column) for column in columns))
+    for name, stats in report.items():
+        cells = []
+        for column in columns:
+            cell = str(stats[column])
+            previous = (baseline or {}).get(name, {}).get(column)
+            if previous and column in ('rps', 'p50', 'p95', 'p99'):
+                cell += ' ({:+.0%})'.format(stats[column] / previous - 1)
+            cells.append('{:>18}'.format(cell))
+        print('{:<14}'.format(name) + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='https://localhost')
+    parser.add_argument('--manifest', default='bench/seed.json')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--out', help='save the result as json')
+    parser.add_argument('--compare', help='earlier result to compare with')
+    args = parser.parse_args()
+    with open(args.manifest) as file:
+        manifest = json.load(file)
+    results = Queue()
+    processes = [Process(target=worker, args=(
+        args.url, manifest, args.threads, args.duration,
+        args.seed * 100 + index, results)) for index in range(args.processes)]
+    start = time.monotonic()
+    for process in processes:
+        process.start()
+    samples = [sample for _ in processes for sample in results.get()]
+    elapsed = time.monotonic() - start
+    for process in processes:
+        process.join()
+    report = summarize(samples, args.duration)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['endpoints']
+    print_report(report, baseline)
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as file:
+            json.dump(dict(commit=commit(), started=time.time() - elapsed,
+                           duration=round(elapsed, 2), url=args.url,
+                           processes=args.processes, threads=args.threads,
+                           mix=MIX, dataset=manifest, endpoints=report),
+                      file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+# queries.py
+'''
+SQL statement budget check of every endpoint, see `app/common/budgets.py`.
+
+Each scenario below is replayed through the test client on two fresh
+SQLite datasets, a small and a large one, where the requesting user owns
+`size` projects and notifications and liked all of those projects but one. A
+scenario fails when its request runs more statements than the view budget,
+runs more on the large dataset than on the small one (a query per row),
+reads a whole table or answers another status than the expected one, an
+error answered early would make the other checks pass having tested
+nothing. Views of `contents`, `user_auths` and `oauth` without a budget fail
+too. Offending statements are printed with their query plan and the exit
+status is 1.
+
+    python -m bench.queries [--small 5] [--large 50] [--verbose]
+
+Both sizes stay under `JSON_STREAM_BATCH`, so streamed collections count
+their per-batch statements once. The response cache is off, user snapshots
+are warm as in a running process.
+'''
+
+from app import instance, db
+from app.config import Development
+from app.common import migrations
+from app.common.budgets import Recorder, budget_of
+from app.common.jwt import issue_tokens
+from app.common.models import Notification, Project, ProjectLike, User
+from app.common.pagination import encode_cursor
+from app.common.revocation import issue_link_token
+from app.common.search import rebuild_index
+from bench.seed import seed
+from datetime import datetime
+
+import argparse
+import random
+import shutil
+import sys
+import tempfile
+
+BLUEPRINTS = ('contents', 'user_auths', 'oauth')
+UNCONFIRMED = 'unconfirmed@bench.local'
+
+
+class Fixture(object):
+    '''Rows and tokens scenarios build their requests from'''
+
+    def __init__(self, manifest, size):
+        self.user = manifest['first_user']
+        self.email = manifest['email'].format(self.user)
+        '''Second seeded user, not a partner'''
+        self.member = manifest['email'].format(self.user + 1)
+        self.password = manifest['password']
+        self.project = manifest['first_project']
+        self.unliked = manifest['first_project'] + size - 1
+        self.cart = {str(index): {'project_id': self.project + index}
+                     for index in range(3)}
+        self.notification = db.session.query(
+            db.func.min(Notification.id)).filter_by(
+            user_id=self.user).scalar()
+        self.cursor = encode_cursor(datetime.now(), 2 ** 31)
+
+    def auth(self, email=None, **headers):
+        access, _ = issue_tokens(email or self.email)
+        return dict(headers, Authorization='Bearer ' + access)
+
+    def refresh(self):
+        _, refresh = issue_tokens(self.email)
+        return refresh
+
+    def link(self, email, purpose):
+        return issue_link_token(email, purpose)
+
+    def project_form(self, **fields):
+        return dict(dict(project_title='Bench check', project_type='event',
+                         project_video='', project_desc='ikebana de inverno',
+                         project_allow='true'), **fields)
+
+
+'''(endpoint, method, label, status, request) where request(fixture) returns
+the path and test client arguments and status is the expected response
+status. Scenarios deleting rows or revoking the user tokens come last'''
+SCENARIOS = (
+    ('contents.list_arrangements', 'GET', 'anonymous', 200,
+     lambda f: ('/list', {})),
+    ('contents.list_arrangements', 'GET', 'next page', 200,
+     lambda f: ('/list', dict(query_string={'cursor': f.cursor}))),
+    ('contents.list_arrangements', 'GET', 'logged', 200,
+     lambda f: ('/list', dict(headers=f.auth()))),
+    ('contents.get_projcet', 'GET', 'anonymous', 200,
+     lambda f: ('/get_project/{}'.format(f.project), {})),
+    ('contents.get_projcet', 'GET', 'logged', 200,
+     lambda f: ('/get_project/{}'.format(f.project),
+                dict(headers=f.auth()))),
+    ('contents.search', 'POST', 'anonymous', 200,
+     lambda f: ('/search', dict(json={'string': 'ikebana flor'}))),
+    ('contents.search', 'POST', 'logged', 200,
+     lambda f: ('/search', dict(json={'string': 'ikebana flor'},
+                                headers=f.auth()))),
+    ('contents.register', 'GET', 'own projects', 200,
+     lambda f: ('/projects', dict(headers=f.auth()))),
+    ('contents.register', 'POST', 'new project', 200,
+     lambda f: ('/projects', dict(data=f.project_form(),
+                                  headers=f.auth()))),
+    ('contents.register', 'PUT', 'edit project', 200,
+     lambda f: ('/projects', dict(data=f.project_form(
+         project_id=f.project, project_title='Bench edit'),
+         headers=f.auth()))),
+    ('contents.project_uploads', 'GET', '', 200,
+     lambda f: ('/projects/{}/uploads'.format(f.project),
+                dict(headers=f.auth()))),
+    ('contents.like_project', 'POST', '', 200,
+     lambda f: ('/like_project', dict(json={'project_id': f.unliked},
+                                      headers=f.auth()))),
+    ('contents.new_solicitation', 'POST', 'three projects', 200,
+     lambda f: ('/solicitation', dict(json=[f.cart, {'autor_msg': 'Check'}],
+                                      headers=f.auth()))),
+    ('user_auths.login', 'POST', '', 200,
+     lambda f: ('/login', dict(json={'email': f.email,
+                                     'password': f.password}))),
+    ('user_auths.register', 'POST', '', 200,
+     lambda f: ('/user_register', dict(json={
+         'email': 'new@bench.local', 'fullname': 'New', 'password': 'x'}))),
+    ('user_auths.recover_pass', 'POST', '', 200,
+     lambda f: ('/recover_pass', dict(json={'email': f.email}))),
+    ('user_auths.verify', 'GET', '', 200,
+     lambda f: ('/verify', dict(query_string={
+         'code': f.link(UNCONFIRMED, 'verify')}))),
+    ('user_auths.turn_partner', 'POST', 'update data', 200,
+     lambda f: ('/become_partner', dict(json={
+         'city': 'Recife', 'tel': '0', 'personal_address': '',
+         'location': '', 'work_address': ''}, headers=f.auth()))),
+    ('user_auths.turn_partner', 'POST', 'new partner', 200,
+     lambda f: ('/become_partner', dict(json={
+         'city': 'Recife', 'tel': '0', 'personal_address': '',
+         'location': '', 'work_address': ''}, headers=f.auth(f.member)))),
+    ('user_auths.retrieve_user', 'GET', '', 200,
+     lambda f: ('/user', dict(headers=f.auth()))),
+    ('user_auths.retrieve_user', 'POST', 'profile', 200,
+     lambda f: ('/user', dict(data={'fullname': 'Bench', 'bio': ''},
+                              content_type='multipart/form-data',
+                              headers=f.auth()))),
+    ('user_auths.update_msg', 'POST', '', 200,
+     lambda f: ('/update_notif', dict(json={'notif_id': f.notification},
+                                      headers=f.auth()))),
+    ('user_auths.list_notifications', 'GET', '', 200,
+     lambda f: ('/notifications', dict(headers=f.auth()))),
+    ('user_auths.jwks', 'GET', '', 404,
+     lambda f: ('/.well-known/jwks.json', {})),
+    ('user_auths.autor_public', 'GET', '', 200,
+     lambda f: ('/autor_public/{}'.format(f.project), {})),
+    ('user_auths.refresh', 'POST', '', 200,
+     lambda f: ('/refresh', dict(headers={
+         'Authorization': 'Bearer ' + f.refresh()}))),
+    ('user_auths.logout', 'POST', 'with refresh token', 200,
+     lambda f: ('/logout', dict(json={'refresh_key': f.refresh()},
+                                headers=f.auth()))),
+    ('contents.register', 'DELETE', 'delete project', 200,
+     lambda f: ('/projects', dict(json={'project_id': f.project},
+                                  headers=f.auth()))),
+    ('user_auths.retrieve_user', 'DELETE', 'clear notifications', 200,
+     lambda f: ('/user', dict(headers=f.auth()))),
+    ('user_auths.retrieve_user', 'POST', 'password', 200,
+     lambda f: ('/user', dict(json={'old_pass': f.password,
+                                    'new_pass': f.password},
+                              headers=f.auth()))),
+    ('user_auths.reset_pass', 'POST', '', 200,
+     lambda f: ('/reset_pass', dict(
+         json={'password': f.password},
+         query_string={'code': f.link(f.email, 'recover')}))),
+)
+
+
+def check_config(folder):
+    '''Development config on throwaway databases, no cache nor rate limits'''
+    class QueryCheck(Development):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/users.db'.format(folder)
+        SQLALCHEMY_BINDS = {
+            'content': 'sqlite:///{}/content.db'.format(folder)}
+        TESTING = True
+        CACHE_BACKEND = 'memory'
+        CACHE_TTL = 0
+        RATELIMIT_ENABLED = False
+        PASSWORD_HASH_WORKERS = 0
+    return QueryCheck
+
+
+def populate(size):
+    '''
+    Seed ten times `size` users, projects and notifications, then hand
+    `size` projects and notifications to the first user, who likes all of those projects
+    but one and has every notification unread
+
+    Returns:
+        (Fixture)
+    '''
+    manifest = seed(size * 10, size * 10, size * 10, random.Random(size))
+    owner = manifest['first_user']
+    first = manifest['first_project']
+    '''Seeded projects of the first user go to the next partner'''
+    Project.query.filter_by(autor_id=owner).update(
+        {Project.autor_id: owner + 10}, synchronize_session=False)
+    Project.query.filter(Project.id < first + size).update(
+        {Project.autor_id: owner}, synchronize_session=False)
+    notifications = db.session.query(Notification.id).order_by(
+        Notification.id).limit(size).subquery()
+    Notification.query.filter(Notification.id.in_(notifications)).update(
+        {Notification.user_id: owner, Notification.is_read: False},
+        synchronize_session=False)
+    db.session.execute(ProjectLike.__table__.insert(), [
+        dict(project_id=first + index, user_id=owner)
+        for index in range(size - 1)], mapper=ProjectLike.__mapper__)
+    db.session.add(User(username=UNCONFIRMED, email=UNCONFIRMED,
+                        fullname='Unconfirmed', password='x',
+                        confirmed=False))
+    db.session.commit()
+    migrations.user_aggregates()
+    rebuild_index()
+    db.session.commit()
+    migrations.analyze()
+    return Fixture(manifest, size)
+
+
+def replay(size):
+    '''
+    Replay every scenario on a fresh dataset
+
+    Returns:
+        (app, dict): The app and (endpoint, method, label) to the response
+        status and recorded statements
+    '''
+    folder = tempfile.mkdtemp()
+    app = instance(check_config(folder))
+    results = dict()
+    try:
+        with app.app_context():
+            migrations.upgrade()
+            fixture = populate(size)
+            client = app.test_client()
+            for endpoint, method, label, _, build in SCENARIOS:
+                path, kwargs = build(fixture)
+                with Recorder() as recorder:
+                    response = client.open(path, method=method, **kwargs)
+                    response.get_data()
+                    response.close()
+                results[endpoint, method, label] = (response.status_code,
+                                                    recorder.statements)
+            for _, statements in results.values():
+                for statement in statements:
+                    statement.explain()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return app, results
+
+
+def unbudgeted(app):
+    '''(endpoint, method) of blueprint views declaring no budget'''
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint.split('.')[0] not in BLUEPRINTS:
+            continue
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if budget_of(app.view_functions[rule.endpoint], method) is None:
+                missing.append((rule.endpoint, method))
+    return missing
+
+
+def show(statement):
+    print('      {:.1f}ms  {}'.format(
+        (statement.seconds or 0) * 1000, ' '.join(statement.sql.split())[:400]))
+    for line in statement.plan:
+        print('        ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--small', type=int, default=5)
+    parser.add_argument('--large', type=int, default=50)
+    parser.add_argument('--verbose', action='store_true',
+                        help='print the statements of every scenario')
+    args = parser.parse_args()
+    _, small = replay(args.small)
+    app, large = replay(args.large)
+    failed = False
+    print('{:<32}{:<8}{:<22}{:>7}{:>7}{:>8}'.format(
+        'endpoint', 'method', 'scenario', args.small, args.large, 'budget'))
+    for endpoint, method, label, expected, _ in SCENARIOS:
+        key = endpoint, method, label
+        status, statements = large[key]
+        budget = budget_of(app.view_functions[endpoint], method)
+        problems = []
+        if budget is None:
+            problems.append('no budget')
+        elif len(statements) > budget:
+            problems.append('over budget')
+        if len(statements) > len(small[key][1]):
+            problems.append('grows with rows')
+        scans = [statement for statement in statements
+                 if statement.full_scans()]
+        if scans:
+            problems.append('full scan')
+        for answered in sorted({small[key][0], status} - {expected}):
+            problems.append('status {}, expected {}'.format(
+                answered, expected))
+        print('{:<32}{:<8}{:<22}{:>7}{:>7}{:>8}  {}'.format(
+            endpoint, method, label, len(small[key][1]), len(statements),
+            '-' if budget is None else budget,
+            ', '.join(problems) or 'ok'))
+        if problems or args.verbose:
+            for statement in (scans if problems == ['full scan']
+                              else statements):
+                show(statement)
+        failed = failed or bool(problems)
+    replayed = {(endpoint, method)
+                for endpoint, method, _, _, _ in SCENARIOS}
+    for endpoint, method in unbudgeted(app):
+        print('{:<32}{:<8}no budget'.format(endpoint, method))
+        failed = True
+    for rule in app.url_map.iter_rules():
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if (rule.endpoint.split('.')[0] in BLUEPRINTS and
+                    (rule.endpoint, method) not in replayed):
+                print('{:<32}{:<8}not replayed'.format(rule.endpoint, method))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
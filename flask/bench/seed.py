@@ -0,0 +1,122 @@
+# seed.py
+'''
+Synthetic dataset for benchmarks. Fills `users.db` and `content.db` (or
+whatever the `APP_CONFIG` binds point at) with users, projects and
+notifications, then refreshes counters, the search index and planner
+statistics. Every user shares one password, written with the row ranges to
+a manifest for `bench.load`.
+
+    python -m bench.seed [--users N] [--projects N] [--notifications N]
+                         [--reset] [--manifest bench/seed.json]
+'''
+
+from app import instance, db
+from app.common import migrations
+from app.common.hashing import hash_password
+from app.common.models import Notification, Project, User
+from app.common.search import rebuild_index
+from datetime import datetime, timedelta
+
+import argparse
+import json
+import random
+
+PASSWORD = 'bench-password'
+EMAIL = 'bench{}@bench.local'
+WORDS = ('ikebana', 'flores', 'inverno', 'primavera', 'cerâmica', 'bambu',
+         'orquídea', 'crisântemo', 'cerejeira', 'galho', 'musgo', 'vaso',
+         'kenzan', 'moribana', 'nageire', 'seika', 'rikka', 'outono',
+         'verão', 'folhagem', 'pedra', 'água', 'sakura', 'camélia')
+TYPES = ('arrangement', 'workshop', 'event', 'course')
+
+
+def _insert(model, rows, size=5000):
+    '''Executemany inserts in chunks, one commit per chunk'''
+    for start in range(0, len(rows), size):
+        db.session.execute(model.__table__.insert(), rows[start:start + size],
+                           mapper=model.__mapper__)
+        db.session.commit()
+
+
+def _moment(rand, days):
+    return datetime.now() - timedelta(seconds=rand.randrange(days * 86400))
+
+
+def _text(rand, words):
+    return ' '.join(rand.choice(WORDS) for _ in range(words))
+
+
+def seed(users, projects, notifications, rand):
+    '''
+    Insert the dataset
+
+    Args:
+        users (int): Users, one in ten is a partner owning projects
+        projects (int): Projects spread over the partners
+        notifications (int): Notifications spread over every user
+        rand (Random): Seeded random source
+
+    Returns:
+        (dict): Manifest of inserted id ranges
+    '''
+    password = hash_password(PASSWORD)
+    first_user = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    _insert(User, [dict(
+        id=first_user + index,
+        username=EMAIL.format(first_user + index),
+        email=EMAIL.format(first_user + index),
+        fullname='Bench {}'.format(_text(rand, 2).title()),
+        password=password, confirmed=True, partner=index % 10 == 0,
+        city=rand.choice(('São Paulo', 'Curitiba', 'Recife')),
+        created_on=_moment(rand, 730)) for index in range(users)])
+    partners = list(range(first_user, first_user + users, 10))
+    first_project = (db.session.query(
+        db.func.max(Project.id)).scalar() or 0) + 1
+    _insert(Project, [dict(
+        id=first_project + index,
+        name='Bench {} {}'.format(first_project + index, _text(rand, 2)),
+        autor_id=rand.choice(partners), type=rand.choice(TYPES),
+        description=_text(rand, 30), created_on=_moment(rand, 365),
+        picture={'file1': 'https://bench.local/{}.png'.format(index)},
+        picture_meta={}, video='', liked_by={}, like_count=0, orders=0,
+        allow=index % 3 == 0) for index in range(projects)])
+    _insert(Notification, [dict(
+        user_id=first_user + rand.randrange(users),
+        sender='Mensagem do Sistema', content=_text(rand, 12),
+        sended_on=_moment(rand, 90), is_read=rand.random() < 0.7)
+        for _ in range(notifications)])
+    migrations.user_aggregates()
+    rebuild_index()
+    db.session.commit()
+    migrations.analyze()
+    return dict(email=EMAIL, password=PASSWORD, first_user=first_user,
+                users=users,
+                partners=len(partners), first_project=first_project,
+                projects=projects, notifications=notifications,
+                words=list(WORDS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--projects', type=int, default=20000)
+    parser.add_argument('--notifications', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--reset', action='store_true',
+                        help='drop every table first')
+    parser.add_argument('--manifest', default='bench/seed.json')
+    args = parser.parse_args()
+    app = instance()
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        migrations.upgrade()
+        manifest = seed(args.users, args.projects, args.notifications,
+                        random.Random(args.seed))
+    with open(args.manifest, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    print(json.dumps(manifest))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# serve.py
+'''
+One app worker without uWSGI, to compare worker modes where it isn't
+installed: a sync worker serving one request at a time like a process of
+`wsgi.ini`, or a gevent worker like a process of `wsgi-gevent.ini`.
+
+    python -m bench.serve [--port 5077] [--gevent 200]
+
+Numbers are per process, uWSGI runs `processes` of them.
+'''
+
+import argparse
+import logging
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--gevent', type=int, default=0, metavar='GREENLETS',
+                        help='cooperative worker with that many greenlets')
+    args = parser.parse_args()
+    if args.gevent:
+        os.environ['WORKER_MODE'] = 'gevent'
+    '''Monkey patches first when WORKER_MODE is gevent'''
+    from wsgi import app
+    if args.gevent:
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('', args.port), app, spawn=Pool(args.gevent),
+                   log=None).serve_forever()
+    else:
+        from werkzeug.serving import run_simple
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        run_simple('', args.port, app, threaded=False)
+
+
+if __name__ == '__main__':
+    main()
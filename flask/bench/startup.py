@@ -0,0 +1,187 @@
+# startup.py
+'''
+Cold start and memory of app workers.
+
+    python -m bench.startup [--workers 5] [--runs 5]
+
+Times `instance()` in fresh interpreters, imports included, then the first
+request, with the resident memory after each. Then forks `--workers`
+children the way uWSGI does, loading the app in each child after the fork
+(`lazy-apps = true`) or once in the parent before it (preloaded), and adds
+up their proportional set size once each has served a few requests: pages
+shared copy-on-write count once, split between the processes sharing them.
+
+Runs on throwaway databases, needs Linux for `/proc/<pid>/smaps_rollup`.
+'''
+
+from statistics import median
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+def memory(pid='self'):
+    '''
+    Memory of a process in KiB
+
+    Returns:
+        (dict): `rss`, `pss` and `uss` (pages private to the process)
+    '''
+    fields = dict()
+    with open('/proc/{}/smaps_rollup'.format(pid)) as file:
+        for line in file:
+            name, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                fields[name] = int(value.split()[0])
+    return dict(rss=fields['Rss'], pss=fields['Pss'],
+                uss=fields['Private_Clean'] + fields['Private_Dirty'])
+
+
+def load(folder):
+    '''App on the databases of `folder`'''
+    from app import instance
+    from bench.queries import check_config
+    return instance(check_config(folder))
+
+
+def serve(app):
+    '''A few anonymous read requests'''
+    client = app.test_client()
+    for method, path, options in (
+            ('GET', '/list', {}),
+            ('POST', '/search', dict(json={'string': 'ikebana flor'}))):
+        response = client.open(path, method=method, **options)
+        response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError('{} {} answered {}'.format(
+                method, path, response.status_code))
+
+
+def prepare(folder):
+    '''Migrate and seed a small dataset'''
+    from app.common import migrations
+    from bench.seed import seed
+    app = load(folder)
+    with app.app_context():
+        migrations.upgrade()
+        seed(200, 2000, 2000, random.Random(7))
+
+
+def cold(folder):
+    '''Load the app and serve its first request in this interpreter'''
+    start = time.perf_counter()
+    app = load(folder)
+    loaded = time.perf_counter()
+    after_load = memory()['rss']
+    serve(app)
+    return dict(load=loaded - start, request=time.perf_counter() - loaded,
+                rss_load=after_load, rss_request=memory()['rss'],
+                boto3='boto3' in sys.modules)
+
+
+def workers(folder, count, preload):
+    '''
+    Fork `count` workers, each serving a few requests
+
+    Returns:
+        (dict): Memory of the parent and of every worker
+    '''
+    if preload:
+        app = load(folder)
+        gc.freeze()
+    ready, done = os.pipe(), os.pipe()
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready[0])
+            os.close(done[1])
+            try:
+                if preload:
+                    '''What uWSGI runs in every worker it forks'''
+                    from app.common import services
+                    services.forked()
+                else:
+                    app = load(folder)
+                serve(app)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os.write(ready[1], b'.')
+                os.read(done[0], 1)
+                os._exit(0)
+        pids.append(pid)
+    for _ in pids:
+        os.read(ready[0], 1)
+    result = dict(master=memory(), workers=[memory(pid) for pid in pids])
+    os.close(done[1])
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return result
+
+
+def probe(role, folder, *options):
+    '''Run a role in a fresh interpreter, return its json output'''
+    output = subprocess.run(
+        [sys.executable, '-m', 'bench.startup', '--role', role,
+         '--folder', folder] + list(options),
+        check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def mib(kib):
+    return '{:.1f}'.format(kib / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--role', help=argparse.SUPPRESS)
+    parser.add_argument('--folder', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == 'workers':
+        print(json.dumps(workers(args.folder, args.workers, args.preload)))
+        return
+    if args.role:
+        print(json.dumps(dict(prepare=prepare, cold=cold)[args.role](
+            args.folder)))
+        return
+    folder = tempfile.mkdtemp()
+    try:
+        probe('prepare', folder)
+        runs = [probe('cold', folder) for _ in range(args.runs)]
+        print('cold start, median of {} runs'.format(args.runs))
+        print('  instance()      {:.3f}s  rss {} MiB  boto3 loaded: {}'.format(
+            median(run['load'] for run in runs),
+            mib(median(run['rss_load'] for run in runs)), runs[0]['boto3']))
+        print('  first requests  {:.3f}s  rss {} MiB'.format(
+            median(run['request'] for run in runs),
+            mib(median(run['rss_request'] for run in runs))))
+        print('{} workers, MiB'.format(args.workers))
+        print('{:<12}{:>12}{:>12}{:>12}{:>12}'.format(
+            '', 'master pss', 'worker pss', 'worker uss', 'total pss'))
+        for label, options in (('lazy-apps', []), ('preloaded', ['--preload'])):
+            result = probe('workers', folder, '--workers', str(args.workers),
+                           *options)
+            pss = [worker['pss'] for worker in result['workers']]
+            uss = [worker['uss'] for worker in result['workers']]
+            print('{:<12}{:>12}{:>12}{:>12}{:>12}'.format(
+                label, mib(result['master']['pss']), mib(median(pss)),
+                mib(median(uss)), mib(result['master']['pss'] + sum(pss))))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# upstream.py
+'''
+Concurrent requests waiting on a slow upstream: `/callback` against
+`fake_oidc.py --delay=1`, whose token endpoint answers after a second.
+
+    python fake_oidc.py 5055 --delay=1 &
+    python -m bench.upstream [--url https://localhost]
+                             [--provider http://localhost:5055]
+                             [--concurrency 5,25,100,200] [--duration 15]
+
+The app needs `APP_CONFIG=Benchmark`, `APP_SECRET_KEY` and, over plain
+http, `OAUTHLIB_INSECURE_TRANSPORT=1`. Every client thread logs in as its
+own OpenID user, created by an untimed first request. For each concurrency
+level prints completed callbacks per second, errors and latency: sync
+workers top out at `processes / delay`, gevent workers keep up until their
+greenlets, connection pools or CPU run out.
+'''
+
+from bench.load import summarize
+from urllib.parse import parse_qs, urlparse
+
+import argparse
+import json
+import os
+import threading
+import time
+import requests
+import urllib3
+
+
+def callback(http, url, provider, email, timeout):
+    '''
+    Fetch a code from the provider, then time the app callback
+
+    Returns:
+        (status, seconds): status 0 when the request failed
+    '''
+    redirect_uri = url + '/callback'
+    response = http.get(provider + '/authorize', allow_redirects=False,
+                        params={'redirect_uri': redirect_uri,
+                                'login_hint': email})
+    code = parse_qs(urlparse(response.headers['Location']).query)['code'][0]
+    start = time.perf_counter()
+    try:
+        response = http.get(redirect_uri, params={'code': code},
+                            timeout=timeout)
+        response.content
+        status = response.status_code
+    except requests.RequestException:
+        status = 0
+    return status, time.perf_counter() - start
+
+
+def level(url, provider, concurrency, duration, timeout):
+    '''Run `concurrency` clients for `duration` seconds'''
+    samples = []
+    ready = threading.Barrier(concurrency + 1)
+
+    def client(index):
+        http = requests.Session()
+        http.verify = False
+        email = 'upstream{}@bench.local'.format(index)
+        callback(http, url, provider, email, timeout)
+        ready.wait()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            status, seconds = callback(http, url, provider, email, timeout)
+            samples.append(('callback', status, seconds))
+    threads = [threading.Thread(target=client, args=(index,))
+               for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.monotonic()
+    for thread in threads:
+        thread.join()
+    '''Requests still queued at the deadline finish late, count them in'''
+    return summarize(samples, time.monotonic() - start)['callback']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='https://localhost')
+    parser.add_argument('--provider', default='http://localhost:5055')
+    parser.add_argument('--concurrency', default='5,25,100,200')
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--out', help='save the result as json')
+    args = parser.parse_args()
+    urllib3.disable_warnings()
+    columns = ('count', 'rps', 'errors', 'p50', 'p95', 'p99')
+    print('{:<12}'.format('concurrency') +
+          ''.join('{:>10}'.format(column) for column in columns))
+    results = dict()
+    for concurrency in [int(value) for value in args.concurrency.split(',')]:
+        stats = level(args.url.rstrip('/'), args.provider.rstrip('/'),
+                      concurrency, args.duration, args.timeout)
+        results[concurrency] = stats
+        print('{:<12}'.format(concurrency) +
+              ''.join('{:>10}'.format(stats[column]) for column in columns))
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as file:
+            json.dump(dict(url=args.url, duration=args.duration,
+                           levels=results), file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# debug_smtp.py
+'''
+Local SMTP stand-in for offline development. Accepts any login, never
+relays and prints every received message (or writes it to a spool folder).
+
+    python debug_smtp.py [port] [spool_dir]
+
+Pair it with the `Development` config (localhost:1025, no TLS)
+'''
+
+import socketserver
+import sys
+import os
+import time
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    '''One SMTP session, just enough of RFC 5321 for smtplib'''
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 debug_smtp ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline().decode('utf-8', 'replace').strip()
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250-debug_smtp')
+                self.reply('250-AUTH PLAIN LOGIN')
+                self.reply('250 8BITMIME')
+            elif command == 'HELO':
+                self.reply('250 debug_smtp')
+            elif command == 'AUTH':
+                if line.upper().startswith('AUTH LOGIN'):
+                    for prompt in ('VXNlcm5hbWU6', 'UGFzc3dvcmQ6'):
+                        if prompt == 'VXNlcm5hbWU6' and len(line.split()) > 2:
+                            continue
+                        self.reply('334 ' + prompt)
+                        self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif command == 'MAIL':
+                sender, recipients = line[10:].strip(), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line[8:].strip())
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b'.\r\n', b'.\n', b''):
+                        break
+                    data.append(chunk[1:] if chunk.startswith(b'..') else chunk)
+                self.server.store(sender, recipients, b''.join(data))
+                self.reply('250 OK: queued')
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, spool=None):
+        super().__init__(address, SMTPHandler)
+        self.spool = spool
+        if spool:
+            os.makedirs(spool, exist_ok=True)
+
+    def store(self, sender, recipients, data):
+        if self.spool:
+            name = '{:.6f}.eml'.format(time.time())
+            with open(os.path.join(self.spool, name), 'wb') as file:
+                file.write(data)
+        else:
+            print('---------- {} -> {}'.format(sender, ', '.join(recipients)))
+            print(data.decode('utf-8', 'replace'), flush=True)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1025
+    spool = sys.argv[2] if len(sys.argv) > 2 else None
+    DebugSMTPServer(('127.0.0.1', port), spool).serve_forever()
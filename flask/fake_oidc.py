@@ -0,0 +1,122 @@
+# fake_oidc.py
+'''
+Local OpenID Connect provider stand-in for offline development of the oauth
+endpoints. Approves every authorization request, signs RS256 ID tokens with
+a key generated at startup and serves discovery and JWKS with ETag and
+Cache-Control like Google does.
+
+    python fake_oidc.py [port] [--minimal] [--delay=seconds]
+
+`--minimal` issues ID tokens holding only `sub` and `email`, so the app has
+to fall back to userinfo. `--delay` holds every token response that long,
+like a slow provider (see `bench/upstream.py`). Point the app at it with
+`GOOGLE_DISCOVERY_URL=http://localhost:<port>/.well-known/openid-configuration`
+and `OAUTHLIB_INSECURE_TRANSPORT=1` (plain http). Get a code by opening
+`/authorize?redirect_uri=...&login_hint=someone@email.com`
+'''
+
+from flask import Flask, jsonify, request, redirect, abort
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+from urllib.parse import urlencode
+
+import hashlib
+import json
+import sys
+import time
+import uuid
+import jwt
+
+app = Flask(__name__)
+key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                               backend=default_backend())
+kid = uuid.uuid4().hex[:16]
+codes = dict()
+tokens = dict()
+minimal = '--minimal' in sys.argv
+delay = float(next((arg.split('=', 1)[1] for arg in sys.argv[1:]
+                    if arg.startswith('--delay=')), 0))
+
+
+def cached(payload, max_age=300):
+    '''Json response with ETag and max-age, 304 when the client has it'''
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+    return response.make_conditional(request)
+
+
+@app.route('/.well-known/openid-configuration')
+def discovery():
+    base = request.host_url.rstrip('/')
+    return cached({
+        'issuer': base,
+        'authorization_endpoint': base + '/authorize',
+        'token_endpoint': base + '/token',
+        'userinfo_endpoint': base + '/userinfo',
+        'jwks_uri': base + '/jwks',
+        'id_token_signing_alg_values_supported': ['RS256'],
+    })
+
+
+@app.route('/jwks')
+def jwks():
+    jwk = json.loads(RSAAlgorithm.to_jwk(key.public_key()))
+    jwk.update(kid=kid, use='sig', alg='RS256')
+    return cached({'keys': [jwk]})
+
+
+@app.route('/authorize')
+def authorize():
+    email = request.args.get('login_hint', 'someone@email.com')
+    code = uuid.uuid4().hex
+    codes[code] = {
+        'sub': hashlib.sha1(email.encode()).hexdigest()[:21],
+        'email': email,
+        'email_verified': True,
+        'given_name': email.split('@')[0].title(),
+        'picture': 'https://example.com/{}.png'.format(email.split('@')[0]),
+    }
+    query = {'code': code}
+    if request.args.get('state'):
+        query['state'] = request.args['state']
+    return redirect(request.args['redirect_uri'] + '?' + urlencode(query))
+
+
+@app.route('/token', methods=['POST'])
+def token():
+    time.sleep(delay)
+    claims = codes.pop(request.form.get('code'), None)
+    if claims is None or request.authorization is None:
+        return jsonify({'error': 'invalid_grant'}), 400
+    now = int(time.time())
+    id_claims = dict(claims, iss=request.host_url.rstrip('/'),
+                     aud=request.authorization.username, iat=now,
+                     exp=now + 3600)
+    if minimal:
+        id_claims = {name: id_claims[name] for name in
+                     ('iss', 'aud', 'iat', 'exp', 'sub', 'email')}
+    access_token = uuid.uuid4().hex
+    tokens[access_token] = claims
+    id_token = jwt.encode(id_claims, key, algorithm='RS256',
+                          headers={'kid': kid})
+    if isinstance(id_token, bytes):
+        id_token = id_token.decode('ascii')
+    return jsonify({'access_token': access_token, 'token_type': 'Bearer',
+                    'expires_in': 3600, 'id_token': id_token,
+                    'scope': 'openid email profile'})
+
+
+@app.route('/userinfo')
+def userinfo():
+    header = request.headers.get('Authorization', '')
+    claims = tokens.get(header.split(' ')[-1])
+    if claims is None:
+        abort(401)
+    return jsonify(claims)
+
+
+if __name__ == '__main__':
+    port = int(next((arg for arg in sys.argv[1:] if arg.isdigit()), 5055))
+    app.run(port=port, threaded=True)
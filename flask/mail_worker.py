@@ -0,0 +1,10 @@
+# mail_worker.py
+'''Outbox e-mail sender process. Started by uWSGI, see `wsgi.ini`'''
+
+from app import instance
+from app.common.outbox import run
+
+app = instance()
+
+if __name__ == '__main__':
+    run(app)
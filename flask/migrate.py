@@ -0,0 +1,11 @@
+# migrate.py
+'''Upgrade storage databases to the current models. Run before serving'''
+
+from app import instance
+from app.common.migrations import upgrade
+
+app = instance()
+
+if __name__ == '__main__':
+    with app.app_context():
+        upgrade()
@@ -6,5 +6,5 @@ app = instance()
 app.app_context().push()
 
 from app.common.models import *
-from app import s3
+from app.common.services import s3
 
@@ -1,8 +1,32 @@
 # run.py
+'''
+WSGI entry point. `WORKER_MODE=gevent` (see `wsgi-gevent.ini`) patches the
+standard library before the app imports requests, smtplib and later
+boto3, so their sockets yield to other greenlets instead of blocking the
+worker.
+
+`wsgi.ini` loads the app once in the uWSGI master, workers share it
+copy-on-write and reset what can't cross a fork, see
+`app/common/services.py`
+'''
+
+import gc
+import os
+
+if os.environ.get('WORKER_MODE') == 'gevent':
+    from gevent import monkey
+    if not monkey.is_module_patched('socket'):
+        '''uWSGI `gevent-monkey-patch` may have done it already'''
+        monkey.patch_all()
 
 from app import instance
+from app.common import services
 
 app = instance()
 
+if services.preloading():
+    '''Collections would touch, and so copy, every object loaded so far'''
+    gc.freeze()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')